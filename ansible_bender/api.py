@@ -1,16 +1,25 @@
 import datetime
+import hashlib
+import json
 import logging
 import os
 import sys
-from typing import Tuple, List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, List, Iterable, Optional
 
 from ansible_bender.builder import get_builder
+from ansible_bender.builders.buildah_builder import BuildahBuilder
 from ansible_bender.builders.base import BuildState
-from ansible_bender.conf import Build
-from ansible_bender.constants import OUT_LOGGER, OUT_LOGGER_FORMAT, TIMESTAMP_FORMAT
-from ansible_bender.core import AnsibleRunner
+from ansible_bender.conf import Build, BuildSummary, CachePolicy, RetentionPolicy
+from ansible_bender.constants import OUT_LOGGER, OUT_LOGGER_FORMAT, TIMESTAMP_FORMAT, \
+    RETENTION_TIME_BUDGET, NO_CACHE_TAG, STOP_LAYERING_TAG, PROBE_CACHE_TTL
+from ansible_bender.core import AnsibleRunner, get_task_contents, get_task_plan
 from ansible_bender.db import Database
 from ansible_bender.exceptions import ABBuildUnsuccesful
+from ansible_bender.fingerprint import Fingerprinter, FINGERPRINT_CACHE_FILE_NAME
+from ansible_bender.ipc import BuildService
+from ansible_bender.pipeline import CommitPipeline
 from ansible_bender.utils import set_logging
 
 
@@ -18,20 +27,46 @@ logger = logging.getLogger(__name__)
 out_logger = logging.getLogger(OUT_LOGGER)
 
 
+def get_group_digest(contents):
+    """
+    key of a layer in the cache store: a layer created by a single task is keyed by its
+    content, a layer which covers several tasks by a digest of their contents
+
+    :param contents: list of str
+    :return: str
+    """
+    if len(contents) == 1:
+        return contents[0]
+    sha512 = hashlib.sha512()
+    for content in contents:
+        sha512.update(content.encode("utf-8") + b"\n")
+    return sha512.hexdigest()
+
+
 class Application:
-    def __init__(self, debug=False, db_path=None, verbose=False, init_logging=True):
+    def __init__(self, debug=False, db_path=None, verbose=False, init_logging=True, db_backend=None,
+                 cache_policy=None, retention_policy=None):
         """
         :param debug: bool, provide debug output if True
         :param db_path: str, path to json file where the database stores the data persistently
         :param verbose: bool, print verbose output
         :param init_logging: bool, set up logging if True
+        :param db_backend: str, name of the database backend: json or sqlite
+        :param cache_policy: instance of CachePolicy, when to evict layers from the cache
+        :param retention_policy: instance of RetentionPolicy, which past builds to remove
         """
         if init_logging:
             self.set_logging(debug=debug, verbose=verbose)
         self.verbose = verbose
         self.debug = debug
-        self.db = Database(db_path=db_path)
+        self.db = Database(db_path=db_path, backend=db_backend)
         self.db_path = self.db.db_root_path
+        self.cache_policy = cache_policy or CachePolicy()
+        self.retention_policy = retention_policy or RetentionPolicy()
+        # build_id -> builder, see get_builder
+        self._builders = {}
+        # build_id -> CommitPipeline, see Build.pipelined_commits
+        self._commit_pipelines = {}
 
     @staticmethod
     def set_logging(debug: bool = False, verbose: bool = False):
@@ -67,17 +102,9 @@ class Application:
 
         try:
             builder = self.get_builder(build)
-            builder.sanity_check()
-
-            # before we start messing with the base image, we need to check for its presence first
-            if not builder.is_base_image_present():
-                builder.pull()
-                build.pulled = True
-
-            builder.check_container_creation()
+            base_image_id = self._preflight(build, builder)
 
             # let's record base image as a first layer
-            base_image_id = builder.get_image_id(build.base_image)
             build.record_layer(None, base_image_id, None, cached=True)
 
             a_runner = AnsibleRunner(build.playbook_path, builder, build, debug=self.debug)
@@ -86,12 +113,12 @@ class Application:
             build.build_start_time = datetime.datetime.now()
             self.db.record_build(build, build_state=BuildState.IN_PROGRESS)
 
-            build.python_interpreter = build.python_interpreter or self.db.load_python_interpreter(base_image_id)
-            if not build.python_interpreter:
-                build.python_interpreter = builder.find_python_interpreter()
-                self.db.record_python_interpreter(base_image_id, build.python_interpreter)
+            if build.is_layering_on() and not build.layering_policy.is_default():
+                build.task_plan = self._get_task_plan(build)
 
             builder.create()
+            build.working_container_layer_id = base_image_id
+            self.db.record_build(build)
         except Exception:
             self.db.record_build(
                 None,
@@ -101,68 +128,296 @@ class Application:
             )
             raise
 
+        if build.pipelined_commits:
+            # commits are collected by this instance: it serves the callback plugin
+            # during the whole build, see BuildService
+            self._commit_pipelines[build.build_id] = CommitPipeline()
+        output = ""
+        succeeded = False
         try:
             try:
-                output = a_runner.build(self.db_path)
+                # the callback plugin consults this process about every task
+                with BuildService(self, build) as service:
+                    output = a_runner.build(self.db_path, db_backend=self.db.backend.name,
+                                            ipc_address=service.address)
+                # layers committed in the background have to be recorded before the final image
+                self.collect_commits(build, wait=True)
+                b = self.db.get_build(build.build_id)
+                # tasks executed since the last boundary deserve a layer in the cache
+                self.commit_pending_tasks(b)
+                self.collect_commits(b, wait=True)
+                # the playbook may have ended with a run of tasks loaded from cache
+                self.materialize_working_container(b)
+                # commit the final image and apply all metadata
+                b.final_layer_id = self._commit_final_image(b, builder)
+                if builder.commit_timings:
+                    logger.info("%d commits took %.2f s in total", len(builder.commit_timings),
+                                sum(x["seconds"] for x in builder.commit_timings))
+
+                if b.squash:
+                    logger.debug("Squashing metadata into a single layer")
+                    # reset layers if squashing
+                    b.wipe_layers()
+                    self.record_progress(b, None, b.final_layer_id)
+                if not b.is_layering_on():
+                    self.record_progress(b, None, b.final_layer_id)
+                b.log_file = self.db.save_logs(b.build_id, output.split("\n"))
+                # the build is done once all its layers and the final image are committed
+                self.db.record_build(b, build_state=BuildState.DONE, set_finish_time=True)
             except ABBuildUnsuccesful as ex:
-                b = self.db.record_build(None, build_id=build.build_id,
-                                         build_state=BuildState.FAILED,
-                                         set_finish_time=True)
-                b.log_lines = ex.output.split("\n")
-                self.db.record_build(b)
-                timestamp = datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
-                image_name = build.target_image + "-" + timestamp + "-failed"
-                b.target_image = image_name
-                image_id = builder.commit(image_name)
-                b.final_layer_id = image_id
-                self.record_progress(b, None, image_id)
-                out_logger.info("Image build failed /o\\")
-                out_logger.info("The progress is saved into image '%s'", image_name)
+                self._record_failed_build(build, builder, ex.output)
+                raise
+            except Exception:
+                # e.g. a layer committed in the background failed: the build must not stay
+                # in progress, it would never be pruned
+                try:
+                    self._record_failed_build(build, builder, output)
+                except Exception as ex:
+                    logger.warning("unable to save the progress of the failed build: %s", ex)
                 raise
-
-            b = self.db.record_build(None, build_id=build.build_id, build_state=BuildState.DONE,
-                                     set_finish_time=True)
-            b.log_lines = output
-            # commit the final image and apply all metadata
-            b.final_layer_id = builder.commit(build.target_image, final_image=True)
-
-            if b.squash:
-                logger.debug("Squashing metadata into a single layer")
-                # reset layers if squashing
-                b.wipe_layers()
-                self.record_progress(b, None, b.final_layer_id)
-            if not b.is_layering_on():
-                self.record_progress(b, None, b.final_layer_id)
-            else:
-                self.db.record_build(b)
 
             out_logger.info("Image '%s' was built successfully \\o/",  build.target_image)
+            succeeded = True
         finally:
+            pipeline = self._commit_pipelines.pop(build.build_id, None)
+            if pipeline is not None:
+                pipeline.close()
             builder.clean()
+            self._prune_after_build(succeeded)
+
+    def _record_failed_build(self, build: Build, builder, output: str):
+        """
+        mark the build as failed and save the working container into a "-failed" image
+
+        :param build: Build instance
+        :param builder: instance of Builder
+        :param output: str, output of ansible-playbook
+        """
+        try:
+            self.collect_commits(build, wait=True)
+        except Exception as commit_ex:
+            logger.warning("a layer committed in the background failed: %s", commit_ex)
+            self._commit_pipelines.pop(build.build_id).close()
+        b = self.db.record_build(None, build_id=build.build_id,
+                                 build_state=BuildState.FAILED,
+                                 set_finish_time=True)
+        b.log_file = self.db.save_logs(b.build_id, output.split("\n"))
+        self.db.record_build(b)
+        timestamp = datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
+        image_name = build.target_image + "-" + timestamp + "-failed"
+        b.target_image = image_name
+        self.materialize_working_container(b)
+        image_id = builder.commit(image_name)
+        b.final_layer_id = image_id
+        self.record_progress(b, None, image_id)
+        out_logger.info("Image build failed /o\\")
+        out_logger.info("The progress is saved into image '%s'", image_name)
+
+    def _commit_final_image(self, build: Build, builder) -> str:
+        """
+        commit the final image and apply all metadata; when the working container is the same
+        as the top layer (no task ran since the layer was committed, or the filesystem of the
+        container didn't change since then), only the metadata is applied on top of the layer
+        so that the filesystem of the container is not read again
+
+        :param build: Build instance
+        :param builder: instance of Builder
+        :return: str, id of the final image
+        """
+        top_layer_id = build.get_top_layer_id()
+        if (build.is_layering_on() and not build.squash
+                and build.working_container_layer_id == top_layer_id):
+            unchanged = not build.working_container_dirty
+            if not unchanged:
+                # tasks ran since the top layer was committed, e.g. tasks which reported
+                # no change: only a scan of the filesystem can prove they changed nothing
+                fs_changes = builder.get_fs_changes()
+                unchanged = fs_changes is not None and not fs_changes[0]
+            if unchanged:
+                image_id = builder.commit_metadata(top_layer_id, build.target_image)
+                if image_id:
+                    logger.debug("the final image was created from layer %s", top_layer_id)
+                    return image_id
+        return builder.commit(build.target_image, final_image=True)
+
+    def _preflight(self, build: Build, builder) -> str:
+        """
+        check that the container tooling works, make sure the base image is present and
+        find the python interpreter in it; independent probes run concurrently and the checks
+        of the tooling are skipped if they passed recently with the same versions and base image
+
+        :param build: Build instance, it's updated
+        :param builder: instance of Builder
+        :return: str, id of the base image
+        """
+        with ThreadPoolExecutor() as executor:
+            environment_id = executor.submit(builder.get_environment_id)
+            is_base_image_present = executor.submit(builder.is_base_image_present)
+            environment_id, is_base_image_present = environment_id.result(), is_base_image_present.result()
+
+        # before we start messing with the base image, we need to check for its presence first
+        if not is_base_image_present:
+            builder.pull()
+            build.pulled = True
+        base_image_id = builder.get_image_id(build.base_image)
+
+        probe_key = None
+        if environment_id:
+            probe_key = hashlib.sha256(json.dumps([
+                environment_id, base_image_id, build.buildah_from_extra_args,
+                build.buildah_run_extra_args, build.podman_run_extra_args,
+            ]).encode("utf-8")).hexdigest()
+        probes = []
+        if probe_key and self.db.is_probe_fresh(probe_key, PROBE_CACHE_TTL):
+            logger.info("the container tooling passed the checks recently, skipping them")
+        else:
+            probes = [builder.sanity_check, builder.check_container_creation]
+        build.python_interpreter = build.python_interpreter or self.db.load_python_interpreter(base_image_id)
+
+        with ThreadPoolExecutor() as executor:
+            futures = [executor.submit(p) for p in probes]
+            python_interpreter = None
+            if not build.python_interpreter:
+                python_interpreter = executor.submit(builder.find_python_interpreter)
+            for f in futures:
+                f.result()
+            if python_interpreter is not None:
+                build.python_interpreter = python_interpreter.result()
+                self.db.record_python_interpreter(base_image_id, build.python_interpreter)
+        if probes and probe_key:
+            self.db.record_probe(probe_key)
+        return base_image_id
+
+    def plan(self, build: Build) -> List[dict]:
+        """
+        find out which tasks of the build would be loaded from cache, without creating
+        any container or running ansible-playbook; the cache is queried the same way
+        the build queries it: task by task, or for runs of tasks when a layering policy
+        is set
+
+        :param build: instance of Build
+        :return: list of dicts, one for every task: name, action, content, cached (bool,
+                 None when it can't be known before the build runs: the content of the task
+                 or of a task before it depends on facts or registered variables),
+                 layer_id (str, the cached layer) and duration (float or None, how long
+                 the task took when it was executed the last time)
+        """
+        if not os.path.isfile(build.playbook_path):
+            raise RuntimeError("No such file or directory: %s" % build.playbook_path)
+
+        fingerprinter = Fingerprinter(os.path.join(self.db.runtime_dir_path, FINGERPRINT_CACHE_FILE_NAME))
+        tasks = get_task_contents(build.playbook_path, fingerprinter=fingerprinter)
+        # the latest timing of a task, regardless of the image it was executed on
+        durations = {}
+        entries = self.db.load_cache_entries()
+        entries.sort(key=lambda e: e["last_hit"] or datetime.datetime.min)
+        for e in entries:
+            if e["duration"] is not None:
+                durations[e["content"]] = e["duration"]
+
+        builder = self.get_builder(build)
+        top_layer_id = None
+        if builder.is_base_image_present():
+            top_layer_id = builder.get_image_id(build.base_image)
+        # the same decisions task_started makes during the build
+        caching = build.cache_tasks and build.is_layering_on() and top_layer_id is not None
+        # runs of tasks are looked up only with a layering policy, see _decide_planned_task_start
+        spans = not build.layering_policy.is_default()
+        task_plan = get_task_plan(tasks, build.layering_policy.granularity)
+        # cached or not, the task before was unknown
+        unknown = False
+        response = []
+        index = 0
+        while index < len(tasks):
+            span, layer_id, cached = 0, None, False
+            if caching and task_plan[index]["cacheable"] and task_plan[index]["content"] is None:
+                # the task uses facts or registered variables
+                caching, unknown = False, True
+            if caching and task_plan[index]["cacheable"]:
+                contents = []
+                for planned in task_plan[index:] if spans else task_plan[index:index + 1]:
+                    if not planned["cacheable"] or planned["content"] is None:
+                        break
+                    contents.append(planned["content"])
+                span, layer_id = self._find_cached_span(builder, top_layer_id, contents)
+            if span:
+                top_layer_id = layer_id
+                cached = True
+            else:
+                # the task is executed: none of the following ones can be loaded from cache
+                caching = False
+                span = 1
+                cached = None if unknown else False
+            for task, _, content in tasks[index:index + span]:
+                response.append({
+                    "name": task.get_name(),
+                    "action": task.action,
+                    "content": content,
+                    "cached": cached,
+                    "layer_id": layer_id,
+                    "duration": durations.get(content),
+                })
+            index += span
+        return response
+
+    def _prune_after_build(self, succeeded: bool):
+        """
+        opportunistic cleanup, a failure here must not break the build
+
+        :param succeeded: bool, the build finished successfully
+        """
+        if not succeeded:
+            # the records, logs and the "-failed" image are needed to investigate the failure
+            # and the next attempt is likely to need the layers; `ab prune-builds` and
+            # `ab prune-cache` clean up on demand
+            logger.debug("the build did not succeed, past builds and the layer cache are not pruned")
+            return
+        try:
+            self.prune_builds(time_budget=RETENTION_TIME_BUDGET)
+        except Exception as ex:
+            logger.warning("unable to prune past builds: %s", ex)
+        try:
+            self.prune_cache()
+        except Exception as ex:
+            logger.warning("unable to prune the layer cache: %s", ex)
 
-    def get_build(self, build_id: str = None) -> Build:
+    def get_build(self, build_id: str = None, snapshot: bool = False) -> Build:
         """
         get selected build or latest build if build_id is None
 
         :param build_id: str or None
+        :param snapshot: bool, read without waiting for builds in progress: for read-only commands
         :return: build
         """
         if build_id is None:
-            return self.db.get_latest_build()
-        return self.db.get_build(build_id)
+            return self.db.get_latest_build(snapshot=snapshot)
+        return self.db.get_build(build_id, snapshot=snapshot)
 
-    def get_logs(self, build_id: str = None) -> List[str]:
+    def get_logs(self, build_id: str = None, tail: int = None) -> Iterable[str]:
         """
-        get logs for a specific build, if build_id is not, select the latest build
+        get logs for a specific build, if build_id is not, select the latest build;
+        the logs are read lazily
 
         :param build_id: str or None
-        :return: list of str
+        :param tail: int, provide only last N lines
+        :return: iterable of str
         """
-        build = self.get_build(build_id=build_id)
-        return build.log_lines
+        build = self.get_build(build_id=build_id, snapshot=True)
+        return self.db.iter_logs(build, tail=tail)
 
-    def list_builds(self) -> List[Build]:
-        return self.db.load_builds()
+    def list_builds(self, limit: int = None, state: BuildState = None, image: str = None,
+                    since: datetime.datetime = None) -> List[BuildSummary]:
+        """
+        provide summaries of past and present builds, oldest first
+
+        :param limit: int, list only the latest N builds
+        :param state: BuildState, list only builds in this state
+        :param image: str, glob pattern, list only builds of matching target images
+        :param since: datetime, list only builds started since then
+        :return: list of BuildSummary
+        """
+        return self.db.load_build_summaries(state=state, target_image=image, since=since,
+                                            limit=limit, snapshot=True)
 
     def inspect(self, build_id: str = None):
         """
@@ -171,9 +426,9 @@ class Application:
         :param build_id: str or None
         :return: dict
         """
-        build = self.get_build(build_id=build_id)
+        build = self.get_build(build_id=build_id, snapshot=True)
         di = build.to_dict()
-        del di["log_lines"]  # we have a dedicated command for that
+        del di["log_file"]  # we have a dedicated command for that
         del di["layer_index"]  # internal info
         return di
 
@@ -193,22 +448,322 @@ class Application:
         builder.push(build, target, force=force)
 
     def get_builder(self, build: Build):
-        return get_builder(build.builder_name)(build, debug=self.debug)
+        """
+        provide a builder for the selected build, it's reused by all calls for the build
+        so that its state (e.g. the index of images) is not lost
+        """
+        builder = self._builders.get(build.build_id)
+        if builder is not None:
+            # the build may have been loaded from the database again
+            builder.build = build
+            return builder
+        builder = get_builder(build.builder_name)(build, debug=self.debug)
+        if build.build_id is not None:
+            self._builders[build.build_id] = builder
+        return builder
+
+    def task_started(self, build: Build, content: str, tags: List[str],
+                     identity: str = None) -> Tuple[bool, Optional[str]]:
+        """
+        decide what to do with a task which is about to be executed: the task is skipped
+        when its result can be loaded from cache
+
+        :param build: Build instance, it's updated
+        :param content: str, hash of the task, see the callback plugin
+        :param tags: list of str, tags of the task
+        :param identity: str, identity of the task in the playbook, see the callback plugin
+        :return: (bool, skip the task, str or None, message to display)
+        """
+        if build.is_failed():
+            return True, None
+        self.collect_commits(build)
+        if build.task_plan is not None and build.is_layering_on():
+            skip, message = self._decide_planned_task_start(build, content, tags, identity)
+        else:
+            skip, message = self._decide_task_start(build, content, tags)
+        if not skip:
+            # the task is going to be executed, it needs the working container
+            self.materialize_working_container(build)
+        return skip, message
+
+    def _get_task_plan(self, build: Build) -> Optional[List[dict]]:
+        """ load the playbook and find boundaries of layers according to the layering policy """
+        fingerprinter = Fingerprinter(os.path.join(self.db.runtime_dir_path, FINGERPRINT_CACHE_FILE_NAME))
+        try:
+            tasks = get_task_contents(build.playbook_path, fingerprinter=fingerprinter)
+        except Exception as ex:
+            logger.warning("unable to load tasks of the playbook, a layer will be committed "
+                           "after every task: %s", ex)
+            return None
+        fingerprinter.save()
+        return get_task_plan(tasks, build.layering_policy.granularity)
 
-    def maybe_load_from_cache(self, content: str, build_id: str) -> str:
-        if not content:
-            return
+    @staticmethod
+    def _is_planned_task(planned_task: dict, content: str, identity: Optional[str]) -> bool:
+        """
+        tasks are matched by their identity: their content may depend on facts and registered
+        variables which are not known when the playbook is planned
+        """
+        if identity is not None and planned_task.get("identity") is not None:
+            return planned_task["identity"] == identity
+        return planned_task["content"] is not None and planned_task["content"] == content
+
+    def _get_planned_index(self, build: Build, content: str, identity: Optional[str],
+                           index: int) -> Optional[int]:
+        """ :return: index if the task is the one at the position in the plan, None otherwise """
+        if 0 <= index < len(build.task_plan) and self._is_planned_task(
+                build.task_plan[index], content, identity):
+            return index
+        return None
+
+    def _find_planned_index(self, build: Build, content: str, identity: Optional[str]) -> Optional[int]:
+        """
+        :return: index of the task in the plan at the current position or after it, tasks
+                 which are passed over didn't run; None if the task is not in the plan
+        """
+        for index in range(build.plan_position, len(build.task_plan)):
+            if self._is_planned_task(build.task_plan[index], content, identity):
+                return index
+        return None
+
+    def _decide_planned_task_start(self, build: Build, content: str, tags: List[str],
+                                   identity: Optional[str]) -> Tuple[bool, Optional[str]]:
+        """ task_started for builds which commit layers according to a layering policy """
+        index = self._find_planned_index(build, content, identity)
+        if index is None:
+            # tasks included dynamically can't be known beforehand: they are layered one by one
+            logger.info("task %s is not in the playbook, committing a layer for it", content)
+            self.commit_pending_tasks(build)
+            return self._decide_task_start(build, content, tags)
+        if index > build.plan_position:
+            # e.g. rescue tasks of a block which succeeded
+            logger.debug("tasks %d-%d of the playbook didn't run", build.plan_position, index - 1)
+            skipped = build.task_plan[build.plan_position:index]
+            if any(t["boundary"] for t in skipped) and build.layering_policy.should_commit(
+                    len(build.pending_contents), build.pending_duration):
+                self.commit_pending_tasks(build)
+        if STOP_LAYERING_TAG in tags:
+            build.stop_layering()
+            self.db.record_build(build)
+            return False, None
+        build.plan_position = index + 1
+        if index < build.plan_skip_until:
+            # a part of a layer which was loaded from cache
+            self.db.record_build(build)
+            return True, None
+        message = None
+        if NO_CACHE_TAG in tags and build.cache_tasks:
+            build.cache_tasks = False
+            message = "detected tag '%s': won't load from cache from now" % NO_CACHE_TAG
+        if (not build.pending_contents and build.cache_tasks and build.was_last_layer_cached()
+                and not self._get_commit_pipeline(build)):
+            # the following tasks are known from the plan, unless they use facts or
+            # registered variables
+            contents = [content] if content and build.task_plan[index]["cacheable"] else []
+            for task in build.task_plan[index + 1:] if contents else []:
+                if not task["cacheable"] or task["content"] is None:
+                    break
+                contents.append(task["content"])
+            span, _ = self._find_cached_span(self.get_builder(build), build.get_top_layer_id(), contents)
+            if span:
+                _, layer_id = self.record_progress(build, get_group_digest(contents[:span]), None)
+                if layer_id:
+                    build.plan_skip_until = index + span
+                    self.db.record_build(build)
+                    message = "loaded from cache: '%s'" % layer_id
+                    if span > 1:
+                        message += " (%d tasks)" % span
+                    return True, message
+        self.db.record_build(build)
+        return False, message
 
-        build = self.db.get_build(build_id)
-        builder = self.get_builder(build)
+    def _find_cached_span(self, builder, base_image_id: str, contents: List[str]) -> Tuple[int, Optional[str]]:
+        """
+        find the longest run of tasks which can be loaded from cache as a single layer
+
+        :param builder: instance of Builder
+        :param base_image_id: str, id of the top layer
+        :param contents: list of str, contents of the following tasks
+        :return: (int, how many tasks the layer covers, 0 if there is no such layer,
+                  str, id of the layer)
+        """
+        with self.db.transaction():
+            candidates = []
+            for span in range(1, len(contents) + 1):
+                layer_id = self.db.get_cached_layer(get_group_digest(contents[:span]), base_image_id,
+                                                    touch=False)
+                if layer_id:
+                    candidates.append((span, layer_id))
+        for span, layer_id in reversed(candidates):
+            if builder.is_image_present(layer_id):
+                return span, layer_id
+        return 0, None
+
+    def commit_pending_tasks(self, build: Build) -> Optional[str]:
+        """
+        commit tasks executed since the last layer into a new layer
+
+        :param build: Build instance, it's updated
+        :return: str, name of the image, None if no layer was committed
+        """
+        if not build.pending_contents:
+            return None
+        contents, duration, changed = build.pending_contents, build.pending_duration, build.pending_changed
+        build.pending_contents, build.pending_duration, build.pending_changed = [], 0.0, False
+        if not changed:
+            self.reuse_parent_layer(get_group_digest(contents), build, duration=duration)
+            return None
+        return self.cache_task_result(get_group_digest(contents), build, duration=duration)
+
+    def _decide_task_start(self, build: Build, content: str, tags: List[str]) -> Tuple[bool, Optional[str]]:
+        if STOP_LAYERING_TAG in tags:
+            build.stop_layering()
+            self.db.record_build(build)
+            return False, None
+        if NO_CACHE_TAG in tags:
+            build.cache_tasks = False
+            self.db.record_build(build)
+            return False, "detected tag '%s': won't load from cache from now" % NO_CACHE_TAG
+        if not build.was_last_layer_cached() or self._get_commit_pipeline(build):
+            # a layer is being committed: the task can't be loaded from cache on top of it
+            return False, None
+        if not build.is_layering_on():
+            return False, None
+        logger.debug("hash = %s", content)
+        status = self.maybe_load_from_cache(content, build)
+        if status:
+            return True, "loaded from cache: '%s'" % status
+        return False, None
+
+    def task_finished(self, build: Build, content: str, tags: List[str], action: str,
+                      failed: bool = False, skipped: bool = False, changed: bool = False,
+                      duration: float = None, identity: str = None) -> Optional[str]:
+        """
+        snapshot the container once a task was executed
+
+        :param build: Build instance, it's updated
+        :param content: str, hash of the task, see the callback plugin
+        :param tags: list of str, tags of the task
+        :param action: str, name of the ansible module
+        :param failed: bool, the task failed
+        :param skipped: bool, the task was skipped
+        :param changed: bool, the task reported a change
+        :param duration: float, how many seconds the task took
+        :param identity: str, identity of the task in the playbook, see the callback plugin
+        :return: str or None, message to display
+        """
+        if build.is_failed():
+            return None
+        if not skipped and not build.working_container_dirty:
+            # the task ran in the working container: until a layer is committed, its changes
+            # (or the changes of a task whose failure was ignored) are not in any layer
+            build.working_container_dirty = True
+            self.db.record_build(build)
+        if failed:
+            return None
+        self.collect_commits(build)
+        if STOP_LAYERING_TAG in tags:
+            build.stop_layering()
+            self.db.record_build(build)
+            return "detected tag '%s', tasks won't be cached nor layered any more" % STOP_LAYERING_TAG
+        if not build.is_layering_on():
+            return None
+        if not skipped:
+            changed = self._is_fs_changed(build, content, changed)
+        if build.task_plan is not None:
+            index = self._get_planned_index(build, content, identity, build.plan_position - 1)
+            if index is not None:
+                return self._planned_task_finished(build, index, content, changed, duration)
+        if skipped:
+            self._after_pending_commits(build, lambda: self.record_progress(build, content, None))
+            return None
+        if not changed:
+            layer_id = self.reuse_parent_layer(content, build, duration=duration)
+            if layer_id is None:
+                return "nothing changed, reusing the parent layer"
+            return "nothing changed, reusing layer '%s'" % layer_id
+        image_name = self.cache_task_result(content, build, duration=duration)
+        if image_name:
+            return "caching the task result in an image '%s'" % image_name
+        return None
+
+    def _is_fs_changed(self, build: Build, content: str, changed: bool) -> bool:
+        """
+        :param changed: bool, the changed status reported by ansible
+        :return: bool, did the task change the filesystem of the working container
+        """
+        if not build.detect_fs_changes:
+            return changed
+        fs_changes = self.get_builder(build).get_fs_changes()
+        if fs_changes is None:
+            return changed
+        fs_changed, size = fs_changes
+        logger.info("task %s: ansible reported changed=%s, the filesystem %s (%d bytes written)",
+                    (content or "")[:12], changed, "changed" if fs_changed else "didn't change", size)
+        return fs_changed
+
+    def _planned_task_finished(self, build: Build, index: int, content: str, changed: bool,
+                               duration: Optional[float]) -> Optional[str]:
+        """ task_finished for builds which commit layers according to a layering policy """
+        if index < build.plan_skip_until or index == build.plan_finished_position:
+            # loaded from cache or a result was already reported
+            return None
+        build.plan_finished_position = index
+        # the content computed when the task ran: it includes values of facts and registered
+        # variables, unlike the plan
+        build.pending_contents.append(content)
+        build.pending_duration += duration or 0.0
+        build.pending_changed = build.pending_changed or changed
+        last = index == len(build.task_plan) - 1
+        if build.task_plan[index]["boundary"] and (last or build.layering_policy.should_commit(
+                len(build.pending_contents), build.pending_duration)):
+            tasks = len(build.pending_contents)
+            image_name = self.commit_pending_tasks(build)
+            if image_name:
+                return "caching the result of %d task(s) in an image '%s'" % (tasks, image_name)
+            return None
+        self.db.record_build(build)
+        return None
+
+    def abort_build(self, build: Build):
+        """ mark the build as failed, the remaining tasks are skipped """
+        self.db.record_build(build, build_state=BuildState.FAILED)
+
+    def maybe_load_from_cache(self, content: str, build: Build) -> str:
+        """
+        load the layer for the task from cache and make it the top layer of the build
+
+        The working container is not replaced right away: tasks are often loaded from
+        cache in long runs, it's enough to create the container once the first task
+        is actually executed, see materialize_working_container.
 
-        if not build.cache_tasks:
+        :param content: str, hash of the task
+        :param build: Build instance, it's updated
+        :return: str, id of the loaded layer, None if it's not in cache
+        """
+        if not content or not build.cache_tasks:
             return
 
+        # buildah is asked whether the layer exists before the database is locked
         base_image_id, layer_id = self.record_progress(build, content, None)
-        builder.swap_working_container()
         return layer_id
 
+    def materialize_working_container(self, build: Build):
+        """
+        make sure the working container is created from the top layer of the build
+
+        :param build: Build instance, it's updated
+        """
+        top_layer_id = build.get_top_layer_id()
+        if build.working_container_layer_id in (None, top_layer_id):
+            return
+        logger.debug("creating the working container from layer %s", top_layer_id)
+        builder = self.get_builder(build)
+        builder.swap_working_container()
+        build.working_container_layer_id = top_layer_id
+        build.working_container_dirty = False
+        self.db.record_build(build)
+
     def get_layer(self, content: str, base_image_id: str) -> str:
         """
         provide a layer for given content and base_image_id; if there
@@ -222,7 +777,9 @@ class Application:
 
     def record_progress(self, build: Build, content: str, layer_id: str, build_id: str = None) -> Tuple[str, str]:
         """
-        record build progress to the database
+        record build progress to the database; when the layer is looked up in the cache,
+        the lookup and the check that its image exists (it runs buildah) are done before
+        the database is locked, the result is validated again within the transaction
 
         :param build:
         :param content: str or None
@@ -230,31 +787,45 @@ class Application:
         :param build_id:
         :return:
         """
-        if build_id:
-            build = self.db.get_build(build_id)
-        base_image_id = build.get_top_layer_id()
         was_cached = False
         if not layer_id:
             # skipped task, it was cached
-            if content:
-                layer_id = self.get_layer(content, base_image_id)
-                builder = self.get_builder(build)
-                if not builder.is_image_present(layer_id):
-                    logger.info("layer %s for content %s does not exist", layer_id, content)
-                    layer_id = None
+            if not content:
+                return None, None
+            if build_id:
+                build = self.db.get_build(build_id)
+            base_image_id = build.get_top_layer_id()
+            layer_id = self.db.get_cached_layer(content, base_image_id, touch=False)
+            if layer_id and not self.get_builder(build).is_image_present(layer_id):
+                logger.info("layer %s for content %s does not exist", layer_id, content)
+                layer_id = None
             if not layer_id:
                 return None, None
             was_cached = True
-        build.record_layer(content, layer_id, base_image_id, cached=was_cached)
-        self.db.record_build(build)
+        # the cache store is read before the build is changed
+        with self.db.transaction(write=True, build_id=build_id or build.build_id):
+            if build_id:
+                build = self.db.get_build(build_id)
+            top_layer_id = build.get_top_layer_id()
+            if was_cached:
+                # the build or the cache store could have changed since the lookup
+                if (top_layer_id != base_image_id
+                        or self.db.get_cached_layer(content, base_image_id) != layer_id):
+                    logger.info("layer %s for content %s is no longer in the cache", layer_id, content)
+                    return None, None
+            base_image_id = top_layer_id
+            build.record_layer(content, layer_id, base_image_id, cached=was_cached)
+            self.db.record_build(build)
         return base_image_id, layer_id
 
-    def create_new_layer(self, content: str, build: Build) -> Tuple[str, str, str]:
+    def create_new_layer(self, content: str, build: Build, duration: float = None) -> Tuple[str, str, str]:
         """
-        create new layer from the current state of the container of specified build
+        create new layer from the current state of the container of specified build,
+        record it and, if caching is on, store it in the cache
 
         :param content: task as a str
         :param build: Build instance
+        :param duration: float, how many seconds the task took
         :return:
         """
         builder = self.get_builder(build)
@@ -264,23 +835,180 @@ class Application:
             image_name = "%s-%s" % (build.target_image, timestamp)
             # buildah doesn't accept upper case
             image_name = image_name.lower()
+        cache_tasks = build.cache_tasks
+
+        def commit(parent_layer_id):
+            layer_id = builder.commit_snapshot(snapshot, image_name)
+            size = builder.get_layer_size(layer_id, parent_layer_id) if cache_tasks else None
+            return layer_id, size
+
+        def record(layer_id, size):
+            return self._record_new_layer(build, content, layer_id, size, duration, cache_tasks)
+
+        # the layer covers everything which happened in the working container so far
+        build.working_container_dirty = False
+        pipeline = self._get_commit_pipeline(build)
+        snapshot = builder.snapshot() if pipeline is not None else None
+        if snapshot is not None:
+            pipeline.submit(commit, build.get_top_layer_id(), record)
+            return image_name, None, None
+        # the snapshot failed: the layers have to be recorded in order
+        self.collect_commits(build, wait=True)
         layer_id = builder.commit(image_name, print_output=False)
-        base_image_id, _ = self.record_progress(build, content, layer_id)
+        size = None
+        if cache_tasks:
+            size = builder.get_layer_size(layer_id, build.get_top_layer_id())
+        base_image_id = record(layer_id, size)
         return image_name, layer_id, base_image_id
 
-    def cache_task_result(self, content: str, build: Build) -> str:
+    def _record_new_layer(self, build: Build, content: str, layer_id: str, size: Optional[int],
+                          duration: Optional[float], cache_tasks: bool) -> str:
+        """ :return: str, id of the parent layer """
+        build.working_container_layer_id = layer_id
+        # commit is slow, so it's done before the database is locked
+        with self.db.transaction(write=True):
+            base_image_id, _ = self.record_progress(build, content, layer_id)
+            if cache_tasks:
+                self.db.save_layer(layer_id, base_image_id, content, size=size, duration=duration)
+        return base_image_id
+
+    def _get_commit_pipeline(self, build: Build) -> Optional[CommitPipeline]:
+        """
+        :return: CommitPipeline, None if layers are committed synchronously, e.g. when
+                 a new instance is created for every task since IPC is not available
+        """
+        return self._commit_pipelines.get(build.build_id)
+
+    def _after_pending_commits(self, build: Build, record):
+        """
+        invoke record once the layers which are being committed are recorded: it's queued
+        after them instead of waiting for them
+
+        :param record: callable without arguments
+        :return: what record returns, None if it was queued
+        """
+        pipeline = self._get_commit_pipeline(build)
+        if not pipeline:
+            return record()
+        pipeline.submit(lambda parent_layer_id: (parent_layer_id, None), build.get_top_layer_id(),
+                        lambda layer_id, size: record())
+        return None
+
+    def collect_commits(self, build: Build, wait: bool = False):
+        """
+        record layers which were committed in the background, see Build.pipelined_commits
+
+        :param build: Build instance, it's updated
+        :param wait: bool, wait for the commits which are still in progress
+        """
+        pipeline = self._get_commit_pipeline(build)
+        if pipeline:
+            pipeline.collect(wait=wait)
+
+    def reuse_parent_layer(self, content: str, build: Build, duration: float = None) -> str:
+        """
+        record a task which didn't change anything: instead of committing an identical
+        image, the top layer stands for the task as well, in the build and in the cache
+
+        :param content: str, hash of the task
+        :param build: Build instance, it's updated
+        :param duration: float, how many seconds the task took
+        :return: str, id of the reused layer, None when the top layer is still being committed
+        """
+        cache_tasks = build.cache_tasks
+
+        def record():
+            with self.db.transaction(write=True):
+                layer_id = build.get_top_layer_id()
+                # the working container is still at the top layer, following tasks can be
+                # loaded from cache on top of it
+                build.record_layer(content, layer_id, layer_id, cached=True)
+                self.db.record_build(build)
+                if cache_tasks:
+                    self.db.save_layer(layer_id, layer_id, content, size=0, duration=duration)
+            return layer_id
+
+        return self._after_pending_commits(build, record)
+
+    def cache_task_result(self, content: str, build: Build, duration: float = None) -> str:
         """ snapshot the container after a task was executed """
         if not content:
             logger.info("no content provided, will not cache this layer")
             return
-        image_name, layer_id, base_image_id = self.create_new_layer(content, build)
+        image_name, _, _ = self.create_new_layer(content, build, duration=duration)
         if not build.cache_tasks:  # actually we could still cache results
             return
-        self.db.save_layer(layer_id, base_image_id, content)
         return image_name
 
+    def prune_cache(self, policy: CachePolicy = None) -> List[dict]:
+        """
+        evict layers from the cache store according to the policy and remove their images
+
+        :param policy: instance of CachePolicy, defaults to the policy of this application
+        :return: list of dicts, the evicted cache entries
+        """
+        policy = policy or self.cache_policy
+        entries = self.db.load_cache_entries()
+        evicted = policy.select_evicted(entries)
+        if not evicted:
+            return []
+        builder = get_builder(BuildahBuilder.name)
+        evicted_ids = {id(e) for e in evicted}
+        # images of unchanged tasks are their parents, see reuse_parent_layer
+        used_images = {e["image_id"] for e in entries if id(e) not in evicted_ids}
+        removed = []
+        # most recently used go first: those are usually children of the older layers
+        for entry in evicted:
+            if entry["image_id"] == entry["base_image_id"] or entry["image_id"] in used_images:
+                removed.append(entry)
+            elif builder.remove_image(entry["image_id"]):
+                removed.append(entry)
+        for entry in removed:
+            logger.debug("evicted layer %s (%s bytes, last used %s) from the cache",
+                         entry["image_id"], entry["size"], entry["last_hit"])
+        self.db.delete_cache_entries(removed)
+        logger.info("evicted %d layers from the cache, %d bytes freed",
+                    len(removed), sum(e["size"] or 0 for e in removed))
+        return removed
+
+    def prune_builds(self, policy: RetentionPolicy = None, time_budget: float = None) -> List[BuildSummary]:
+        """
+        remove past builds according to the retention policy, together with their logs
+        and the images committed by failed builds
+
+        :param policy: instance of RetentionPolicy, defaults to the policy of this application
+        :param time_budget: float, stop after this many seconds, the rest is removed next time
+        :return: list of BuildSummary, the removed builds
+        """
+        policy = policy or self.retention_policy
+        deadline = time.monotonic() + time_budget if time_budget is not None else None
+        expired = policy.select_expired(self.db.load_build_summaries())
+        builder = get_builder(BuildahBuilder.name)
+        removed = []
+        for summary in expired:
+            if deadline is not None and time.monotonic() > deadline:
+                logger.info("time budget for pruning builds is exhausted, %d builds remain",
+                            len(expired) - len(removed))
+                break
+            if policy.get_failed_image_target(summary.target_image):
+                if not builder.remove_image(summary.target_image):
+                    # keep the record so we can try again
+                    continue
+                logger.info("removed image %s of a failed build", summary.target_image)
+            try:
+                self.db.delete_build(summary.build_id)
+            except RuntimeError as ex:
+                # removed concurrently
+                logger.debug("%s", ex)
+                continue
+            logger.info("removed build %s of image %s (%s)", summary.build_id, summary.target_image,
+                        summary.state.value)
+            removed.append(summary)
+        logger.info("removed %d past builds", len(removed))
+        return removed
+
     def clean(self):
-        self.db.release()
+        self.db.close()
 
     def remove_build(self, build_id: str):
         self.db.delete_build(build_id)
@@ -23,6 +23,8 @@ class Builder:
         self.build = build
         self.ansible_host = None
         self.debug = debug
+        # how long the commits took: list of dicts: image, seconds, final
+        self.commit_timings = []
         self.python_interpr_prio = (
             "/usr/bin/python3",
             "/usr/local/bin/python3",
@@ -58,6 +60,17 @@ class Builder:
         :param image_name: str, name the snapshot
         """
 
+    def commit_metadata(self, layer_id, image_name):
+        """
+        create the final image from a committed layer by applying the metadata on top of it,
+        the working container is not committed
+
+        :param layer_id: str, id of the layer which has the same content as the working container
+        :param image_name: str, name of the image
+        :return: str, id of the image, None if the builder can't do that
+        """
+        return None
+
     def clean(self):
         """
         clean working container
@@ -71,6 +84,51 @@ class Builder:
         :return: True when the selected image is present, False otherwise
         """
 
+    def get_layer_size(self, layer_id, base_image_id):
+        """
+        :return: int, how many bytes the layer adds on top of the base image, None if unknown
+        """
+
+    def get_fs_changes(self):
+        """
+        find out whether the filesystem of the working container changed since the last
+        layer was committed (or the container was created), see Build.detect_fs_changes
+
+        :return: (bool, did it change, int, how many bytes were written), None if unknown
+        """
+        return None
+
+    def snapshot(self):
+        """
+        take a point-in-time snapshot of the working container which can be committed while
+        the playbook keeps modifying the container, see Build.pipelined_commits
+
+        :return: an opaque handle for commit_snapshot, None if a cheap snapshot can't be taken
+        """
+        return None
+
+    def commit_snapshot(self, snapshot, image_name=None):
+        """
+        create an image from a snapshot and dispose of the snapshot; it's invoked
+        in a background thread
+
+        Builders which can't take snapshots never get here, the working container
+        is committed then.
+
+        :param snapshot: the handle returned by snapshot()
+        :param image_name: str, name of the image
+        :return: str, id of the image
+        """
+        return self.commit(image_name, print_output=False)
+
+    @staticmethod
+    def remove_image(image_id):
+        """
+        remove the selected image
+
+        :return: True when the image is gone, False if it couldn't be removed
+        """
+
     def is_base_image_present(self):
         """
         :return: True when the base image is present, False otherwise
@@ -111,6 +169,15 @@ class Builder:
         invoke container tooling and thus verify they work well
         """
 
+    def get_environment_id(self):
+        """
+        identify the versions of the container tooling: checks which passed recently in the
+        same environment are not performed again
+
+        :return: str, None if the checks should always be performed
+        """
+        return None
+
     def check_container_creation(self):
         """
         check that containers can be created
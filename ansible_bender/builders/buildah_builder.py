@@ -1,11 +1,17 @@
+import copy
 import datetime
+import functools
 import json
 import logging
 import os
 import re
 import shlex
+import stat
 import subprocess
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional, List
 
@@ -17,6 +23,14 @@ from ansible_bender.utils import graceful_get, run_cmd, buildah_command_exists,
 
 logger = logging.getLogger(__name__)
 
+# print the first of the paths passed as arguments which exists
+PYTHON_PROBE_SCRIPT = 'for i in "$@"; do if [ -e "$i" ]; then echo "$i"; exit 0; fi; done; exit 3'
+# exit code of the script when none of the paths exists
+PYTHON_PROBE_NOT_FOUND = 3
+# intermediate layers never leave the local storage: compressing them is a waste of time
+# and the native format of buildah needs no conversion
+INTERMEDIATE_COMMIT_ARGS = ["--disable-compression", "--format", "oci"]
+
 
 def inspect_resource(resource_type, resource_id):
     try:
@@ -33,6 +47,133 @@ def inspect_resource(resource_type, resource_id):
     return metadata
 
 
+def list_buildah_images():
+    """
+    :return: list of dicts, images in the storage of buildah: id, names, ...
+    """
+    out = run_cmd(["buildah", "images", "--json"], return_output=True, log_output=False)
+    return json.loads(out or "[]") or []
+
+
+def is_image_id(image_reference):
+    """ does the reference look like an id of an image rather than its name? """
+    return bool(re.fullmatch(r"(sha256:)?[0-9a-f]{12,64}", image_reference))
+
+
+class ImageIndex:
+    """
+    ids and names of images in the storage of buildah: they are listed with a single call
+    and the index is updated as images are committed, pulled and removed so that lookups
+    don't need to inspect images one by one; references which are not in the index are
+    inspected by the callers
+    """
+
+    def __init__(self):
+        self._images = None  # id -> set of names
+        # commits of pipelined builds update the index from a worker thread
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """ list the images again on the next lookup """
+        with self._lock:
+            self._images = None
+
+    def _load(self):
+        if self._images is None:
+            self._images = {x["id"]: set(x.get("names") or []) for x in list_buildah_images()}
+        return self._images
+
+    def add(self, image_id, image_name=None):
+        with self._lock:
+            if self._images is None:
+                # it will be listed
+                return
+            names = self._images.setdefault(_strip_digest_algorithm(image_id), set())
+            if image_name:
+                names.add(image_name)
+
+    def tag(self, image_id, image_name):
+        """
+        record an image which was just committed as image_name: the name is moved from
+        the image which held it before
+        """
+        image_name = _normalize_image_name(image_name)
+        if not _has_domain(image_name):
+            # this is how buildah names images committed without a registry
+            image_name = "localhost/" + image_name
+        with self._lock:
+            if self._images is None:
+                return
+            for names in self._images.values():
+                names.discard(image_name)
+            self._images.setdefault(_strip_digest_algorithm(image_id), set()).add(image_name)
+
+    def remove(self, image_reference):
+        with self._lock:
+            if self._images is None:
+                return
+            image_id = self._lookup(image_reference)
+            if image_id:
+                del self._images[image_id]
+
+    def get_image_id(self, image_reference):
+        """
+        :param image_reference: str, id or name of the image
+        :return: str, id of the image, None if it's not in the index
+        """
+        with self._lock:
+            return self._lookup(image_reference)
+
+    def _lookup(self, image_reference):
+        images = self._load()
+        if is_image_id(image_reference):
+            prefix = _strip_digest_algorithm(image_reference)
+            ids = [x for x in images if x.startswith(prefix)]
+        else:
+            if "@" in image_reference:
+                # digests are resolved by buildah
+                return None
+            name = _normalize_image_name(image_reference)
+            ids = [image_id for image_id, names in images.items()
+                   if any(_does_name_match(x, name) for x in names)]
+        # ambiguous references are resolved by buildah
+        return ids[0] if len(ids) == 1 else None
+
+
+def _strip_digest_algorithm(image_id):
+    return image_id[len("sha256:"):] if image_id.startswith("sha256:") else image_id
+
+
+def _has_domain(image_name):
+    domain = image_name.split("/", 1)[0]
+    return "/" in image_name and ("." in domain or ":" in domain or domain == "localhost")
+
+
+def _normalize_image_name(image_name):
+    """ add the default tag """
+    if ":" not in image_name.rsplit("/", 1)[-1]:
+        image_name += ":latest"
+    return image_name
+
+
+def _does_name_match(full_name, image_name):
+    """
+    :param full_name: str, fully qualified name from the storage, e.g. docker.io/library/fedora:32
+    :param image_name: str, normalized name, short names match images from any registry
+                       just like buildah does it: fedora:32, library/fedora:32
+    """
+    if full_name == image_name:
+        return True
+    if _has_domain(image_name):
+        return False
+    repository = full_name.split("/", 1)[1] if _has_domain(full_name) else full_name
+    return repository == image_name or repository == "library/" + image_name
+
+
+# images of the build in progress, see BuildahBuilder
+image_index = ImageIndex()
+
+
 def get_buildah_image_id(container_image):
     metadata = inspect_resource("image", container_image)
     return graceful_get(metadata, "FromImageID")
@@ -52,6 +193,126 @@ def does_image_exist(container_image):
     run_cmd(cmd, print_output=False)
 
 
+def get_image_sizes(container_images):
+    """
+    :param container_images: list of str
+    :return: list of int, sizes of the images in bytes
+    """
+    out = run_cmd(["podman", "image", "inspect", "--format", "{{.Size}}"] + container_images,
+                  return_output=True, log_output=False)
+    return [int(x) for x in out.split()]
+
+
+def remove_buildah_image(container_image):
+    buildah("rmi", [container_image])
+
+
+def get_overlay_upper_dir(mount_point, mountinfo_path="/proc/self/mountinfo"):
+    """
+    :param mount_point: str, where an overlay filesystem is mounted
+    :return: str, path to its upper dir, None if there is no such overlay mount
+    """
+    with open(mountinfo_path) as fd:
+        for line in fd:
+            fields = line.split()
+            try:
+                separator = fields.index("-")
+            except ValueError:
+                continue
+            if fields[4] != mount_point or fields[separator + 1] != "overlay":
+                continue
+            for option in fields[separator + 3].split(","):
+                if option.startswith("upperdir="):
+                    return option[len("upperdir="):]
+    return None
+
+
+def scan_upper_dir(upper_dir):
+    """
+    state of the upper dir of an overlay: only files changed within the container are there
+
+    :param upper_dir: str
+    :return: dict, relative path -> (mode, size, mtime_ns, rdev, uid, gid, ctime_ns); ctime
+             changes also with chown, xattrs, ACLs and capabilities; directories are only
+             tracked by their presence, mode and owner, their mtime and ctime change with
+             every temporary file
+    """
+    state = {}
+    # scandir entries carry the name and the type, only a single lstat is done per entry
+    directories = [("", upper_dir)]
+    while directories:
+        prefix, directory = directories.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            relative_path = prefix + entry.name
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                state[relative_path] = (st.st_mode, 0, 0, 0, st.st_uid, st.st_gid, 0)
+                directories.append((relative_path + os.sep, entry.path))
+            else:
+                # whiteouts of removed files are character devices
+                state[relative_path] = (st.st_mode, st.st_size, st.st_mtime_ns, st.st_rdev,
+                                        st.st_uid, st.st_gid, st.st_ctime_ns)
+    return state
+
+
+def diff_upper_dir_states(before, after):
+    """
+    :param before: dict, see scan_upper_dir
+    :param after: dict, see scan_upper_dir
+    :return: (bool, did anything change, int, bytes written)
+    """
+    changed = [p for p, s in after.items() if before.get(p) != s]
+    removed = before.keys() - after.keys()
+    size = sum(after[p][1] for p in changed if stat.S_ISREG(after[p][0]))
+    return bool(changed or removed), size
+
+
+def copy_upper_dir(source, target):
+    """
+    copy the upper dir of an overlay into the (empty) upper dir of another one: with reflinks
+    the copy is cheap and later writes to the source don't leak into it, whiteouts and opaque
+    directories are preserved
+
+    :param source: str
+    :param target: str
+    """
+    run_cmd(["cp", "-a", "--reflink=always", "-T", source, target], log_stderr=False)
+
+
+@functools.lru_cache(maxsize=None)
+def get_buildah_version():
+    """
+    buildah doesn't change while ab is running, it's asked once per process
+
+    :return: tuple of int
+    """
+    out = run_cmd(["buildah", "version"], log_stderr=True, return_output=True, log_output=False)
+    version = re.findall(r"Version:\s*([\d\.]+)", out)[0].split(".")
+    logger.debug("buildah version = %s", version)
+    # buildah version = ['1', '11', '3']
+    try:
+        return tuple(map(int, version))
+    except (IndexError, ValueError) as ex:
+        logger.error("Unable to parse buildah's version: %s", ex)
+        return 0, 0, 0
+
+
+def get_podman_version():
+    """
+    :return: str, version of podman
+    """
+    out = run_cmd(["podman", "version", "--format", "{{.Client.Version}}"],
+                  log_stderr=True, return_output=True, log_output=False)
+    return out.strip()
+
+
 def podman_run_cmd(container_image, cmd, extra_args, log_stderr=True, return_output=False):
     """
     run provided command in selected container image using podman; raise exc when command fails
@@ -212,8 +473,22 @@ class BuildahBuilder(Builder):
         self.target_image = build.target_image
         self.ansible_host = build.build_container
         self.logs = []
+        # upper dir of the working container, "" when it can't be found
+        self._upper_dir = None
+        # state of the upper dir when the last layer was committed
+        self._fs_state = None
+        # state of the upper dir found by the last get_fs_changes
+        self._last_fs_scan = None
+        # the image the working container was created from
+        self._container_image = None
+        self._snapshot_count = 0
+        self._environment_id = None
+        # container name -> the configuration applied before the last commit
+        self._commit_configs = {}
         buildah_command_exists()
         podman_command_exists()
+        # a new build: the images are listed again once they are needed
+        image_index.invalidate()
         self.podman_run_args = []
         if self.build.podman_run_extra_args:
           self.podman_run_args = shlex.split(self.build.podman_run_extra_args)
@@ -225,14 +500,30 @@ class BuildahBuilder(Builder):
         """
         create a container where all the work happens
         """
-        create_buildah_container(
-            self.build.get_top_layer_id(), self.ansible_host,
-            build_volumes=self.build.build_volumes,
-            extra_from_args=self.build.buildah_from_extra_args,
-            debug=self.debug)
+        self._container_image = self.build.get_top_layer_id()
+        try:
+            create_buildah_container(
+                self._container_image, self.ansible_host,
+                build_volumes=self.build.build_volumes,
+                extra_from_args=self.build.buildah_from_extra_args,
+                debug=self.debug)
+        except subprocess.CalledProcessError:
+            # the layer was found in the index, but e.g. a concurrent prune removed it
+            image_index.invalidate()
+            if not self.is_image_present(self._container_image):
+                raise RuntimeError("layer %s was removed while the build was in progress, "
+                                   "please run the build again" % self._container_image)
+            raise
+        self._configure_container(self.ansible_host)
+        self._commit_configs.pop(self.ansible_host, None)
+        self._upper_dir = None
+        self._last_fs_scan = None
+        self._fs_state = self._scan_fs()
+
+    def _configure_container(self, container_name):
         # let's apply configuration before execing the playbook, except for user
         configure_buildah_container(
-            self.ansible_host, working_dir=self.build.metadata.working_dir,
+            container_name, working_dir=self.build.metadata.working_dir,
             user=self.build.build_user,
             env_vars=self.build.metadata.env_vars,
             ports=self.build.metadata.ports,
@@ -270,6 +561,12 @@ class BuildahBuilder(Builder):
         :param final_image: is this is the final layer?
         :return:
         """
+        image_id = self._commit_container(self.ansible_host, image_name, print_output=print_output,
+                                          final_image=final_image)
+        self._update_fs_state()
+        return image_id
+
+    def _commit_container(self, container_name, image_name, print_output=True, final_image=False):
         if final_image:
             user = self.build.metadata.user
         else:
@@ -277,54 +574,188 @@ class BuildahBuilder(Builder):
 
         if (self.build.metadata.user or self.build.metadata.cmd or
             self.build.metadata.entrypoint or self.build.metadata.volumes):
-            # change user if needed
-            configure_buildah_container(
-                self.ansible_host,
-                user=user,
-                cmd=self.build.metadata.cmd,
-                entrypoint=self.build.metadata.entrypoint,
-                volumes=self.build.metadata.volumes,
-            )
+            config = {
+                "user": user,
+                "cmd": self.build.metadata.cmd,
+                "entrypoint": self.build.metadata.entrypoint,
+                "volumes": self.build.metadata.volumes,
+            }
+            # the configuration stays with the container, it's applied again only when it changes
+            if self._commit_configs.get(container_name) != config:
+                # change user if needed
+                configure_buildah_container(container_name, **config)
+                self._commit_configs[container_name] = copy.deepcopy(config)
+
+        start = time.monotonic()
+        image_id = self._run_commit(container_name, image_name, print_output=print_output,
+                                    final_image=final_image)
+        seconds = time.monotonic() - start
+        logger.info("committed %s in %.2f s", image_name or image_id, seconds)
+        self.commit_timings.append({"image": image_name or image_id, "seconds": seconds,
+                                    "final": final_image})
+        return image_id
 
+    def _run_commit(self, container_name, image_name, print_output=True, final_image=False):
+        if final_image:
+            extra_args = ["--squash"] if self.build.squash else []
+        else:
+            extra_args = INTERMEDIATE_COMMIT_ARGS
+        fd, name = tempfile.mkstemp()
+        os.close(fd)
+        args = extra_args + ["--iidfile", name, container_name]
         if image_name:
-            args = [self.ansible_host, image_name]
-            if final_image and self.build.squash:
-                args.insert(0, "--squash")
-            buildah("commit", args, print_output=print_output, debug=self.debug)
-            return self.get_image_id(image_name)
+            # the id is read from the file: the index may still map the name to the image
+            # which held it before
+            args.append(image_name)
         else:
-            fd, name = tempfile.mkstemp()
-            os.close(fd)
-            args = ["-q", "--iidfile", name, self.ansible_host]
+            args.insert(0, "-q")
             # buildah 1.7.3 dropped the requirement for image name, let's support both
             # https://github.com/ansible-community/ansible-bender/issues/166
             if self.get_buildah_version() < (1, 7, 3):
                 args += ["{}-{}".format(
-                    self.ansible_host,
+                    container_name,
                     datetime.datetime.now().strftime(TIMESTAMP_FORMAT_TOGETHER)
                 )]
-            if final_image and self.build.squash:
-                args.insert(0, "--squash")
-            try:
-                buildah("commit", args, print_output=print_output, debug=self.debug)
-                image_id = Path(name).read_text()
-                logger.debug("layer id = %s", image_id)
-                return image_id
-            finally:
-                os.unlink(name)
+        try:
+            buildah("commit", args, print_output=print_output, debug=self.debug)
+            image_id = Path(name).read_text()
+        finally:
+            os.unlink(name)
+        logger.debug("layer id = %s", image_id)
+        if image_name:
+            image_index.tag(image_id, image_name)
+            # named images are identified the same way as in get_image_id
+            return _strip_digest_algorithm(image_id)
+        image_index.add(image_id)
+        return image_id
+
+    def commit_metadata(self, layer_id, image_name):
+        """
+        create a container from the layer, configure it and commit it: its diff is empty
+
+        :return: str, id of the image
+        """
+        container_name = "%s-final" % self.ansible_host
+        create_buildah_container(layer_id, container_name, debug=self.debug)
+        try:
+            self._configure_container(container_name)
+            return self._commit_container(container_name, image_name, final_image=True)
+        finally:
+            buildah("rm", [container_name], debug=self.debug)
+            self._commit_configs.pop(container_name, None)
 
     def clean(self):
         """
         clean working container
         """
         buildah("rm", [self.ansible_host], debug=self.debug)
+        self._commit_configs.pop(self.ansible_host, None)
+        self._upper_dir = None
+        self._fs_state = None
+        self._last_fs_scan = None
+
+    def _get_upper_dir(self):
+        if self._upper_dir is None:
+            self._upper_dir = ""
+            try:
+                mount_point = buildah_with_output("mount", [self.ansible_host]).strip()
+                self._upper_dir = get_overlay_upper_dir(mount_point) or ""
+            except (subprocess.CalledProcessError, OSError) as ex:
+                logger.debug("unable to mount the working container: %s", ex)
+            if not self._upper_dir:
+                logger.info("the working container is not an overlay mounted in this namespace, "
+                            "changes of its filesystem can't be detected")
+        return self._upper_dir or None
+
+    def _scan_fs(self):
+        if not self.build.detect_fs_changes:
+            return None
+        upper_dir = self._get_upper_dir()
+        if not upper_dir:
+            return None
+        return scan_upper_dir(upper_dir)
+
+    def _update_fs_state(self):
+        """
+        the layer was just committed: its content is the new baseline; a task is inspected
+        right before its layer is committed so the scan done then is reused instead of walking
+        the upper dir again
+        """
+        state, self._last_fs_scan = self._last_fs_scan, None
+        self._fs_state = state if state is not None else self._scan_fs()
+
+    def get_fs_changes(self):
+        """
+        :return: (bool, int) or None, see Builder.get_fs_changes
+        """
+        if self._fs_state is None:
+            return None
+        state = self._scan_fs()
+        if state is None:
+            return None
+        self._last_fs_scan = state
+        return diff_upper_dir_states(self._fs_state, state)
+
+    def snapshot(self):
+        """
+        create a container from the same image as the working container and reflink-copy
+        the upper dir of the working container into it
+
+        :return: str, name of the snapshot container, None if it can't be created
+        """
+        upper_dir = self._get_upper_dir()
+        if not upper_dir:
+            return None
+        self._snapshot_count += 1
+        snapshot = "%s-snapshot-%d" % (self.ansible_host, self._snapshot_count)
+        try:
+            create_buildah_container(self._container_image, snapshot,
+                                     extra_from_args=self.build.buildah_from_extra_args,
+                                     debug=self.debug)
+        except subprocess.CalledProcessError as ex:
+            logger.info("unable to create a snapshot container: %s", ex)
+            return None
+        try:
+            mount_point = buildah_with_output("mount", [snapshot]).strip()
+            snapshot_upper_dir = get_overlay_upper_dir(mount_point)
+            # the upper dir must not be modified while the overlay is mounted
+            buildah("umount", [snapshot], debug=self.debug)
+            if not snapshot_upper_dir:
+                raise RuntimeError("the snapshot container is not an overlay")
+            copy_upper_dir(upper_dir, snapshot_upper_dir)
+        except (subprocess.CalledProcessError, OSError, RuntimeError) as ex:
+            logger.info("unable to snapshot the working container, the layer is committed "
+                        "right away: %s", ex)
+            buildah("rm", [snapshot], debug=self.debug)
+            return None
+        self._update_fs_state()
+        return snapshot
+
+    def commit_snapshot(self, snapshot, image_name=None):
+        """
+        commit the snapshot container and remove it
+
+        :param snapshot: str, name of the snapshot container
+        :param image_name: str, name of the image
+        :return: str, id of the image
+        """
+        try:
+            self._configure_container(snapshot)
+            return self._commit_container(snapshot, image_name, print_output=False)
+        finally:
+            buildah("rm", [snapshot], debug=self.debug)
+            self._commit_configs.pop(snapshot, None)
 
     def get_image_id(self, image_name):
         """ return image_id for provided image """
+        image_id = image_index.get_image_id(image_name)
+        if image_id:
+            return image_id
         image_id = get_buildah_image_id(image_name)
         if not image_id:
             raise RuntimeError("We haven't got any image ID: the image is not present "
                                "or buildah/podman is malfunctioning.")
+        image_index.add(image_id, image_name)
         return image_id
 
     def is_image_present(self, image_reference):
@@ -333,6 +764,9 @@ class BuildahBuilder(Builder):
         """
         if not image_reference:
             return False
+        if image_index.get_image_id(image_reference):
+            return True
+        # e.g. created by a parallel build
         try:
             does_image_exist(image_reference)
         except subprocess.CalledProcessError:
@@ -340,12 +774,46 @@ class BuildahBuilder(Builder):
         else:
             return True
 
+    def get_layer_size(self, layer_id, base_image_id):
+        """
+        :return: int, how many bytes the layer adds on top of the base image, None if unknown
+        """
+        try:
+            layer_size, base_size = get_image_sizes([layer_id, base_image_id])
+        except (subprocess.CalledProcessError, ValueError) as ex:
+            logger.info("unable to get size of layer %s: %s", layer_id, ex)
+            return None
+        return max(layer_size - base_size, 0)
+
+    @staticmethod
+    def remove_image(image_id):
+        """
+        remove the selected image
+
+        :return: True when the image is gone, False if it couldn't be removed
+        """
+        try:
+            remove_buildah_image(image_id)
+        except subprocess.CalledProcessError:
+            # the image could have been removed already
+            try:
+                does_image_exist(image_id)
+            except subprocess.CalledProcessError:
+                image_index.remove(image_id)
+                return True
+            # e.g. there are containers or images which use the image
+            logger.info("image %s can't be removed", image_id)
+            return False
+        image_index.remove(image_id)
+        return True
+
     def pull(self):
         """
         pull base image
         """
         logger.info("pulling base image: %s", self.build.base_image)
         pull_buildah_image(self.build.base_image)
+        image_index.invalidate()
 
     def push(self, build, target, force=False):
         """
@@ -363,10 +831,32 @@ class BuildahBuilder(Builder):
 
     def find_python_interpreter(self):
         """
-        find python executable in the base image
+        find python executable in the base image: all the paths are probed within
+        a single container
 
         :return: str, path to python interpreter
         """
+        cmd = ["sh", "-c", PYTHON_PROBE_SCRIPT, "sh"] + list(self.python_interpr_prio)
+        interpreter = None
+        try:
+            out = podman_run_cmd(self.build.base_image, cmd, self.podman_run_args,
+                                 log_stderr=False, return_output=True)
+        except subprocess.CalledProcessError as ex:
+            if ex.returncode != PYTHON_PROBE_NOT_FOUND:
+                # e.g. there is no shell in the base image
+                logger.info("unable to probe python interpreters at once, trying them one by one: %s", ex)
+                interpreter = self._find_python_interpreter_one_by_one()
+        else:
+            interpreter = out.strip()
+        if interpreter:
+            logger.info("using python interpreter %s", interpreter)
+            return interpreter
+        logger.error("couldn't locate python interpreter, tried these paths: %s", self.python_interpr_prio)
+        raise RuntimeError(f"no python interpreter was found in the base image \"{self.build.base_image}\""
+                           ", you can specify the path via CLI option --python-interpreter")
+
+    def _find_python_interpreter_one_by_one(self):
+        """ :return: str, path to python interpreter, None if there is none """
         for i in self.python_interpr_prio:
             cmd = ["ls", i]
             try:
@@ -375,11 +865,8 @@ class BuildahBuilder(Builder):
                 logger.info("python interpreter %s does not exist", i)
                 continue
             else:
-                logger.info("using python interpreter %s", i)
                 return i
-        logger.error("couldn't locate python interpreter, tried these paths: %s", self.python_interpr_prio)
-        raise RuntimeError(f"no python interpreter was found in the base image \"{self.build.base_image}\""
-                           ", you can specify the path via CLI option --python-interpreter")
+        return None
 
     def get_logs(self):
         """
@@ -392,26 +879,30 @@ class BuildahBuilder(Builder):
         """
         invoke container tooling and thus verify they work well
         """
-        # doing podman info would be super-handy, but it will immensely clutter the output
-        logger.debug("checking that podman command works")
-        run_cmd(["podman", "version"], log_stderr=True, log_output=True)
-        logger.debug("checking that buildah command works")
-        run_cmd(["buildah", "version"], log_stderr=True, log_output=True)
+        # the commands are invoked to find out their versions
+        self.get_environment_id()
         logger.debug("Checking container creation using buildah")
         buildah_run_cmd(
             self.build.base_image, self.ansible_host, ["true"],
             log_stderr=True, extra_from_args=self.build.buildah_from_extra_args, extra_run_args=self.buildah_run_args)
 
+    def get_environment_id(self):
+        """
+        :return: str, versions of buildah and podman
+        """
+        if self._environment_id is None:
+            # doing podman info would be super-handy, but it will immensely clutter the output
+            logger.debug("checking that buildah and podman commands work")
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                buildah_version = executor.submit(self.get_buildah_version)
+                podman_version = executor.submit(get_podman_version)
+                self._environment_id = "buildah %s, podman %s" % (
+                    ".".join(map(str, buildah_version.result())), podman_version.result())
+            logger.debug("environment: %s", self._environment_id)
+        return self._environment_id
+
     def get_buildah_version(self):
-        out = run_cmd(["buildah", "version"], log_stderr=True, return_output=True, log_output=False)
-        version = re.findall(r"Version:\s*([\d\.]+)", out)[0].split(".")
-        logger.debug("buildah version = %s", version)
-        # buildah version = ['1', '11', '3']
-        try:
-            return tuple(map(int, version))
-        except (IndexError, ValueError) as ex:
-            logger.error("Unable to parse buildah's version: %s", ex)
-            return 0, 0, 0
+        return get_buildah_version()
 
     def check_container_creation(self):
         """
@@ -2,20 +2,390 @@ import hashlib
 import json
 import logging
 import os
+import time
 import traceback
-import pathlib
 
-from ansible.executor.task_result import TaskResult
+import jinja2
+import jinja2.meta
+import jinja2.nodes
+from ansible import constants as C
+from ansible.errors import AnsibleError
+from ansible.parsing.dataloader import DataLoader
 from ansible.playbook.task import Task
 from ansible.plugins.callback import CallbackBase
+from ansible.template import Templar
 
 from ansible_bender.api import Application
-from ansible_bender.builders.base import BuildState
-from ansible_bender.constants import NO_CACHE_TAG
+from ansible_bender.db import Database
+from ansible_bender.fingerprint import Fingerprinter, FINGERPRINT_CACHE_FILE_NAME
+from ansible_bender.ipc import BuildServiceClient
 
-FILE_ACTIONS = ["file", "copy", "synchronize", "unarchive", "template"]
 logger = logging.getLogger("ansible_bender")
 
+# action -> directory within the search path where ansible looks for the source
+SOURCE_DIRS = {
+    "template": "templates",
+    "win_template": "templates",
+}
+INCLUDE_TASKS_ACTIONS = ("include_tasks", "import_tasks", "include")
+INCLUDE_ROLE_ACTIONS = ("include_role", "import_role")
+# task keywords which are jinja expressions without the curly braces
+EXPRESSION_KEYWORDS = ("when", "changed_when", "failed_when", "until")
+# variables which differ with every run regardless of the playbook: the host is a new
+# container every time and omit is a random placeholder
+VOLATILE_VARIABLES = {
+    "ansible_host", "inventory_hostname", "inventory_hostname_short", "hostvars", "groups",
+    "group_names", "ansible_play_hosts", "ansible_play_hosts_all", "ansible_play_batch",
+    "play_hosts", "inventory_dir", "inventory_file", "omit",
+}
+# variables which the template action defines for the template it renders
+TEMPLATE_VARIABLES = {
+    "ansible_managed", "template_host", "template_path", "template_fullpath", "template_destpath",
+    "template_uid", "template_mtime", "template_run_date",
+}
+# lookup plugins which render a template from the templates directory
+TEMPLATE_LOOKUPS = ("template", "ansible.builtin.template")
+# facts which differ with every run, with or without the ansible_ prefix
+VOLATILE_FACTS = {"date_time", "uptime_seconds", "memfree_mb", "memory_mb"}
+# keys of results of modules, e.g. registered variables, which differ with every run
+VOLATILE_RESULT_KEYS = {"start", "end", "delta"}
+
+
+def _resolve(task, dirname, source):
+    """
+    find the source the same way ansible does, see ActionBase._find_needle
+
+    :return: str, path, or None if ansible wouldn't find it either
+    """
+    loader = task.get_loader() or DataLoader()
+    try:
+        return loader.path_dwim_relative_stack(task.get_search_path(), dirname, source)
+    except AnsibleError:
+        return None
+
+
+def _find_role(task, name):
+    """ :return: str, path to the role directory, None if it can't be found """
+    # roles are looked up next to the playbook and the role which includes them first
+    dirs = []
+    for path in task.get_search_path():
+        dirs += [os.path.join(path, "roles"), path]
+    dirs += C.DEFAULT_ROLES_PATH
+    for d in dirs:
+        role_path = os.path.join(d, name)
+        if os.path.isdir(role_path):
+            return role_path
+    return None
+
+
+def _iter_strings(data):
+    if isinstance(data, str):
+        yield data
+    elif isinstance(data, dict):
+        for value in data.values():
+            yield from _iter_strings(value)
+    elif isinstance(data, (list, tuple)):
+        for value in data:
+            yield from _iter_strings(value)
+
+
+def _get_variable_path(node):
+    """
+    :param node: jinja2.nodes.Node
+    :return: list of str, e.g. ["ansible_facts", "os_family"] for ansible_facts['os_family'],
+             None if the node is not a variable or its attribute
+    """
+    if isinstance(node, jinja2.nodes.Name):
+        return [node.name] if node.ctx == "load" else None
+    if isinstance(node, jinja2.nodes.Getattr):
+        key = node.attr
+    elif isinstance(node, jinja2.nodes.Getitem) and isinstance(node.arg, jinja2.nodes.Const):
+        key = node.arg.value
+    else:
+        return None
+    path = _get_variable_path(node.node)
+    if path is None:
+        return None
+    if not isinstance(key, (str, int)) or "." in str(key):
+        # the dotted notation can't express it, the parent stands for it
+        return path
+    return path + [str(key)]
+
+
+def _iter_variable_paths(node):
+    path = _get_variable_path(node)
+    if path is not None:
+        yield path
+        return
+    for child in node.iter_child_nodes():
+        if isinstance(node, jinja2.nodes.Call) and child is node.node and isinstance(child, jinja2.nodes.Name):
+            # a global function, e.g. lookup or range
+            continue
+        yield from _iter_variable_paths(child)
+
+
+def _is_volatile(path):
+    name = path[0]
+    if name in VOLATILE_VARIABLES:
+        return True
+    if name.startswith("ansible_") and name[len("ansible_"):] in VOLATILE_FACTS:
+        return True
+    return name == "ansible_facts" and len(path) > 1 and path[1] in VOLATILE_FACTS
+
+
+def _parse(template):
+    """ :return: jinja2.nodes.Template, None if the template is not valid """
+    try:
+        return jinja2.Environment().parse(template)
+    except jinja2.TemplateSyntaxError:
+        # ansible will complain, not our business
+        return None
+
+
+def _read_template(path):
+    """ :return: str, content of the template file, None if it can't be read """
+    try:
+        with open(path, encoding="utf-8") as fd:
+            return fd.read()
+    except (OSError, UnicodeDecodeError) as ex:
+        logger.debug("unable to read template %s: %s", path, ex)
+        return None
+
+
+def _iter_task_templates(ds):
+    """ strings within the task which ansible templates """
+    yield from _iter_strings(ds)
+    for keyword in EXPRESSION_KEYWORDS:
+        expressions = ds.get(keyword) if isinstance(ds, dict) else None
+        if isinstance(expressions, str):
+            expressions = [expressions]
+        if isinstance(expressions, list):
+            yield from ("{{ %s }}" % e for e in expressions if isinstance(e, str))
+
+
+def _iter_template_lookups(ast):
+    """ :return: names of templates rendered via lookup('template', ...), None if not constant """
+    for call in ast.find_all(jinja2.nodes.Call):
+        if not (isinstance(call.node, jinja2.nodes.Name) and call.node.name in ("lookup", "query", "q")):
+            continue
+        if not (call.args and isinstance(call.args[0], jinja2.nodes.Const)
+                and call.args[0].value in TEMPLATE_LOOKUPS):
+            continue
+        for arg in call.args[1:]:
+            is_name = isinstance(arg, jinja2.nodes.Const) and isinstance(arg.value, str)
+            yield arg.value if is_name else None
+
+
+def get_referenced_variables(ds, templates=()):
+    """
+    variables used in templates within the task: when an attribute or an item of a variable
+    is used, e.g. ansible_facts['os_family'] or result.rc, only the attribute is referenced
+
+    :param ds: dict, data structure of the task
+    :param templates: iterable of str, paths to template files rendered by the task,
+                      see get_task_templates
+    :return: set of str, dotted paths: ansible_facts.os_family, result.rc, package
+    """
+    sources = [(t, set()) for t in _iter_task_templates(ds)]
+    # the template action defines some variables for the template it renders
+    sources += [(_read_template(path) or "", TEMPLATE_VARIABLES) for path in templates]
+    paths = set()
+    for template, defined in sources:
+        if "{" not in template:
+            continue
+        ast = _parse(template)
+        if ast is None:
+            continue
+        undeclared = jinja2.meta.find_undeclared_variables(ast) - defined
+        for path in _iter_variable_paths(ast):
+            # e.g. loop variables of a for loop within the template
+            if path[0] in undeclared and not _is_volatile(path):
+                paths.add(tuple(path))
+    # the whole variable covers its attributes
+    return {".".join(p) for p in paths if not any(p[:i] in paths for i in range(1, len(p)))}
+
+
+def _strip_volatile(value):
+    """ drop facts and keys of results of modules which differ with every run """
+    if isinstance(value, dict):
+        volatile = {k for k in value if isinstance(k, str) and (
+            k in VOLATILE_FACTS or k[len("ansible_"):] in VOLATILE_FACTS
+            or ("changed" in value and k in VOLATILE_RESULT_KEYS))}
+        return {k: _strip_volatile(v) for k, v in value.items() if k not in volatile}
+    if isinstance(value, (list, tuple)):
+        return [_strip_volatile(x) for x in value]
+    return value
+
+
+def _get_value(templar, variables, path):
+    value = variables[path[0]]
+    for key in path[1:]:
+        if isinstance(value, str):
+            # a variable defined by a template, e.g. "{{ other_dict }}"
+            value = templar.template(value)
+        if isinstance(value, dict) and key in value:
+            value = value[key]
+        elif isinstance(value, (list, tuple)) and key.isdigit() and int(key) < len(value):
+            value = value[int(key)]
+        else:
+            # e.g. a method of the value: it's used as a whole
+            break
+    return _strip_volatile(templar.template(value))
+
+
+def resolve_variables(names, variables, loader=None):
+    """
+    template values of the variables, so that variables defined using other variables
+    are resolved as well; only the referenced attributes are templated
+
+    :param names: iterable of str, see get_referenced_variables
+    :param variables: dict, all variables available to the task
+    :return: dict, name -> value, only defined variables are present
+    """
+    templar = Templar(loader=loader or DataLoader(), variables=variables)
+    response = {}
+    for name in sorted(names):
+        path = name.split(".")
+        if path[0] not in variables:
+            continue
+        try:
+            response[name] = _get_value(templar, variables, path)
+        except Exception as ex:
+            logger.debug("unable to template variable %s: %s", name, ex)
+            response[name] = _strip_volatile(variables[path[0]])
+    return response
+
+
+def get_unresolved_variables(names, variables):
+    """
+    referenced variables whose values are not known yet, e.g. when the playbook is planned:
+    facts are gathered and results of tasks are registered only once the playbook runs
+
+    :param names: iterable of str, see get_referenced_variables
+    :param variables: dict, all variables available to the task
+    :return: set of str
+    """
+    unresolved = set()
+    for name in names:
+        path = name.split(".")
+        if path[0] == "ansible_facts" or path[0] not in variables:
+            unresolved.add(name)
+            continue
+        value = variables[path[0]]
+        for key in path[1:]:
+            if not isinstance(value, dict):
+                # a template or e.g. a method of the value, the value is known
+                break
+            if key not in value:
+                unresolved.add(name)
+                break
+            value = value[key]
+    return unresolved
+
+
+def get_task_sources(task: Task):
+    """
+    paths to files which affect the outcome of the task besides its own content:
+
+     * src of file actions, e.g. copy or template
+     * task files included via include_tasks
+     * roles included via include_role, as a whole
+     * defaults and vars of the role which the task belongs to
+
+    :return: list of str, sorted
+    """
+    action = (task.action or "").rsplit(".", 1)[-1]
+    args = task.args or {}
+    sources = set()
+
+    src = args.get("src")
+    if isinstance(src, str) and src:
+        path = _resolve(task, SOURCE_DIRS.get(action, "files"), src)
+        if path:
+            sources.add(path)
+
+    if action in INCLUDE_TASKS_ACTIONS:
+        file_name = args.get("file") or args.get("_raw_params")
+        if isinstance(file_name, str) and file_name:
+            path = _resolve(task, "tasks", file_name)
+            if path:
+                sources.add(path)
+
+    if action in INCLUDE_ROLE_ACTIONS:
+        name = args.get("name")
+        if isinstance(name, str) and name:
+            path = _find_role(task, name)
+            if path:
+                sources.add(path)
+
+    role = getattr(task, "_role", None)
+    role_path = getattr(role, "_role_path", None)
+    if role_path:
+        for d in ("defaults", "vars"):
+            path = os.path.join(role_path, d)
+            if os.path.isdir(path):
+                sources.add(path)
+
+    return sorted(sources)
+
+
+def _render_template_name(name, templar):
+    """ :return: str, name of the template, None if it's given by a variable which is not known """
+    if "{" not in name:
+        return name
+    if templar is None:
+        return None
+    try:
+        name = templar.template(name)
+    except Exception as ex:
+        logger.debug("unable to template %s: %s", name, ex)
+        return None
+    return name if isinstance(name, str) and "{" not in name else None
+
+
+def get_task_templates(task: Task, templar=None):
+    """
+    paths to jinja templates rendered by the task: src of template actions, templates rendered
+    via lookup('template', ...) and templates which they include, import or extend
+
+    :param task: instance of Task
+    :param templar: instance of Templar, renders names of templates given by variables
+    :return: list of str, sorted; None if the task renders a template which can't be known
+             before the task runs, e.g. lookup('template', item)
+    """
+    action = (task.action or "").rsplit(".", 1)[-1]
+    args = task.args or {}
+    names = []
+    if action in SOURCE_DIRS and isinstance(args.get("src"), str):
+        names.append(args["src"])
+    for template in _iter_task_templates(task.get_ds() or task.dump_attrs()):
+        ast = _parse(template) if "{" in template else None
+        if ast is not None:
+            names += _iter_template_lookups(ast)
+
+    paths = set()
+    queue = [(name, None) for name in names]
+    while queue:
+        name, including_path = queue.pop()
+        name = None if name is None else _render_template_name(name, templar)
+        if name is None:
+            return None
+        path = None
+        if including_path:
+            # ansible looks next to the template first
+            path = os.path.join(os.path.dirname(including_path), name)
+        if not path or not os.path.isfile(path):
+            path = _resolve(task, "templates", name)
+        if not path or path in paths:
+            # ansible won't find it either
+            continue
+        paths.add(path)
+        content = _read_template(path)
+        ast = _parse(content) if content else None
+        if ast is not None:
+            queue += [(n, path) for n in jinja2.meta.find_referenced_templates(ast)]
+    return sorted(paths)
+
 
 class CallbackModule(CallbackBase):
     CALLBACK_VERSION = 2.0
@@ -23,58 +393,98 @@ class CallbackModule(CallbackBase):
     CALLBACK_NAME = 'a_container_image_snapshoter'
     CALLBACK_NEEDS_WHITELIST = True
 
+    def __init__(self, *args, fingerprinter=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the parent ab process makes the decisions, if it's able to
+        self._client = BuildServiceClient.from_environment()
+        # task uuid -> content, computed once per task
+        self._contents = {}
+        # task uuid -> identity, see get_task_identity
+        self._identities = {}
+        # task uuid -> when ansible started to execute the task
+        self._start_times = {}
+        self._fingerprinter = fingerprinter
+        self._play = None
+
     def _get_app_and_build(self):
         build_id = os.environ["AB_BUILD_ID"]
         db_path = os.environ["AB_DB_PATH"]
         app = Application(init_logging=False, db_path=db_path)
-        build = app.get_build(build_id)
+        # only this build writes the record, no need to wait for the lock
+        build = app.get_build(build_id, snapshot=True)
         app.set_logging(debug=build.debug, verbose=build.verbose)
         return app, build
 
+    def _get_content(self, task: Task):
+        content = self._contents.get(task._uuid)
+        if content is None:
+            content = self._contents[task._uuid] = self.get_task_content(task)
+        return content
+
+    def _get_identity(self, task: Task):
+        identity = self._identities.get(task._uuid)
+        if identity is None:
+            identity = self._identities[task._uuid] = self.get_task_identity(task)
+        return identity
+
+    def _display_message(self, message):
+        if message:
+            self._display.display(message)
+
     def _snapshot(self, task_result):
         """
         snapshot the target container
 
         :param task_result: instance of TaskResult
         """
-        if task_result._task.action in ["setup", "gather_facts"]:
+        task = task_result._task
+        if task.action in ["setup", "gather_facts"]:
             # we ignore setup
             return
-        if task_result.is_failed() or task_result._result.get("rc", 0) > 0:
-            return
-        a, build = self._get_app_and_build()
-        if build.is_failed():
-            return
-        if "stop-layering" in getattr(task_result._task, "tags", []):
-            build.stop_layering()
-            a.db.record_build(build)
-            self._display.display("detected tag 'stop-layering', tasks won't be cached nor layered any more")
-            return
-        if not build.is_layering_on():
-            return
-        content = self.get_task_content(task_result._task)
-        if task_result.is_skipped() or getattr(task_result, "_result", {}).get("skip_reason", False):
-            a.record_progress(None, content, None, build_id=build.build_id)
-            return
-        # # alternatively, we can guess it's a file action and do getattr(task, "src")
-        # # most of the time ansible says changed=True even when the file is the same
-        if task_result._task.action in FILE_ACTIONS:
-            if not task_result.is_changed():
-                status = a.maybe_load_from_cache(content, build_id=build.build_id)
-                if status:
-                    self._display.display("loaded from cache: '%s'" % status)
-                    return
-        image_name = a.cache_task_result(content, build)
-        if image_name:
-            self._display.display("caching the task result in an image '%s'" % image_name)
+        result = getattr(task_result, "_result", {})
+        start_time = self._start_times.get(task._uuid)
+        kwargs = {
+            "content": self._get_content(task),
+            "identity": self._get_identity(task),
+            "tags": list(getattr(task, "tags", [])),
+            "action": task.action,
+            "failed": task_result.is_failed() or result.get("rc", 0) > 0,
+            "skipped": task_result.is_skipped() or bool(result.get("skip_reason", False)),
+            "changed": task_result.is_changed(),
+            "duration": time.monotonic() - start_time if start_time is not None else None,
+        }
+        if self._client:
+            message = self._client.call("task_finished", **kwargs)["message"]
+        else:
+            a, build = self._get_app_and_build()
+            message = a.task_finished(build, **kwargs)
+        self._display_message(message)
 
     @staticmethod
-    def get_task_content(task: Task):
-        sha512 = hashlib.sha512()
+    def _get_task_data(task: Task):
         serialized_data = task.get_ds()
         if not serialized_data:
             # ansible 2.8
             serialized_data = task.dump_attrs()
+        return serialized_data
+
+    def get_task_identity(self, task: Task):
+        """
+        digest of the task as it's written in the playbook: unlike the content, it's the same
+        when the playbook is planned and when it runs, whatever the values of variables are;
+        identical tasks are told apart by their position in the playbook
+
+        :return: str, None if ansible doesn't provide the task
+        """
+        serialized_data = self._get_task_data(task)
+        if not serialized_data:
+            return None
+        c = json.dumps(serialized_data, sort_keys=True, default=str)
+        return hashlib.sha512(c.encode("utf-8")).hexdigest()
+
+    def get_task_content(self, task: Task):
+        sha512 = hashlib.sha512()
+        serialized_data = self._get_task_data(task)
         if not serialized_data:
             logger.error("unable to obtain task content from ansible: caching will not work")
             return
@@ -83,48 +493,94 @@ class CallbackModule(CallbackBase):
         logger.debug("content = %s", c)
         sha512.update(c.encode("utf-8"))
 
-        # If task is a file action, cache the src.
-        #
-        # Take the file stats of the src (if directory, get the stats
-        # of every file within) and concatinate it with the task config
-        # (assigned under serialized_data)
-        #
-        # The idea is that, if a file is changed, so will its modification time,
-        # which will force the layer to be reloaded. Otherwise, load from cache.
-        #
-        # Note: serialized_data was grabbed above.
-        task_config = task.dump_attrs()
-        if( ('args' in task_config) and ('src' in task_config['args']) ):
-            src = task_config['args']['src']
-            src_path = os.path.join(task.get_search_path()[0], "files", src)
-
-            if(not(os.path.exists(src_path))):
-                src_path = os.path.join(task.get_search_path()[0], src)
-
-            if os.path.isdir(src_path):
-                dir_hash = CallbackModule.get_dir_fingerprint(src_path)
-                sha512.update(dir_hash.encode("utf-8"))
-            elif os.path.isfile(src_path):
-                the_file = pathlib.Path(src_path)
-                date_modified = str(the_file.stat().st_mtime)
-                sha512.update(date_modified.encode("utf-8"))
+        # Templates rendered by the task are part of it: both their files and their variables.
+        templates = self._get_task_templates(task)
+        if templates is None:
+            logger.info("task %s renders a template known only once it runs: it will not be cached",
+                        task.get_name())
+            return
+
+        # Values of variables used by the task are part of it: a change of a variable
+        # invalidates only tasks which use it.
+        variables = self._get_task_variables(task, serialized_data, templates)
+        if variables:
+            v = json.dumps(variables, sort_keys=True, default=str)
+            logger.debug("variables = %s", v)
+            sha512.update(v.encode("utf-8"))
+
+        # Files used by the task are part of it: when they change, the task is not loaded
+        # from cache. The fingerprint is a digest of names, modes and content of the files
+        # so that it doesn't change with a fresh checkout.
+        fingerprinter = self._get_fingerprinter()
+        for path in sorted(set(get_task_sources(task)) | set(templates)):
+            fingerprint = fingerprinter.fingerprint(path)
+            logger.debug("source %s, fingerprint = %s", path, fingerprint)
+            if fingerprint:
+                sha512.update(fingerprint.encode("utf-8"))
 
         return sha512.hexdigest()
 
-    @staticmethod
-    def get_dir_fingerprint(directory):
-        sha512 = hashlib.sha512()
-        for root, dirs, files in os.walk(directory):
-            for filename in files:
-                the_file = pathlib.Path(os.path.join(directory, root, filename))
+    def _get_all_variables(self, task: Task):
+        """ :return: dict, all variables available to the task, None if they can't be obtained """
+        if self._play is None:
+            return None
+        variable_manager = self._play.get_variable_manager()
+        if variable_manager is None:
+            return None
+        host = None
+        inventory = getattr(variable_manager, "_inventory", None)
+        if inventory is not None:
+            hosts = inventory.get_hosts(self._play.hosts)
+            # ab builds a single container
+            host = hosts[0] if hosts else None
+        return variable_manager.get_vars(play=self._play, host=host, task=task)
 
-                if not the_file.exists():
-                    continue
+    def _get_task_templates(self, task: Task):
+        """ :return: list of str, see get_task_templates """
+        templates = get_task_templates(task)
+        if templates is None:
+            # names of templates can be given by variables
+            variables = self._get_all_variables(task)
+            if variables is not None:
+                templar = Templar(loader=task.get_loader() or DataLoader(), variables=variables)
+                templates = get_task_templates(task, templar)
+        return templates
 
-                date_modified = str(the_file.stat().st_mtime)
-                sha512.update(date_modified.encode("utf-8"))
+    def _get_task_variables(self, task: Task, ds, templates=()):
+        """ :return: dict, resolved values of variables referenced by the task """
+        names = get_referenced_variables(ds, templates)
+        if not names:
+            return {}
+        variables = self._get_all_variables(task)
+        if variables is None:
+            return {}
+        return resolve_variables(names, variables, loader=task.get_loader())
 
-        return sha512.hexdigest()
+    def get_task_unresolved_variables(self, task: Task):
+        """
+        :return: set of str, variables referenced by the task whose values are not known yet,
+                 see get_unresolved_variables
+        """
+        serialized_data = self._get_task_data(task)
+        if not serialized_data:
+            return set()
+        names = get_referenced_variables(serialized_data, self._get_task_templates(task) or ())
+        if not names:
+            return set()
+        variables = self._get_all_variables(task)
+        if variables is None:
+            return set()
+        return get_unresolved_variables(names, variables)
+
+    def _get_fingerprinter(self):
+        if self._fingerprinter is None:
+            cache_path = None
+            db_path = os.environ.get("AB_DB_PATH")
+            if db_path:
+                runtime_dir_path = Database(db_path=db_path).runtime_dir_path
+                cache_path = os.path.join(runtime_dir_path, FINGERPRINT_CACHE_FILE_NAME)
+            self._fingerprinter = Fingerprinter(cache_path)
+        return self._fingerprinter
 
     def _maybe_load_from_cache(self, task):
         """
@@ -135,35 +591,32 @@ class CallbackModule(CallbackBase):
         if task.action in ["setup", "gather_facts"]:
             # we ignore setup
             return
-        a, build = self._get_app_and_build()
-        if build.is_failed():
-            # build failed, skip the task
-            task.when = "0"  # skip
-            return
-        if "stop-layering" in getattr(task, "tags", []):
-            build.stop_layering()
-            a.db.record_build(build)
-            return
-        if NO_CACHE_TAG in getattr(task, "tags", []):
-            self._display.display("detected tag '%s': won't load from cache from now" % NO_CACHE_TAG)
-            build.cache_tasks = False
-            a.db.record_build(build)
-            return
-        if not build.was_last_layer_cached():
-            return
-        if not build.is_layering_on():
-            return
-        content = self.get_task_content(task)
-        logger.debug("hash = %s", content)
-        status = a.maybe_load_from_cache(content, build_id=build.build_id)
-        if status:
-            self._display.display("loaded from cache: '%s'" % status)
+        content = self._get_content(task)
+        identity = self._get_identity(task)
+        tags = list(getattr(task, "tags", []))
+        if self._client:
+            response = self._client.call("task_started", content=content, tags=tags,
+                                         identity=identity)
+            skip, message = response["skip"], response["message"]
+        else:
+            a, build = self._get_app_and_build()
+            skip, message = a.task_started(build, content, tags, identity=identity)
+        self._display_message(message)
+        if skip:
             task.when = "0"  # skip
+        else:
+            self._start_times[task._uuid] = time.monotonic()
 
     def abort_build(self):
         logger.debug("%s", traceback.format_exc())
-        a, build = self._get_app_and_build()
-        a.db.record_build(build, build_state=BuildState.FAILED)
+        if self._client:
+            self._client.call("abort_build")
+        else:
+            a, build = self._get_app_and_build()
+            a.abort_build(build)
+
+    def v2_playbook_on_play_start(self, play):
+        self._play = play
 
     def v2_playbook_on_task_start(self, task, is_conditional):
         try:
@@ -172,14 +625,27 @@ class CallbackModule(CallbackBase):
             logger.error("error while running the build: %s", ex)
             self.abort_build()
 
-    def v2_on_any(self, *args, **kwargs):
+    def _on_task_result(self, result):
+        # results of loop items (v2_runner_item_on_*) are ignored: the task is snapshotted
+        # once, after the result of the whole loop
         try:
-            first_arg = args[0]
-        except IndexError:
-            return
-        if isinstance(first_arg, TaskResult):
-            try:
-                return self._snapshot(first_arg)
-            except Exception as ex:
-                logger.error("error while running the build: %s", ex)
-                self.abort_build()
+            return self._snapshot(result)
+        except Exception as ex:
+            logger.error("error while running the build: %s", ex)
+            self.abort_build()
+
+    def v2_runner_on_ok(self, result):
+        return self._on_task_result(result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        return self._on_task_result(result)
+
+    def v2_runner_on_skipped(self, result):
+        return self._on_task_result(result)
+
+    def v2_runner_on_unreachable(self, result):
+        return self._on_task_result(result)
+
+    def v2_playbook_on_stats(self, stats):
+        if self._fingerprinter is not None:
+            self._fingerprinter.save()
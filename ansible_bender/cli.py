@@ -3,7 +3,9 @@ CLI for ansible builder
 """
 
 import argparse
+import datetime
 import json
+import re
 import sys
 import subprocess
 import yaml
@@ -11,9 +13,12 @@ from tabulate import tabulate
 
 from ansible_bender import __version__
 from ansible_bender.api import Application
-from ansible_bender.constants import ANNOTATIONS_KEY, PLAYBOOK_TEMPLATE
+from ansible_bender.builders.base import BuildState
+from ansible_bender.conf import CachePolicy, RetentionPolicy
+from ansible_bender.constants import ANNOTATIONS_KEY, PLAYBOOK_TEMPLATE, LAYERING_GRANULARITIES, \
+    RETENTION_TIME_BUDGET
 from ansible_bender.core import AnsibleVarsParser
-from ansible_bender.db import PATH_CANDIDATES
+from ansible_bender.db import PATH_CANDIDATES, BACKENDS
 from ansible_bender.okd import build_inside_openshift
 
 from ansible_bender.utils import fancy_time, run_cmd
@@ -37,6 +42,56 @@ def split_once_or_fail_with(strink, pattern, error_message):
     return k, v
 
 
+def parse_duration(value):
+    """
+    parse a relative time such as 30m, 12h or 7d
+
+    :param value: str
+    :return: datetime.timedelta
+    """
+    m = re.fullmatch(r"(\d+)([smhd])", value)
+    if not m:
+        raise argparse.ArgumentTypeError(f"invalid duration '{value}': use e.g. 30m, 12h or 7d")
+    unit = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}[m.group(2)]
+    return datetime.timedelta(**{unit: int(m.group(1))})
+
+
+def parse_size(value):
+    """
+    parse a size such as 500M or 20G
+
+    :param value: str
+    :return: int, bytes
+    """
+    m = re.fullmatch(r"(\d+)([kKMGT]?)", value)
+    if not m:
+        raise argparse.ArgumentTypeError(f"invalid size '{value}': use e.g. 500M or 20G")
+    return int(m.group(1)) * 1024 ** " KMGT".index(m.group(2).upper() or " ")
+
+
+ISO_TIME_FORMATS = ("%Y-%m-%d", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f")
+
+
+def parse_since(value):
+    """
+    parse value of the --since option: either a date and time in ISO format
+    or a relative time such as 30m, 12h or 7d
+
+    :param value: str
+    :return: datetime.datetime
+    """
+    if re.fullmatch(r"\d+[smhd]", value):
+        return datetime.datetime.now() - parse_duration(value)
+    # datetime.fromisoformat is not available in python 3.6
+    for time_format in ISO_TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value.replace(" ", "T", 1), time_format)
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(
+        f"invalid time '{value}': use ISO format (2019-01-31T12:00) or a relative time (30m, 12h, 7d)")
+
+
 class CLI:
     def __init__(self):
         self.parser = argparse.ArgumentParser(
@@ -59,6 +114,13 @@ class CLI:
             help="a path to directory where ab will store runtime data, defaults to: \"%s\""
                  % candidates_str
         )
+        self.parser.add_argument(
+            "--database-backend",
+            choices=list(BACKENDS),
+            help="how ab should store its runtime data; the existing json data are migrated "
+                 "when sqlite is selected for the first time, defaults to json "
+                 "(or sqlite once it is in use)"
+        )
         self.subparsers = self.parser.add_subparsers()
 
         self._do_build_interface()
@@ -67,6 +129,8 @@ class CLI:
         self._do_inspect_interface()
         self._do_push_interface()
         self._do_clean_interface()
+        self._do_prune_cache_interface()
+        self._do_prune_builds_interface()
         self._do_init_interface()
 
         self.args = self.parser.parse_args()
@@ -76,7 +140,77 @@ class CLI:
         verbose = False
         if self.args.verbose:
             verbose = True
-        self.app = Application(debug=debug, db_path=self.args.database_dir, verbose=verbose)
+        self.app = Application(debug=debug, db_path=self.args.database_dir, verbose=verbose,
+                               db_backend=self.args.database_backend,
+                               cache_policy=self._get_cache_policy(),
+                               retention_policy=self._get_retention_policy())
+
+    @staticmethod
+    def _add_cache_policy_arguments(parser, description=None):
+        defaults = CachePolicy()
+        parser = parser.add_argument_group("layer cache eviction", description)
+        parser.add_argument(
+            "--cache-max-size",
+            help="evict least recently used layers from the cache once they take more space, "
+                 "e.g. 20G, unlimited by default",
+            type=parse_size,
+            metavar="SIZE",
+            default=defaults.max_size
+        )
+        parser.add_argument(
+            "--cache-max-entries-per-base",
+            help="how many layers can be cached on top of a single image, defaults to %s"
+                 % defaults.max_entries_per_base,
+            type=int,
+            metavar="N",
+            default=defaults.max_entries_per_base
+        )
+        parser.add_argument(
+            "--cache-max-age",
+            help="evict layers from the cache which were not used for this long, e.g. 7d, "
+                 "defaults to %sd" % defaults.max_age.days,
+            type=parse_duration,
+            metavar="AGE",
+            default=defaults.max_age
+        )
+
+    @staticmethod
+    def _add_retention_policy_arguments(parser, description=None):
+        defaults = RetentionPolicy()
+        parser = parser.add_argument_group("retention of past builds", description)
+        parser.add_argument(
+            "--keep-builds",
+            help="keep only the latest N finished builds of every target image, defaults to %s"
+                 % defaults.keep_builds,
+            type=int,
+            metavar="N",
+            default=defaults.keep_builds
+        )
+        parser.add_argument(
+            "--failed-max-age",
+            help="remove failed builds and their images once they are older, e.g. 7d, "
+                 "defaults to %sd" % defaults.failed_max_age.days,
+            type=parse_duration,
+            metavar="AGE",
+            default=defaults.failed_max_age
+        )
+
+    def _get_retention_policy(self):
+        if not hasattr(self.args, "keep_builds"):
+            return None
+        return RetentionPolicy(
+            keep_builds=self.args.keep_builds,
+            failed_max_age=self.args.failed_max_age,
+        )
+
+    def _get_cache_policy(self):
+        if not hasattr(self.args, "cache_max_age"):
+            return None
+        return CachePolicy(
+            max_size=self.args.cache_max_size,
+            max_entries_per_base=self.args.cache_max_entries_per_base,
+            max_age=self.args.cache_max_age,
+        )
 
     def _do_build_interface(self):
         self.build_parser = self.subparsers.add_parser(
@@ -199,6 +333,54 @@ class CLI:
             "--python-interpreter",
             help="Path to a python interpreter inside the base image"
         )
+        self.build_parser.add_argument(
+            "--layering-granularity",
+            choices=LAYERING_GRANULARITIES,
+            help="commit a layer after every task (default), every top-level block, every role "
+                 "or only after tasks tagged 'checkpoint'"
+        )
+        self.build_parser.add_argument(
+            "--layer-min-tasks",
+            type=int,
+            help="commit a layer only once it covers at least this many tasks"
+        )
+        self.build_parser.add_argument(
+            "--layer-min-time",
+            type=parse_duration,
+            help="commit a layer only once its tasks took at least this long, e.g. 90s or 5m"
+        )
+        self.build_parser.add_argument(
+            "--detect-fs-changes",
+            action="store_true",
+            default=None,
+            help="commit a layer only if the filesystem of the working container changed, "
+                 "regardless of the changed status reported by ansible (needs overlay storage "
+                 "and the permission to mount the container)"
+        )
+        self.build_parser.add_argument(
+            "--pipeline-commits",
+            action="store_true",
+            default=None,
+            help="commit layers in the background from snapshots of the working container, "
+                 "so the playbook doesn't wait for every commit (needs overlay storage "
+                 "on a filesystem with reflinks, e.g. xfs or btrfs)"
+        )
+        self.build_parser.add_argument(
+            "--plan",
+            action="store_true",
+            help="don't build anything, only print which tasks would be loaded from cache "
+                 "and estimate how long the build would take"
+        )
+        self._add_cache_policy_arguments(
+            self.build_parser,
+            description="once the image is built successfully, least recently used layers are "
+                        "evicted from the cache and their images are removed according to these "
+                        "limits; nothing is evicted when the build fails or is interrupted")
+        self._add_retention_policy_arguments(
+            self.build_parser,
+            description="once the image is built successfully, past builds are removed "
+                        "according to these limits, for at most %d seconds; nothing is removed "
+                        "when the build fails or is interrupted" % RETENTION_TIME_BUDGET)
         self.build_parser.set_defaults(subcommand="build")
 
         self.bio_parser = self.subparsers.add_parser(
@@ -220,6 +402,13 @@ class CLI:
             nargs="?",
             default=None
         )
+        self.gl_parser.add_argument(
+            "--tail",
+            help="show only last N lines of the logs",
+            type=int,
+            metavar="N",
+            default=None
+        )
         self.gl_parser.set_defaults(subcommand="get-logs")
 
     def _do_list_builds_interface(self):
@@ -228,6 +417,33 @@ class CLI:
             description="print a list of past and present builds",
             help="print a list of past and present builds"
         )
+        self.lb_parser.add_argument(
+            "--limit",
+            help="show only the latest N builds",
+            type=int,
+            metavar="N",
+            default=None
+        )
+        self.lb_parser.add_argument(
+            "--state",
+            help="show only builds in the selected state",
+            choices=[x.value for x in BuildState],
+            default=None
+        )
+        self.lb_parser.add_argument(
+            "--image",
+            help="show only builds of images matching the glob pattern, e.g. 'registry.example.com/*'",
+            metavar="PATTERN",
+            default=None
+        )
+        self.lb_parser.add_argument(
+            "--since",
+            help="show only builds started since the selected time: "
+                 "ISO format (2019-01-31T12:00) or relative (30m, 12h, 7d)",
+            type=parse_since,
+            metavar="TIME",
+            default=None
+        )
         self.lb_parser.set_defaults(subcommand="list-builds")
 
     def _do_inspect_interface(self):
@@ -277,6 +493,26 @@ class CLI:
         # )
         self.push_parser.set_defaults(subcommand="push")
 
+    def _do_prune_cache_interface(self):
+        self.pc_parser = self.subparsers.add_parser(
+            name="prune-cache",
+            description="Evict layers from the cache and remove their images, "
+                        "this is also done at the end of every build",
+            help="Evict layers from the cache and remove their images"
+        )
+        self._add_cache_policy_arguments(self.pc_parser)
+        self.pc_parser.set_defaults(subcommand="prune-cache")
+
+    def _do_prune_builds_interface(self):
+        self.pb_parser = self.subparsers.add_parser(
+            name="prune-builds",
+            description="Remove past builds, their logs and images of failed builds, "
+                        "this is also done at the end of every build",
+            help="Remove past builds, their logs and images of failed builds"
+        )
+        self._add_retention_policy_arguments(self.pb_parser)
+        self.pb_parser.set_defaults(subcommand="prune-builds")
+
     def _do_init_interface(self):
         self.lb_parser = self.subparsers.add_parser(
             name="init",
@@ -353,20 +589,86 @@ class CLI:
             build.python_interpreter = self.args.python_interpreter
         if self.args.build_entrypoint:
             build.build_entrypoint = self.args.build_entrypoint
-
+        if self.args.detect_fs_changes is not None:
+            build.detect_fs_changes = self.args.detect_fs_changes
+        if self.args.pipeline_commits is not None:
+            build.pipelined_commits = self.args.pipeline_commits
+        if self.args.layering_granularity:
+            build.layering_policy.granularity = self.args.layering_granularity
+        if self.args.layer_min_tasks is not None:
+            build.layering_policy.min_tasks = self.args.layer_min_tasks
+        if self.args.layer_min_time is not None:
+            build.layering_policy.min_seconds = self.args.layer_min_time.total_seconds()
+
+        if self.args.plan:
+            self._print_plan(build)
+            return
         self.app.build(build)
 
+    def _print_plan(self, build):
+        plan = self.app.plan(build)
+        header = ("#", "TASK", "CACHE", "LAYER", "TOOK")
+        tasks_data = []
+        first_miss = None
+        first_unknown = None
+        estimate = 0.0
+        unknown = 0
+        for index, task in enumerate(plan, 1):
+            took = ""
+            if task["cached"]:
+                status = "HIT"
+            else:
+                if task["cached"] is None:
+                    # depends on facts, registered variables or templates known during the build
+                    status = "?"
+                    if first_unknown is None:
+                        first_unknown = (index, task["name"])
+                else:
+                    status = "MISS"
+                    if first_miss is None:
+                        first_miss = (index, task["name"])
+                if task["duration"] is None:
+                    unknown += 1
+                else:
+                    estimate += task["duration"]
+            if task["duration"] is not None:
+                took = fancy_time(datetime.timedelta(seconds=task["duration"]))
+            tasks_data.append((index, task["name"], status, task["layer_id"] or "", took))
+        print(tabulate(tasks_data, headers=header))
+        print()
+        if first_unknown is not None:
+            print("Task #%d '%s' uses facts, registered variables or a template known only "
+                  "once it runs: whether it and the following tasks are loaded from cache is "
+                  "known only during the build."
+                  % first_unknown)
+        elif first_miss is None:
+            print("All tasks would be loaded from cache.")
+            return
+        else:
+            print("The first task to execute is #%d '%s'." % first_miss)
+        message = "Estimated time to execute tasks: %s%s" % (
+            "at most " if first_unknown is not None else "",
+            fancy_time(datetime.timedelta(seconds=estimate)))
+        if unknown:
+            message += " (%d task(s) were never executed before)" % unknown
+        print(message)
+
     def _build_inside_openshift(self):
         build_inside_openshift(self.app)
 
     def _list_builds(self):
-        builds = self.app.list_builds()
+        builds = self.app.list_builds(
+            limit=self.args.limit,
+            state=BuildState(self.args.state) if self.args.state else None,
+            image=self.args.image,
+            since=self.args.since,
+        )
         header = ("BUILD ID", "IMAGE NAME", "STATUS", "DATE", "BUILD TIME")
         builds_data = []
         for b in builds:
             build_time = ""
-            if b.build_finished_time and b.build_start_time:
-                build_time = fancy_time(b.build_finished_time - b.build_start_time)
+            if b.duration is not None:
+                build_time = fancy_time(b.duration)
             builds_data.append((
                 b.build_id,
                 b.target_image,
@@ -378,10 +680,11 @@ class CLI:
 
     def _get_logs(self):
         build_id = self.args.BUILD_ID
-        log_lines = self.app.get_logs(build_id=build_id)
-        if log_lines:
-            print("\n".join(log_lines))
-        else:
+        empty = True
+        for line in self.app.get_logs(build_id=build_id, tail=self.args.tail):
+            empty = False
+            print(line)
+        if empty:
             print(f"There are no logs for build {build_id}")
 
     def _inspect(self):
@@ -411,6 +714,15 @@ class CLI:
                 continue
         print("Done!")
 
+    def _prune_cache(self):
+        evicted = self.app.prune_cache()
+        size = sum(e["size"] or 0 for e in evicted)
+        print(f"Evicted {len(evicted)} layers from the cache, {size} bytes were freed.")
+
+    def _prune_builds(self):
+        removed = self.app.prune_builds()
+        print(f"Removed {len(removed)} past builds.")
+
     def _init(self):
         with open('playbook.yml', 'w') as fd:
             fd.write(PLAYBOOK_TEMPLATE)
@@ -449,6 +761,12 @@ class CLI:
             elif subcommand == "clean":
                 self._clean()
                 return 0
+            elif subcommand == "prune-cache":
+                self._prune_cache()
+                return 0
+            elif subcommand == "prune-builds":
+                self._prune_builds()
+                return 0
             elif subcommand == "init":
                 self._init()
                 return 0
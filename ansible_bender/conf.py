@@ -2,9 +2,12 @@
 This is a configuration module
 """
 import datetime
+import re
 
 from ansible_bender.builders.base import BuildState
-from ansible_bender.constants import TIMESTAMP_FORMAT, ANNOTATIONS_KEY
+from ansible_bender.constants import TIMESTAMP_FORMAT, ANNOTATIONS_KEY, CACHE_MAX_AGE_DAYS, \
+    CACHE_MAX_ENTRIES_PER_BASE, RETENTION_KEEP_BUILDS, RETENTION_FAILED_MAX_AGE_DAYS, \
+    LAYERING_GRANULARITIES
 from ansible_bender.exceptions import ABValidationError
 from ansible_bender.schema import IMAGE_META_SCHEMA, BUILD_SCHEMA 
 from ansible_bender.utils import graceful_get
@@ -120,6 +123,191 @@ class Layer:
         )
 
 
+class CachePolicy:
+    """
+    when entries of the layer cache store should be evicted, least recently used go first
+
+    max_size: int, maximum size of all the cached layers in bytes
+    max_entries_per_base: int, maximum number of layers cached on top of a single image
+    max_age: datetime.timedelta, evict layers which were not used for this long
+    """
+    def __init__(self, max_size=None, max_entries_per_base=CACHE_MAX_ENTRIES_PER_BASE,
+                 max_age=datetime.timedelta(days=CACHE_MAX_AGE_DAYS)):
+        self.max_size = max_size
+        self.max_entries_per_base = max_entries_per_base
+        self.max_age = max_age
+
+    def select_evicted(self, entries, now=None):
+        """
+        pick cache entries to evict
+
+        :param entries: list of dicts: base_image_id, content, image_id, last_hit (datetime
+                        or None), size (int or None)
+        :param now: datetime.datetime, current time
+        :return: list of the evicted entries, most recently used first
+        """
+        now = now or datetime.datetime.now()
+        # least recently used first, entries without a timestamp predate the accounting
+        lru = sorted(entries, key=lambda e: e["last_hit"] or datetime.datetime.min)
+        evicted = []
+        kept = []
+        for e in lru:
+            if self.max_age is not None and (e["last_hit"] is None or now - e["last_hit"] > self.max_age):
+                evicted.append(e)
+            else:
+                kept.append(e)
+        if self.max_entries_per_base is not None:
+            per_base = {}
+            for e in kept:
+                per_base.setdefault(e["base_image_id"], []).append(e)
+            kept = []
+            for base_entries in per_base.values():
+                over = max(len(base_entries) - self.max_entries_per_base, 0)
+                evicted += base_entries[:over]
+                kept += base_entries[over:]
+            kept.sort(key=lambda e: e["last_hit"] or datetime.datetime.min)
+        if self.max_size is not None:
+            total = sum(e["size"] or 0 for e in kept)
+            for e in kept:
+                if total <= self.max_size:
+                    break
+                evicted.append(e)
+                total -= e["size"] or 0
+        evicted.sort(key=lambda e: e["last_hit"] or datetime.datetime.min, reverse=True)
+        return evicted
+
+
+class LayeringPolicy:
+    """
+    where layers are committed during the build
+
+    granularity: str, natural boundaries of layers: every "task", the end of a top-level
+                 "block", the end of a "role" or only "checkpoint" tasks (tagged checkpoint)
+    min_tasks: int, at a boundary, commit a layer only if it covers at least this many tasks
+    min_seconds: float, ...or if its tasks took at least this many seconds
+    """
+    def __init__(self, granularity="task", min_tasks=None, min_seconds=None):
+        if granularity not in LAYERING_GRANULARITIES:
+            raise ABValidationError(
+                "Layering granularity %s is not one of %s" % (granularity, ", ".join(LAYERING_GRANULARITIES)))
+        self.granularity = granularity
+        self.min_tasks = min_tasks
+        self.min_seconds = min_seconds
+
+    def is_default(self):
+        """ a layer for every task, the way ab always worked """
+        return self.granularity == "task" and self.min_tasks is None and self.min_seconds is None
+
+    def should_commit(self, tasks, seconds):
+        """
+        :param tasks: int, how many tasks were executed since the last layer
+        :param seconds: float, how long they took
+        :return: bool, commit a layer at this boundary
+        """
+        if self.min_tasks is None and self.min_seconds is None:
+            return True
+        return ((self.min_tasks is not None and tasks >= self.min_tasks) or
+                (self.min_seconds is not None and seconds >= self.min_seconds))
+
+    def to_dict(self):
+        return {
+            "granularity": self.granularity,
+            "min_tasks": self.min_tasks,
+            "min_seconds": self.min_seconds,
+        }
+
+    @classmethod
+    def from_json(cls, j):
+        return cls(granularity=j.get("granularity", "task"), min_tasks=j.get("min_tasks"),
+                   min_seconds=j.get("min_seconds"))
+
+
+class RetentionPolicy:
+    """
+    which past builds should be removed
+
+    keep_builds: int, keep only the latest N finished builds of every target image
+    failed_max_age: datetime.timedelta, remove failed builds which are older
+    """
+    # name of an image committed when a build fails: <target>-<timestamp>-failed
+    FAILED_IMAGE_RE = re.compile(r"^(.+)-\d{8}-\d{12}-failed$")
+
+    def __init__(self, keep_builds=RETENTION_KEEP_BUILDS,
+                 failed_max_age=datetime.timedelta(days=RETENTION_FAILED_MAX_AGE_DAYS)):
+        self.keep_builds = keep_builds
+        self.failed_max_age = failed_max_age
+
+    @classmethod
+    def get_failed_image_target(cls, image_name):
+        """
+        :return: str, name of the target image if the image was committed by a failed build,
+                 None otherwise
+        """
+        m = cls.FAILED_IMAGE_RE.match(image_name or "")
+        return m.group(1) if m else None
+
+    def select_expired(self, summaries, now=None):
+        """
+        pick builds to remove, builds which haven't finished are never picked
+
+        :param summaries: list of BuildSummary
+        :param now: datetime.datetime, current time
+        :return: list of BuildSummary, oldest first
+        """
+        now = now or datetime.datetime.now()
+        finished = [s for s in summaries if s.state in (BuildState.DONE, BuildState.FAILED)]
+        finished.sort(key=lambda s: int(s.build_id), reverse=True)
+        expired = []
+        per_image = {}
+        for s in finished:
+            image = self.get_failed_image_target(s.target_image) or s.target_image
+            per_image[image] = per_image.get(image, 0) + 1
+            if self.keep_builds is not None and per_image[image] > self.keep_builds:
+                expired.append(s)
+            elif (self.failed_max_age is not None and s.state == BuildState.FAILED
+                    and now - (s.build_finished_time or s.build_start_time or now) > self.failed_max_age):
+                expired.append(s)
+        expired.reverse()
+        return expired
+
+
+class BuildSummary:
+    """ a lightweight view of a build: only what's needed to list builds """
+
+    def __init__(self, build_id, target_image, state, build_start_time=None, build_finished_time=None):
+        """
+        :param build_id: str
+        :param target_image: str
+        :param state: one of BuildState
+        :param build_start_time: datetime or None
+        :param build_finished_time: datetime or None
+        """
+        self.build_id = build_id
+        self.target_image = target_image
+        self.state = state
+        self.build_start_time = build_start_time
+        self.build_finished_time = build_finished_time
+
+    @property
+    def duration(self):
+        """ how long the build took: datetime.timedelta or None """
+        if self.build_start_time and self.build_finished_time:
+            return self.build_finished_time - self.build_start_time
+
+    @classmethod
+    def from_json(cls, j):
+        """ return BuildSummary instance from a serialized build or summary """
+        sta = j.get("build_start_time")
+        fin = j.get("build_finished_time")
+        return cls(
+            j["build_id"],
+            j["target_image"],
+            BuildState(j["state"]),
+            build_start_time=datetime.datetime.strptime(sta, TIMESTAMP_FORMAT) if sta else None,
+            build_finished_time=datetime.datetime.strptime(fin, TIMESTAMP_FORMAT) if fin else None,
+        )
+
+
 class Build:
     """ class which represents a build """
     def __init__(self):
@@ -140,7 +328,9 @@ class Build:
         self.final_layer_id = None  # once the image is built, this is the final layer: content + metadata
         self.layer_index = {}  # this is an index for layers: `layer_id: Layer()`
         self.cache_tasks = True  # we cache by default, a user can opt out
+        # logs are stored in a file, see Database.save_logs; this is set only for legacy records
         self.log_lines = []  # a list of strings
+        self.log_file = None  # name of the compressed log file within runtime dir
         self.layering = True
         self.squash = False
         self.debug = False
@@ -152,6 +342,29 @@ class Build:
         self.ansible_extra_args = None
         self.python_interpreter = None
         self.verbose_layer_names = False
+        # the layer the working container is at: it lags behind the top layer while
+        # layers are loaded from cache, see Application.materialize_working_container
+        self.working_container_layer_id = None
+        # tasks ran in the working container after its layer was committed: their changes
+        # (including those of tasks whose failure was ignored) may not be in any layer
+        self.working_container_dirty = False
+        self.layering_policy = LayeringPolicy()
+        # decide whether a task changed anything by inspecting the filesystem of the
+        # working container instead of trusting the changed status reported by ansible
+        self.detect_fs_changes = False
+        # commit layers in the background from snapshots of the working container while
+        # ansible moves on to the next task
+        self.pipelined_commits = False
+        # with a non-default layering policy, tasks of the playbook known before the build:
+        # list of dicts: content, boundary (a layer can be committed after the task) and
+        # cacheable (the task can be loaded from cache)
+        self.task_plan = None
+        self.plan_position = 0  # index of the next task in task_plan
+        self.plan_skip_until = 0  # tasks before this index were loaded from cache
+        self.plan_finished_position = -1  # index of the last task which reported its result
+        self.pending_contents = []  # contents of executed tasks not committed into a layer yet
+        self.pending_duration = 0.0  # how long they took
+        self.pending_changed = False  # did any of them report a change
 
     def to_dict(self):
         """ serialize """
@@ -174,8 +387,7 @@ class Build:
             "layer_index": {x.layer_id: x.to_dict() for x in self.layers},
             "build_container": self.build_container,
             "cache_tasks": self.cache_tasks,
-            # we could compress/base64 here, let's go for the easier solution first
-            "log_lines": self.log_lines,
+            "log_file": self.log_file,
             "layering": self.layering,
             "squash": self.squash,
             "debug": self.debug,
@@ -187,6 +399,18 @@ class Build:
             "ansible_extra_args": self.ansible_extra_args,
             "python_interpreter": self.python_interpreter,
             "verbose_layer_names": self.verbose_layer_names,
+            "working_container_layer_id": self.working_container_layer_id,
+            "working_container_dirty": self.working_container_dirty,
+            "layering_policy": self.layering_policy.to_dict(),
+            "detect_fs_changes": self.detect_fs_changes,
+            "pipelined_commits": self.pipelined_commits,
+            "task_plan": self.task_plan,
+            "plan_position": self.plan_position,
+            "plan_skip_until": self.plan_skip_until,
+            "plan_finished_position": self.plan_finished_position,
+            "pending_contents": self.pending_contents,
+            "pending_duration": self.pending_duration,
+            "pending_changed": self.pending_changed,
         }
 
     def update_from_configuration(self, data):
@@ -205,6 +429,11 @@ class Build:
         self.podman_run_extra_args = graceful_get(data, "podman_run_extra_args")
         self.ansible_extra_args = graceful_get(data, "ansible_extra_args")
         self.verbose_layer_names = graceful_get(data, "verbose_layer_names")
+        self.detect_fs_changes = graceful_get(data, "detect_fs_changes", default=self.detect_fs_changes)
+        self.pipelined_commits = graceful_get(data, "pipelined_commits", default=self.pipelined_commits)
+        layering_policy = graceful_get(data, "layering_policy")
+        if layering_policy:
+            self.layering_policy = LayeringPolicy.from_json(layering_policy)
         # we should probably get this from the official Ansible variable
         # self.python_interpreter = None
 
@@ -236,7 +465,8 @@ class Build:
                          for layer_id, layer_data in j["layer_index"].items()}
         b.build_container = j["build_container"]
         b.cache_tasks = j["cache_tasks"]
-        b.log_lines = j["log_lines"]
+        b.log_lines = j.get("log_lines", [])
+        b.log_file = j.get("log_file", None)
         b.layering = j["layering"]
         b.squash = j.get("squash", False)
         b.debug = j["debug"]
@@ -248,6 +478,18 @@ class Build:
         b.podman_run_extra_args = j.get("podman_run_extra_args", None)
         b.python_interpreter = j.get("python_interpreter", None)
         b.verbose_layer_names = graceful_get(j, "verbose_layer_names", default=False)
+        b.working_container_layer_id = j.get("working_container_layer_id", None)
+        b.working_container_dirty = j.get("working_container_dirty", False)
+        b.layering_policy = LayeringPolicy.from_json(j.get("layering_policy") or {})
+        b.detect_fs_changes = j.get("detect_fs_changes", False)
+        b.pipelined_commits = j.get("pipelined_commits", False)
+        b.task_plan = j.get("task_plan", None)
+        b.plan_position = j.get("plan_position", 0)
+        b.plan_skip_until = j.get("plan_skip_until", 0)
+        b.plan_finished_position = j.get("plan_finished_position", -1)
+        b.pending_contents = j.get("pending_contents", [])
+        b.pending_duration = j.get("pending_duration", 0.0)
+        b.pending_changed = j.get("pending_changed", False)
         return b
 
     def record_layer(self, content, layer_id, base_image_id, cached=None):
@@ -3,6 +3,22 @@ OUT_LOGGER_FORMAT = "%(message)s"
 TIMESTAMP_FORMAT = "%Y%m%d-%H%M%S%f"
 TIMESTAMP_FORMAT_TOGETHER = "%Y%m%d%H%M%S%f"
 NO_CACHE_TAG = "no-cache"
+STOP_LAYERING_TAG = "stop-layering"
+# with the checkpoint layering granularity, layers are committed after tasks with this tag
+CHECKPOINT_TAG = "checkpoint"
+LAYERING_GRANULARITIES = ("task", "block", "role", "checkpoint")
+
+# eviction of the layer cache store, see CachePolicy
+CACHE_MAX_AGE_DAYS = 30
+CACHE_MAX_ENTRIES_PER_BASE = 50
+# retention of past builds, see RetentionPolicy
+RETENTION_KEEP_BUILDS = 50
+RETENTION_FAILED_MAX_AGE_DAYS = 14
+# how many seconds can be spent pruning old builds at the end of a build
+RETENTION_TIME_BUDGET = 10
+# how many seconds the container tooling is trusted to work once it passed the checks
+# with the same versions and base image, see Application.build
+PROBE_CACHE_TTL = 24 * 60 * 60
 
 # configuration related constants
 ANNOTATIONS_KEY = "annotations"
@@ -49,13 +49,17 @@ import yaml
 import ansible_bender
 from ansible_bender import callback_plugins
 from ansible_bender.conf import ImageMetadata, Build
-from ansible_bender.constants import TIMESTAMP_FORMAT, TIMESTAMP_FORMAT_TOGETHER
+from ansible_bender.constants import TIMESTAMP_FORMAT, TIMESTAMP_FORMAT_TOGETHER, CHECKPOINT_TAG, \
+    NO_CACHE_TAG, STOP_LAYERING_TAG
 from ansible_bender.exceptions import ABBuildUnsuccesful, ABValidationError
+from ansible_bender.ipc import IPC_SOCKET_ENV
 from ansible_bender.schema import PLAYBOOK_SCHEMA
 from ansible_bender.utils import run_cmd, ap_command_exists, random_str, graceful_get, \
     is_ansibles_python_2
 
 from ansible.inventory.manager import InventoryManager
+from ansible.playbook import Playbook
+from ansible.playbook.block import Block
 from ansible.vars.manager import VariableManager
 from ansible.parsing.dataloader import DataLoader
 from ansible_bender.conf import Build, ImageMetadata
@@ -72,6 +76,8 @@ callback_plugins={0}
 callback_whitelist=snapshoter\n
 callbacks_enabled=snapshoter\n
 """
+# the host plays are run against when planning the build: the container doesn't exist yet
+PLAN_HOST = "ab-plan"
 
 
 def run_playbook(playbook_path, inventory_path, a_cfg_path, connection, extra_variables=None,
@@ -208,11 +214,13 @@ class AnsibleRunner:
 
         return tmp_pb_path
     
-    def build(self, db_path):
+    def build(self, db_path, db_backend=None, ipc_address=None):
         """
         run the playbook against the container
 
         :param db_path, str, path to ab's database
+        :param db_backend, str, name of the backend the database uses
+        :param ipc_address, str, path to the socket of BuildService
 
         :return: str, output
         """
@@ -231,6 +239,11 @@ class AnsibleRunner:
                 "AB_DB_PATH": db_path,
                 "PYTHONPATH": pythonpath,  # TODO write an e2e test for this
             }
+            if db_backend:
+                # so that the callback plugin talks to the same database
+                environment["AB_DB_BACKEND"] = db_backend
+            if ipc_address:
+                environment[IPC_SOCKET_ENV] = ipc_address
             inv_path = os.path.join(tmp, "inventory")
             logger.info("creating inventory file %s", inv_path)
             with open(inv_path, "w") as fd:
@@ -261,6 +274,98 @@ class AnsibleRunner:
             shutil.rmtree(tmp)
 
 
+def _iter_tasks(blocks):
+    for block in blocks:
+        # the order in which ansible runs them, rescue only when the block fails
+        for item in block.block + block.rescue + block.always:
+            if isinstance(item, Block):
+                yield from _iter_tasks([item])
+            else:
+                yield item
+
+
+def get_task_contents(playbook_path, fingerprinter=None):
+    """
+    load the playbook the same way ansible-playbook does, without running it, and compute
+    identity and content of its tasks the same way the callback plugin does during the build
+
+    :param playbook_path: str
+    :param fingerprinter: instance of Fingerprinter, for files used by tasks
+    :return: list of (Task, str, identity of the task, str, its content, None when it uses
+             facts or registered variables: the content is known once the task is about to run)
+    """
+    # the callback plugin imports the whole ab
+    from ansible_bender.callback_plugins.snapshoter import CallbackModule
+
+    loader = DataLoader()
+    inventory = InventoryManager(loader=loader, sources=PLAN_HOST + ",")
+    variable_manager = VariableManager(loader=loader, inventory=inventory)
+    playbook = Playbook.load(playbook_path, variable_manager=variable_manager, loader=loader)
+    callback = CallbackModule(fingerprinter=fingerprinter)
+    response = []
+    for play in playbook.get_plays():
+        # ab runs all plays against the working container, see _correct_host_entries
+        play.hosts = PLAN_HOST
+        callback.v2_playbook_on_play_start(play)
+        for task in _iter_tasks(play.compile()):
+            if task.action in ("setup", "gather_facts", "meta"):
+                continue
+            content = None
+            if not callback.get_task_unresolved_variables(task):
+                content = callback.get_task_content(task)
+            response.append((task, callback.get_task_identity(task), content))
+    return response
+
+
+def _get_top_level_block(task):
+    block = None
+    parent = task._parent
+    while parent is not None:
+        if isinstance(parent, Block):
+            block = parent
+        parent = parent._parent
+    return block
+
+
+def _get_group_key(task, granularity):
+    """ tasks with the same key belong into the same layer """
+    if granularity == "task":
+        return task._uuid
+    if granularity == "role" and task._role is not None:
+        return task._role._uuid
+    # tasks outside of roles are grouped by blocks
+    block = _get_top_level_block(task)
+    return block._uuid if block is not None else task._uuid
+
+
+def get_task_plan(tasks, granularity):
+    """
+    find where layers can be committed in the list of tasks
+
+    :param tasks: list of (Task, str, str), see get_task_contents
+    :param granularity: str, see LayeringPolicy
+    :return: list of dicts: identity, content (None if it's not known before the task runs),
+             boundary (bool, a layer can be committed after the task), cacheable (bool, the
+             task can be loaded from cache)
+    """
+    plan = []
+    for index, (task, identity, content) in enumerate(tasks):
+        tags = task.tags or []
+        if index == len(tasks) - 1:
+            boundary = True
+        elif granularity == "checkpoint":
+            boundary = CHECKPOINT_TAG in tags
+        else:
+            boundary = _get_group_key(task, granularity) != _get_group_key(tasks[index + 1][0], granularity)
+        plan.append({
+            "identity": identity,
+            "content": content,
+            "boundary": boundary,
+            "cacheable": NO_CACHE_TAG not in tags and STOP_LAYERING_TAG not in tags,
+        })
+    return plan
+
+
 class PbVarsParser:
     def __init__(self, playbook_path):
         """
@@ -1,56 +1,33 @@
 """
 A database module. A class to manage ab's persistent data.
 
+The data are stored using one of the storage backends:
 
-# The schema
-
-{
-    "next_build_id": int  #
-    "builds": {
-        <id>: {
-            state: ...
-            base_image: ...
-            target_image: ...
-            builder_name: ...
-            metadata: {
-                command: ...
-                user: ...
-                env: ...
-                ...
-            },
-            layers: [
-                Layer(content, layer_id, base_image_id, cached),
-            ]
-            layer_index: {
-                layer_id: layer
-            }
-        },
-    },
-    "store": {
-        "base-image-id": {  # base-image + content = new image
-            content: {
-                image_id:
-            }
-        }
-    }
-}
+ * json (default) - json files, one per build, see ansible_bender.storage.json_storage for the schema
+ * sqlite - an SQLite database, see ansible_bender.storage.sqlite_storage
+
+The backend is picked either explicitly or via AB_DB_BACKEND environment variable;
+once ab started to use the sqlite backend in a runtime directory, it sticks to it.
 """
-import copy
+import collections
 import datetime
-import json
+import gzip
 import logging
 import os
-import time
+import tempfile
+import threading
 from contextlib import contextmanager
 
-from ansible_bender.conf import Build
+from ansible_bender.conf import Build, BuildSummary
 from ansible_bender.constants import TIMESTAMP_FORMAT
+from ansible_bender.storage.json_storage import JsonStorage
+from ansible_bender.storage.sqlite_storage import SqliteStorage
 
-DEFAULT_DATA = {
-    "next_build_id": 1,
-    "builds": {},
-    "store": {}
+BACKENDS = {
+    JsonStorage.name: JsonStorage,
+    SqliteStorage.name: SqliteStorage,
 }
+DEFAULT_BACKEND = JsonStorage.name
 
 PATH_CANDIDATES = [
     "~/.cache",
@@ -68,45 +45,47 @@ def generate_working_cont_name(image_name):
 
 
 class Database:
-    """ Simple implementation of persistent data store for ab; it's just a locked json file """
+    """ Persistent data store for ab, the data are stored using one of the BACKENDS """
 
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, backend=None):
+        """
+        :param db_path: str, path to a directory where ab should store the data
+        :param backend: str, name of the storage backend, see BACKENDS
+        """
         path_preference = PATH_CANDIDATES.copy()
         if db_path:
             path_preference.insert(0, db_path)
         self.runtime_dir_path, self.db_root_path = self._runtime_dir_path(path_preference)
-
-    @contextmanager
-    def acquire(self):
-        """
-        lock usage of database
-        """
-        while True:
-            try:
-                with open(self._lock_path(), "r") as fd:
-                    # the file exists, ab changes the database
-                    pid = fd.read()
-                logger.info("ab is running as PID %s", pid)
-                # logger.debug("stack trace: %s", traceback.extract_stack())
-                time.sleep(0.1)
-            except FileNotFoundError:
-                # cool, let's take the lock
-                try:
-                    with os.fdopen(os.open(self._lock_path(), os.O_WRONLY|os.O_EXCL|os.O_CREAT ),'w') as fd:
-                        fd.write("%s" % os.getpid())
-                    break
-                except FileExistsError:
-                    continue
-        # logger.debug("this stack has the lock: %s", traceback.extract_stack())
-        yield True
-        self.release()
-
-    def release(self):
-        """ release lock """
-        try:
-            os.unlink(self._lock_path())
-        except FileNotFoundError:
-            pass
+        backend_name = self._pick_backend(backend)
+        logger.debug("database backend is %s", backend_name)
+        self.backend = BACKENDS[backend_name](self.runtime_dir_path)
+        # a transaction in progress, per thread
+        self._local = threading.local()
+        # how many times the locks were taken, how many times we had to wait and for how long
+        self.lock_stats = self.backend.lock_stats
+
+    def _pick_backend(self, backend):
+        backend = backend or os.environ.get("AB_DB_BACKEND")
+        if not backend:
+            if os.path.exists(SqliteStorage(self.runtime_dir_path).db_path()):
+                # the data were already migrated, don't go back to the stale json file
+                return SqliteStorage.name
+            return DEFAULT_BACKEND
+        if backend not in BACKENDS:
+            raise RuntimeError("No such database backend %s, pick one of: %s" %
+                               (backend, ", ".join(BACKENDS)))
+        if backend == JsonStorage.name:
+            json_storage = JsonStorage(self.runtime_dir_path)
+            if (not os.path.exists(json_storage.db_path()) and
+                    os.path.exists(json_storage.db_path() + ".migrated")):
+                raise RuntimeError(
+                    "The data in %s were migrated to the %s backend, the json backend "
+                    "would start with an empty database." % (self.runtime_dir_path, SqliteStorage.name))
+        return backend
+
+    def close(self):
+        """ release resources held by the storage backend """
+        self.backend.close()
 
     @staticmethod
     def _runtime_dir_path(path_preference):
@@ -125,55 +104,64 @@ class Database:
         os.makedirs(our_dir, mode=0o0700, exist_ok=True)
         return our_dir, resolved
 
-    def _db_path(self):
-        data_path = os.path.join(self.runtime_dir_path, "db.json")
-        return data_path
+    @contextmanager
+    def transaction(self, write=False, snapshot=False, build_id=None):
+        """
+        load the data once, yield a storage Transaction and persist the changes once
 
-    def _lock_path(self):
-        lock_path = os.path.join(self.runtime_dir_path, "ab.pid")
-        return lock_path
+        All the Database methods invoked within the block (in the same thread) join the
+        transaction, so a read-modify-write sequence costs a single load and a single save:
 
-    def _load(self):
-        """ load data from disk, lock has to be acquired already! """
-        try:
-            with open(self._db_path(), "r") as fd:
-                return json.load(fd)
-        except FileNotFoundError:
-            # no problem, probably a first run
-            logger.debug("initializing database")
-            return copy.deepcopy(DEFAULT_DATA)
+            with db.transaction(write=True):
+                build = db.get_build(build_id)
+                db.record_build(build)
+                db.save_layer(layer_id, base_image_id, content)
+
+        :param write: bool, save the changes
+        :param snapshot: bool, read the current state without taking the lock, backends
+                         write atomically so the data are always consistent
+        :param build_id: str, the build is going to be changed after the data shared by all
+                         builds are read: its record is locked right away, see Transaction.lock_build
+        """
+        current = getattr(self._local, "transaction", None)
+        if current is not None:
+            if write and not self._local.write:
+                raise RuntimeError("Can't write to the database within a read-only transaction.")
+            if write and build_id is not None:
+                current.lock_build(build_id)
+            yield current
+            return
+        with self._open_transaction(write, snapshot) as t:
+            if write and build_id is not None:
+                t.lock_build(build_id)
+            yield t
+
+    @contextmanager
+    def _open_transaction(self, write, snapshot):
+        with self.backend.transaction(write=write, snapshot=snapshot) as t:
+            self._local.transaction, self._local.write = t, write
+            try:
+                yield t
+            finally:
+                self._local.transaction = None
 
     @staticmethod
-    def _load_build(data, build_id, is_latest=False):
+    def _load_build(t, build_id, is_latest=False):
         """
         load selected build from database
-        :param data: dict
+
+        :param t: Transaction
         :param build_id: str or None
         :param is_latest: bool
         :return: build
         """
-        try:
-            return Build.from_json(data["builds"][build_id])
-        except KeyError:
+        build_data = t.get_build(build_id)
+        if build_data is None:
             if is_latest:
                 raise RuntimeError("Latest build with ID %s is no longer available, probably got cleaned." % build_id)
             else:
                 raise RuntimeError("There is no such build with ID %s" % build_id)
-
-    def _save(self, data):
-        """ save data from memory to disk, lock has to be acquired already! """
-        with open(self._db_path(), "w") as fd:
-            json.dump(data, fd, indent=2)
-
-    @staticmethod
-    def _get_and_bump_build_id(data):
-        """ return id for next build id and increment the one in DB """
-        next_build_id = data["next_build_id"]
-        data["next_build_id"] += 1
-        if not data["builds"].get(str(next_build_id)):
-            return str(next_build_id)
-        else:
-            raise Exception(f'Database seems to be corrupted. Build {next_build_id} already exists.')
+        return Build.from_json(build_data)
 
     def record_build(self, build_i, build_id=None, build_state=None, set_finish_time=False):
         """
@@ -182,72 +170,130 @@ class Database:
         :param build_i: Build instance
         :param build_id: str, id of the build to load from DB
         :param build_state: one of BuildState
-        :param set_finish_time: bool, set build_finish_time to current time
+        :param set_finish_time: bool, set build_finished_time to current time
         """
-        with self.acquire():
-            data = self._load()
+        with self.transaction(write=True) as t:
             if build_id is not None:
-                build_i = self._load_build(data, build_id)
+                build_i = self._load_build(t, build_id)
             if build_state is not None:
                 build_i.state = build_state
             if build_i.build_id is None:
                 build_i.build_container = generate_working_cont_name(build_i.target_image)
-                build_i.build_id = self._get_and_bump_build_id(data)
+                build_i.build_id = t.allocate_build_id()
             if set_finish_time:
                 build_i.build_finished_time = datetime.datetime.now()
-            data["builds"][build_i.build_id] = build_i.to_dict()
-            self._save(data)
+            if build_i.log_lines and not build_i.log_file:
+                # a record from an older version of ab, logs are no longer stored inline
+                build_i.log_file = self.save_logs(build_i.build_id, build_i.log_lines)
+            t.put_build(build_i.build_id, build_i.to_dict())
         return build_i
 
-    def get_latest_build(self):
+    def get_latest_build(self, snapshot=False):
         """
         return build with highest ID
 
+        :param snapshot: bool, don't wait for writers, read the current state
         :return: build
         """
-        with self.acquire():
-            data = self._load()
-            build_id = str(data["next_build_id"] - 1)
-            return self._load_build(data, build_id, is_latest=True)
+        with self.transaction(snapshot=snapshot) as t:
+            build_id = t.latest_build_id()
+            return self._load_build(t, build_id, is_latest=True)
 
-    def get_build(self, build_id):
+    def get_build(self, build_id, snapshot=False):
         """
         get Build instance by selected build_id
 
         :param build_id: str
+        :param snapshot: bool, don't wait for writers, read the current state
         :return: instance of Build
         """
-        with self.acquire():
-            data = self._load()
-            return self._load_build(data, build_id)
-
-    def save_layer(self, layer_id, base_image, content):
-        with self.acquire():
-            data = self._load()
-            store = data["store"]
-            store.setdefault(base_image, {})
-            store[base_image].setdefault(content, {})
-            store[base_image][content]["image_id"] = layer_id
-            self._save(data)
-
-    def get_cached_layer(self, content, base_image_id):
-        with self.acquire():
-            data = self._load()
-            store = data["store"]
-            try:
-                return store[base_image_id][content]["image_id"]
-            except KeyError:
-                return
+        with self.transaction(snapshot=snapshot) as t:
+            return self._load_build(t, build_id)
+
+    def save_layer(self, layer_id, base_image, content, size=None, duration=None):
+        """
+        store a layer into the cache store
+
+        :param layer_id: str
+        :param base_image: str, id of the image the layer was created on top of
+        :param content: str, hash of the task which created the layer
+        :param size: int, how many bytes the layer adds on top of the base image
+        :param duration: float, how many seconds the task took
+        """
+        now = datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
+        with self.transaction(write=True) as t:
+            t.put_layer(base_image, content, layer_id, size=size, last_hit=now, duration=duration)
+
+    def get_cached_layer(self, content, base_image_id, touch=True):
+        """
+        find a layer in the cache store, a hit is recorded so that recently used
+        layers are the last ones to be evicted
+
+        :param content: str, hash of the task
+        :param base_image_id: str
+        :param touch: bool, record the hit
+        :return: str, id of the layer or None
+        """
+        with self.transaction(write=touch) as t:
+            layer_id = t.get_layer(base_image_id, content)
+            if layer_id and touch:
+                t.touch_layer(base_image_id, content, datetime.datetime.now().strftime(TIMESTAMP_FORMAT))
+            return layer_id
 
-    def load_builds(self):
+    def load_cache_entries(self):
+        """
+        provide all entries of the layer cache store
+
+        :return: list of dicts: base_image_id, content, image_id, last_hit (datetime or None),
+                 size (int or None), duration (float or None)
+        """
+        with self.transaction() as t:
+            entries = list(t.iter_layers())
+        for e in entries:
+            if e["last_hit"]:
+                e["last_hit"] = datetime.datetime.strptime(e["last_hit"], TIMESTAMP_FORMAT)
+        return entries
+
+    def delete_cache_entries(self, entries):
+        """
+        remove entries from the layer cache store
+
+        :param entries: iterable of dicts, with keys base_image_id and content
+        """
+        with self.transaction(write=True) as t:
+            for e in entries:
+                t.delete_layer(e["base_image_id"], e["content"])
+
+    def load_builds(self, snapshot=False):
         """
         provide a list of all available builds
 
+        :param snapshot: bool, don't wait for writers, read the current state
         :return: a list of Build instances
         """
-        with self.acquire():
-            data = self._load()
-            return [Build.from_json(b) for b in data["builds"].values()]
+        with self.transaction(snapshot=snapshot) as t:
+            return [Build.from_json(b) for b in t.iter_builds()]
+
+    def load_build_summaries(self, state=None, target_image=None, since=None, limit=None,
+                             snapshot=False):
+        """
+        provide a list of summaries of builds: much cheaper than loading the builds
+
+        :param state: BuildState, list only builds in this state
+        :param target_image: str, glob pattern, list only builds of matching images
+        :param since: datetime, list only builds started since then
+        :param limit: int, list only the latest N builds
+        :param snapshot: bool, don't wait for writers, read the current state
+        :return: a list of BuildSummary instances
+        """
+        with self.transaction(snapshot=snapshot) as t:
+            summaries = t.list_summaries(
+                state=state.value if state else None,
+                target_image=target_image,
+                since=since.strftime(TIMESTAMP_FORMAT) if since else None,
+                limit=limit,
+            )
+        return [BuildSummary.from_json(s) for s in summaries]
 
     def delete_build(self, build_id):
         """
@@ -255,14 +301,64 @@ class Database:
 
         :param build_id: str, id of the build to be deleted from DB
         """
-        with self.acquire():
-            data = self._load()
-            try:
-                del data["builds"][build_id]
-            except KeyError:
+        with self.transaction(write=True) as t:
+            if not t.delete_build(build_id):
                 raise RuntimeError("There is no such build with ID %s" % build_id)
-            finally:
-                self._save(data)
+        try:
+            os.unlink(os.path.join(self.runtime_dir_path, self._log_file_name(build_id)))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _log_file_name(build_id):
+        return os.path.join("logs", f"{build_id}.log.gz")
+
+    def save_logs(self, build_id, log_lines):
+        """
+        store logs of the selected build into a compressed file
+
+        :param build_id: str
+        :param log_lines: iterable of str
+        :return: str, name of the log file, relative to the runtime directory
+        """
+        file_name = self._log_file_name(build_id)
+        path = os.path.join(self.runtime_dir_path, file_name)
+        os.makedirs(os.path.dirname(path), mode=0o0700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with gzip.open(os.fdopen(fd, "wb"), "wt", encoding="utf-8") as fd:
+                for line in log_lines:
+                    fd.write(line + "\n")
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return file_name
+
+    def iter_logs(self, build, tail=None):
+        """
+        lazily read logs of the selected build
+
+        :param build: instance of Build
+        :param tail: int, provide only last N lines
+        :return: iterable of str
+        """
+        if not build.log_file:
+            lines = build.log_lines
+        else:
+            lines = self._read_log_file(os.path.join(self.runtime_dir_path, build.log_file))
+        if tail is not None:
+            return iter(collections.deque(lines, maxlen=tail))
+        return iter(lines)
+
+    @staticmethod
+    def _read_log_file(path):
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as fd:
+                for line in fd:
+                    yield line.rstrip("\n")
+        except FileNotFoundError:
+            logger.warning("log file %s does not exist", path)
 
     def load_python_interpreter(self, base_image_id):
         """
@@ -271,11 +367,8 @@ class Database:
         :param base_image_id: str, id/hash of the base image
         :return: python interpreter path if found, None otherwise
         """
-        with self.acquire():
-            data = self._load()
-            store = data["store"]
-            store.setdefault(base_image_id, {})
-            return store[base_image_id].get("python_interpreter")
+        with self.transaction() as t:
+            return t.get_python_interpreter(base_image_id)
 
     def record_python_interpreter(self, base_image_id, python_interpreter):
         """
@@ -284,9 +377,27 @@ class Database:
         :param base_image_id: str, id/hash of the base image
         :param python_interpreter: str, path of the python interpreter on the base image
         """
-        with self.acquire():
-            data = self._load()
-            store = data["store"]
-            store.setdefault(base_image_id, {})
-            store[base_image_id]["python_interpreter"] = python_interpreter
-            self._save(data)
+        with self.transaction(write=True) as t:
+            t.put_python_interpreter(base_image_id, python_interpreter)
+
+    def is_probe_fresh(self, key, max_age):
+        """
+        :param key: str, identifies the probe and the environment it was performed in
+        :param max_age: int, seconds
+        :return: bool, the probe passed within max_age seconds
+        """
+        with self.transaction(snapshot=True) as t:
+            passed_at = t.get_probe(key)
+        if not passed_at:
+            return False
+        age = datetime.datetime.now() - datetime.datetime.strptime(passed_at, TIMESTAMP_FORMAT)
+        return age.total_seconds() <= max_age
+
+    def record_probe(self, key):
+        """
+        record that a probe passed just now
+
+        :param key: str, identifies the probe and the environment it was performed in
+        """
+        with self.transaction(write=True) as t:
+            t.put_probe(key, datetime.datetime.now().strftime(TIMESTAMP_FORMAT))
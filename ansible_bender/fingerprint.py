@@ -0,0 +1,205 @@
+"""
+Fingerprints of files used by tasks: the cache is invalidated when the files change
+
+A fingerprint is a digest of names, modes and content of the files. Reading the files is
+expensive, so digests are memoized in a stat cache which persists between builds: a file
+is read again only when its inode, size or modification time change.
+
+Paths matching patterns in an .abignore file, placed in the directory being fingerprinted,
+are skipped: e.g. .git or build artifacts which are irrelevant for the image.
+"""
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import stat
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+IGNORE_FILE_NAME = ".abignore"
+# the stat cache, within ab's runtime directory
+FINGERPRINT_CACHE_FILE_NAME = "fingerprints.json"
+# files are hashed in parallel when there are more to read than this
+PARALLEL_THRESHOLD = 16
+# forget digests of files which were not used in a while once the cache grows this big
+CACHE_MAX_ENTRIES = 100000
+# a file modified so recently could still be modified within the same mtime tick,
+# its digest is not cached
+RACY_SECONDS = 2
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def load_ignore_patterns(directory):
+    """
+    :param directory: str
+    :return: list of str, glob patterns from the .abignore file in the directory
+    """
+    try:
+        with open(os.path.join(directory, IGNORE_FILE_NAME)) as fd:
+            lines = fd.read().splitlines()
+    except FileNotFoundError:
+        return []
+    return [x.strip().rstrip("/") for x in lines if x.strip() and not x.strip().startswith("#")]
+
+
+def is_ignored(relative_path, patterns):
+    """
+    :param relative_path: str, path relative to the directory with .abignore
+    :param patterns: list of str, glob patterns, matched against the path and its name
+    """
+    name = os.path.basename(relative_path)
+    return any(fnmatch.fnmatch(relative_path, p) or fnmatch.fnmatch(name, p) for p in patterns)
+
+
+def file_digest(path):
+    """ sha256 of the content of the file """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(READ_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class Fingerprinter:
+    """ compute fingerprints of files and directories, with a persistent stat cache """
+
+    def __init__(self, cache_path=None):
+        """
+        :param cache_path: str, path to a json file with the stat cache, None to not persist it
+        """
+        self.cache_path = cache_path
+        # path -> [inode, size, mtime_ns, digest]
+        self._cache = {}
+        self._used = set()
+        self._loaded = False
+        self.stats = {"hits": 0, "misses": 0}
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path) as fd:
+                self._cache = json.load(fd)
+        except FileNotFoundError:
+            pass
+        except ValueError as ex:
+            logger.warning("the fingerprint cache %s is corrupted, starting from scratch: %s",
+                           self.cache_path, ex)
+
+    def save(self):
+        """ persist the stat cache, digests computed by other processes are preserved """
+        if not self.cache_path or not self._used:
+            return
+        try:
+            with open(self.cache_path) as fd:
+                on_disk = json.load(fd)
+        except (FileNotFoundError, ValueError):
+            on_disk = {}
+        on_disk.update({k: self._cache[k] for k in self._used})
+        if len(on_disk) > CACHE_MAX_ENTRIES:
+            on_disk = {k: self._cache[k] for k in self._used}
+        dir_path = os.path.dirname(self.cache_path)
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as fd:
+                json.dump(on_disk, fd)
+            os.replace(tmp_path, self.cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _lookup(self, path, st):
+        """ :return: digest from the cache if the file didn't change, None otherwise """
+        entry = self._cache.get(path)
+        if entry and entry[:3] == [st.st_ino, st.st_size, st.st_mtime_ns]:
+            self.stats["hits"] += 1
+            self._used.add(path)
+            return entry[3]
+        return None
+
+    def _store(self, path, st, digest):
+        self.stats["misses"] += 1
+        # time.time_ns is not available in python 3.6
+        if int(time.time() * 10 ** 9) - st.st_mtime_ns > RACY_SECONDS * 10 ** 9:
+            self._cache[path] = [st.st_ino, st.st_size, st.st_mtime_ns, digest]
+            self._used.add(path)
+
+    def _digests(self, files):
+        """
+        :param files: list of (path, os.stat_result)
+        :return: list of str, digests of content of the files
+        """
+        self._load()
+        digests = [self._lookup(path, st) for path, st in files]
+        missing = [i for i, d in enumerate(digests) if d is None]
+        if len(missing) > PARALLEL_THRESHOLD:
+            # hashlib releases the GIL, the files are read and hashed in parallel
+            with ThreadPoolExecutor() as executor:
+                computed = list(executor.map(file_digest, [files[i][0] for i in missing]))
+        else:
+            computed = [file_digest(files[i][0]) for i in missing]
+        for i, digest in zip(missing, computed):
+            path, st = files[i]
+            self._store(path, st, digest)
+            digests[i] = digest
+        return digests
+
+    def fingerprint(self, path):
+        """
+        fingerprint of a file or a directory: names, modes and content of the files
+
+        :param path: str
+        :return: str, hex digest, None if the path doesn't exist
+        """
+        path = os.path.abspath(path)
+        try:
+            # the path itself is followed if it's a symlink, just like ansible does
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if stat.S_ISDIR(st.st_mode):
+            entries = self._walk(path)
+        else:
+            entries = [("", st)]
+        sha256 = hashlib.sha256()
+        files = []
+        for relative_path, st in entries:
+            full_path = os.path.join(path, relative_path) if relative_path else path
+            sha256.update(f"{relative_path}\0{stat.S_IMODE(st.st_mode):o}\0".encode("utf-8"))
+            if stat.S_ISLNK(st.st_mode):
+                sha256.update(os.readlink(full_path).encode("utf-8"))
+            elif stat.S_ISREG(st.st_mode):
+                files.append((full_path, st))
+        for digest in self._digests(files):
+            sha256.update(digest.encode("utf-8"))
+        return sha256.hexdigest()
+
+    @staticmethod
+    def _walk(directory):
+        """
+        :return: list of (relative path, os.stat_result), sorted, without ignored paths
+        """
+        patterns = load_ignore_patterns(directory)
+        response = []
+        for root, dirs, files in os.walk(directory):
+            relative_root = os.path.relpath(root, directory)
+            if relative_root == ".":
+                relative_root = ""
+            # prune ignored directories so they are not walked at all
+            dirs[:] = sorted(d for d in dirs if not is_ignored(os.path.join(relative_root, d), patterns))
+            for name in sorted(dirs + files):
+                relative_path = os.path.join(relative_root, name)
+                if name in files and is_ignored(relative_path, patterns):
+                    continue
+                try:
+                    response.append((relative_path, os.lstat(os.path.join(root, name))))
+                except FileNotFoundError:
+                    continue
+        return response
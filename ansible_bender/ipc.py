@@ -0,0 +1,158 @@
+"""
+Communication between the callback plugin and the ab process which runs the build
+
+ansible-playbook, and hence the callback plugin, runs in a subprocess of `ab build`. Instead
+of setting up ab from scratch on every task event, the callback sends the events to a
+BuildService running in the parent process over a unix socket; the service keeps the build,
+the builder and the database in memory for the whole run and replies with decisions.
+
+The protocol is newline-delimited json:
+
+    request: {"method": "task_started", "params": {...}}
+    response: {"result": ...} or {"error": "message"}
+"""
+import json
+import logging
+import os
+import shutil
+import socket
+import socketserver
+import tempfile
+import threading
+
+from ansible_bender.exceptions import ABError
+
+logger = logging.getLogger(__name__)
+
+# environment variable with the path to the socket of the service
+IPC_SOCKET_ENV = "AB_IPC_SOCKET"
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                result = self.server.service.dispatch(request["method"], request.get("params", {}))
+                response = {"result": result}
+            except Exception as ex:
+                logger.debug("request %r failed", line, exc_info=True)
+                response = {"error": str(ex)}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class BuildService:
+    """ serve requests of the callback plugin for a single build """
+    METHODS = ("task_started", "task_finished", "abort_build")
+
+    def __init__(self, app, build):
+        """
+        :param app: instance of Application
+        :param build: instance of Build, the build in progress
+        """
+        self.app = app
+        self.build = build
+        self.address = None
+        self._tmp_dir = None
+        self._server = None
+        self._thread = None
+        # the callback is sequential, but let's be safe
+        self._lock = threading.Lock()
+
+    def dispatch(self, method, params):
+        if method not in self.METHODS:
+            raise ABError(f"Unknown method {method}")
+        with self._lock:
+            return getattr(self, method)(**params)
+
+    def task_started(self, content, tags, identity=None):
+        skip, message = self.app.task_started(self.build, content, tags, identity=identity)
+        return {"skip": skip, "message": message}
+
+    def task_finished(self, content, tags, action, failed=False, skipped=False, changed=False,
+                      duration=None, identity=None):
+        message = self.app.task_finished(self.build, content, tags, action, failed=failed,
+                                         skipped=skipped, changed=changed, duration=duration,
+                                         identity=identity)
+        return {"message": message}
+
+    def abort_build(self):
+        self.app.abort_build(self.build)
+
+    def start(self):
+        # the path of a unix socket can't be long, the runtime dir may be too deep
+        self._tmp_dir = tempfile.mkdtemp(prefix="ab-ipc-")
+        self.address = os.path.join(self._tmp_dir, "socket")
+        self._server = _Server(self.address, _RequestHandler)
+        self._server.service = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.debug("build service is listening on %s", self.address)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class BuildServiceClient:
+    """ talk to the BuildService of the parent ab process """
+
+    def __init__(self, address):
+        """
+        :param address: str, path to the unix socket of the service
+        """
+        self.address = address
+        self._sock = None
+        self._fd = None
+
+    @classmethod
+    def from_environment(cls):
+        """ :return: a client if the parent process provides the service, None otherwise """
+        address = os.environ.get(IPC_SOCKET_ENV)
+        if address:
+            return cls(address)
+        return None
+
+    def call(self, method, **params):
+        """
+        invoke the method of the service and return its result
+
+        :param method: str, see BuildService.METHODS
+        """
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(self.address)
+            self._fd = self._sock.makefile("rwb")
+        self._fd.write(json.dumps({"method": method, "params": params}).encode("utf-8") + b"\n")
+        self._fd.flush()
+        line = self._fd.readline()
+        if not line:
+            raise ABError("The build service closed the connection.")
+        response = json.loads(line)
+        if "error" in response:
+            raise ABError(response["error"])
+        return response["result"]
+
+    def close(self):
+        if self._sock is not None:
+            self._fd.close()
+            self._sock.close()
+            self._sock = None
@@ -0,0 +1,75 @@
+"""
+Commits of layers in the background
+
+With Build.pipelined_commits, the builder takes a cheap point-in-time snapshot of the working
+container once a task is done and the snapshot is committed by a worker thread while ansible
+continues with the following tasks. Commits complete in the order they were submitted and the
+results are handed back in that order, so layers are recorded just like synchronous commits.
+"""
+import collections
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+PendingCommit = collections.namedtuple("PendingCommit", ("future", "record"))
+
+
+class CommitPipeline:
+    """ commit snapshots one by one in a background thread """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ab-commit")
+        self._pending = collections.deque()
+        self._collecting = False
+
+    def __bool__(self):
+        """ are there commits which were not collected yet? """
+        return bool(self._pending)
+
+    def submit(self, commit, parent_layer_id, record):
+        """
+        queue a commit
+
+        :param commit: callable, accepts id of the parent layer and returns
+                       (str, id of the new layer, int or None, its size)
+        :param parent_layer_id: str, the top layer of the build, used unless another
+                                commit is queued: its layer is the parent then
+        :param record: callable, accepts the result of commit, it's invoked by collect
+        """
+        previous = self._pending[-1].future if self._pending else None
+
+        def run():
+            parent = previous.result()[0] if previous is not None else parent_layer_id
+            return commit(parent)
+
+        self._pending.append(PendingCommit(self._executor.submit(run), record))
+
+    def collect(self, wait=False):
+        """
+        record finished commits in the order they were submitted; an exception raised
+        by a commit is raised here
+
+        :param wait: bool, wait for all the queued commits to finish
+        """
+        if self._collecting:
+            # invoked while recording a commit: the following ones have to wait for it
+            return
+        self._collecting = True
+        try:
+            while self._pending and (wait or self._pending[0].future.done()):
+                pending = self._pending.popleft()
+                pending.record(*pending.future.result())
+        finally:
+            self._collecting = False
+
+    def close(self):
+        """ wait for the remaining commits, their results are discarded """
+        for pending in self._pending:
+            try:
+                pending.future.result()
+            except Exception as ex:
+                logger.debug("a commit in the background failed: %s", ex)
+        self._pending.clear()
+        self._executor.shutdown()
@@ -18,6 +18,7 @@ BUILD_SCHEMA = {
         "build_container",
         "cache_tasks",
         "log_lines",
+        "log_file",
         "layering",
         "squash",
         "debug",
@@ -136,7 +137,14 @@ BUILD_SCHEMA = {
         },
         "log_lines": {
             "type": "array",
-            "title": "A list of log lines"
+            "title": "A list of log lines, present only in builds recorded by older versions of ab"
+        },
+        "log_file": {
+            "type": ["string", "null"],
+            "title": "Name of the compressed file with logs of the build",
+            "examples": [
+                "logs/42.log.gz"
+            ]
         },
         "layering": {
             "type": "boolean",
@@ -409,6 +417,36 @@ PLAYBOOK_SCHEMA = {
             "type": "boolean",
             "title": "tag layers with a verbose name if true (image-name + timestamp), defaults to false",
         },
+        "detect_fs_changes": {
+            "type": "boolean",
+            "title": "When true, commit a layer only if the filesystem of the working container changed",
+        },
+        "pipelined_commits": {
+            "type": "boolean",
+            "title": "When true, commit layers in the background while the next tasks are executed",
+        },
+        "layering_policy": {
+            "type": ["object", "null"],
+            "title": "where layers are committed during the build",
+            "additionalProperties": False,
+            "properties": {
+                "granularity": {
+                    "type": "string",
+                    "enum": ["task", "block", "role", "checkpoint"],
+                    "title": "commit a layer after every task, block, role or task tagged checkpoint",
+                },
+                "min_tasks": {
+                    "type": ["integer", "null"],
+                    "minimum": 1,
+                    "title": "commit a layer only once it covers at least this many tasks",
+                },
+                "min_seconds": {
+                    "type": ["number", "null"],
+                    "minimum": 0,
+                    "title": "commit a layer only once its tasks took at least this many seconds",
+                },
+            },
+        },
         "ansible_extra_args": {
             "type": "string",
             "title": "provide extra arguments for ansible-playbook run",
@@ -0,0 +1,229 @@
+"""
+Base classes for storage backends of the database
+"""
+import fcntl
+import fnmatch
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_KEYS = ("build_id", "target_image", "state", "build_start_time", "build_finished_time")
+
+
+def summarize_build(build_data):
+    """
+    :param build_data: dict, serialized build
+    :return: dict, only the fields needed to list builds
+    """
+    return {k: build_data.get(k) for k in SUMMARY_KEYS}
+
+
+def filter_summaries(summaries, state=None, target_image=None, since=None, limit=None):
+    """
+    filter serialized build summaries, see Transaction.list_summaries
+    """
+    response = []
+    for s in sorted(summaries, key=lambda x: int(x["build_id"]), reverse=True):
+        if state is not None and s["state"] != state:
+            continue
+        if target_image is not None and not fnmatch.fnmatchcase(s["target_image"] or "", target_image):
+            continue
+        if since is not None and (s["build_start_time"] or "") < since:
+            continue
+        response.append(s)
+        if limit is not None and len(response) >= limit:
+            break
+    response.reverse()
+    return response
+
+
+def new_lock_stats():
+    """ how many times a lock was taken, how many times we had to wait and for how long """
+    return {"acquired": 0, "contended": 0, "wait_time": 0.0}
+
+
+@contextmanager
+def file_lock(path, shared=False, stats=None):
+    """
+    lock the selected file using a kernel lock (flock), the lock is released by the kernel
+    when the process dies so a crashed ab can't block the others
+
+    :param path: str, path to the lock file, it's created if it doesn't exist
+    :param shared: bool, take a shared lock: for readers, they don't block each other
+    :param stats: dict, see new_lock_stats, record the contention here
+    :return: file descriptor of the lock file
+    """
+    lock_type = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        try:
+            fcntl.flock(fd, lock_type | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # someone else has the lock, let's wait and measure how long
+            start = time.monotonic()
+            fcntl.flock(fd, lock_type)
+            waited = time.monotonic() - start
+            if stats is not None:
+                stats["contended"] += 1
+                stats["wait_time"] += waited
+            logger.debug("waited %.3f s for %s lock of %s",
+                         waited, "a shared" if shared else "an exclusive", path)
+        if stats is not None:
+            stats["acquired"] += 1
+        try:
+            yield fd
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+class Transaction:
+    """
+    A unit of work performed on top of a storage backend: everything done with a single
+    transaction is loaded once and saved once.
+    """
+
+    def get_build(self, build_id):
+        """
+        :param build_id: str
+        :return: dict with serialized build or None if there is no such build
+        """
+
+    def lock_build(self, build_id):
+        """
+        lock the build for the rest of the transaction unless it's locked already, backends
+        which lock builds must do it before the shared data are locked to avoid deadlocks
+
+        :param build_id: str
+        """
+
+    def put_build(self, build_id, build_data):
+        """
+        store serialized build
+
+        :param build_id: str
+        :param build_data: dict, output of Build.to_dict()
+        """
+
+    def delete_build(self, build_id):
+        """
+        :param build_id: str
+        :return: True if the build was deleted, False if it did not exist
+        """
+
+    def iter_builds(self):
+        """
+        :return: iterable of dicts, serialized builds
+        """
+
+    def list_summaries(self, state=None, target_image=None, since=None, limit=None):
+        """
+        provide summaries of builds without loading the builds themselves
+
+        :param state: str, value of BuildState, list only builds in this state
+        :param target_image: str, glob pattern, list only builds of matching images
+        :param since: str, timestamp in TIMESTAMP_FORMAT, list only builds started since then
+        :param limit: int, list only the latest N builds
+        :return: list of dicts (see SUMMARY_KEYS), ordered by build ID
+        """
+
+    def allocate_build_id(self):
+        """ return id for next build and increment the one in the storage """
+
+    def latest_build_id(self):
+        """ return id of the build which was allocated as the last one """
+
+    def get_layer(self, base_image_id, content):
+        """
+        :param base_image_id: str, id of the image the layer was created on top of
+        :param content: str, hash of the task which created the layer
+        :return: str, id of the layer or None
+        """
+
+    def put_layer(self, base_image_id, content, layer_id, size=None, last_hit=None, duration=None):
+        """
+        store a layer into the cache store
+
+        :param base_image_id: str, id of the image the layer was created on top of
+        :param content: str, hash of the task which created the layer
+        :param layer_id: str
+        :param size: int, how many bytes the layer adds on top of the base image
+        :param last_hit: str, timestamp in TIMESTAMP_FORMAT, when the layer was used
+        :param duration: float, how many seconds the task took
+        """
+
+    def touch_layer(self, base_image_id, content, last_hit):
+        """
+        record that a layer from the cache store was used
+
+        :param base_image_id: str
+        :param content: str
+        :param last_hit: str, timestamp in TIMESTAMP_FORMAT
+        """
+
+    def iter_layers(self):
+        """
+        :return: iterable of dicts with entries of the cache store: base_image_id, content,
+                 image_id, last_hit, size, duration
+        """
+
+    def delete_layer(self, base_image_id, content):
+        """
+        remove a layer from the cache store
+
+        :param base_image_id: str
+        :param content: str
+        :return: True if the entry was deleted, False if it did not exist
+        """
+
+    def get_python_interpreter(self, base_image_id):
+        """
+        :param base_image_id: str
+        :return: str, path to python interpreter or None
+        """
+
+    def put_python_interpreter(self, base_image_id, python_interpreter):
+        """
+        :param base_image_id: str
+        :param python_interpreter: str
+        """
+
+    def get_probe(self, key):
+        """
+        :param key: str, identifies the probe and the environment it was performed in
+        :return: str, timestamp in TIMESTAMP_FORMAT when the probe passed, None if unknown
+        """
+
+    def put_probe(self, key, passed_at):
+        """
+        :param key: str
+        :param passed_at: str, timestamp in TIMESTAMP_FORMAT
+        """
+
+
+class StorageBackend:
+    name = "default-value"
+
+    def __init__(self, runtime_dir_path):
+        """
+        :param runtime_dir_path: str, path to a directory where the data are stored
+        """
+        self.runtime_dir_path = runtime_dir_path
+        self.lock_stats = new_lock_stats()
+
+    @contextmanager
+    def transaction(self, write=False, snapshot=False):
+        """
+        load data from the storage and yield an instance of Transaction to work with them
+
+        :param write: bool, persist changes once the transaction is finished
+        :param snapshot: bool, read the current state without waiting for writers
+        """
+        yield Transaction()
+
+    def close(self):
+        """ release resources held by the backend """
@@ -0,0 +1,438 @@
+"""
+Storage backend which keeps the data in json files
+
+Every build is stored in its own file so that concurrent builds don't contend: a build
+record is locked on its own and only the data shared by all the builds (build ID
+allocation, the build summaries and the cache store) are guarded by the global lock.
+Locks are taken lazily, when the data are accessed for the first time within a transaction.
+To avoid deadlocks, a build is always locked before the shared data: a transaction which
+reads the shared data (e.g. the cache store) before it changes a build has to lock the build
+upfront, see Database.transaction(build_id=...). The only exception is a freshly allocated
+build which no one else can hold.
+
+All files are replaced atomically: readers always see a complete file and don't need to lock.
+
+
+# The schema
+
+db.json:
+{
+    "next_build_id": int  #
+    "summaries": {  # a lightweight index of builds, see SUMMARY_KEYS
+        <id>: {build_id, target_image, state, build_start_time, build_finished_time}
+    },
+    "probes": {  # when checks of the container tooling passed
+        <key>: timestamp
+    },
+}
+
+store.json:
+{
+    "base-image-id": {  # base-image + content = new image
+        content: {
+            image_id:
+            last_hit:  # when the layer was created or loaded from cache
+            size:  # bytes the layer adds on top of the base image
+            duration:  # seconds the task took
+        }
+    }
+}
+
+builds/<id>.json:
+{
+    state: ...
+    base_image: ...
+    target_image: ...
+    builder_name: ...
+    metadata: {
+        command: ...
+        user: ...
+        env: ...
+        ...
+    },
+    layers: [
+        Layer(content, layer_id, base_image_id, cached),
+    ]
+    layer_index: {
+        layer_id: layer
+    }
+}
+
+Older versions of ab stored everything in db.json, as {"next_build_id", "builds", "store"},
+such database is split into the files above on first use.
+"""
+import contextlib
+import copy
+import json
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+
+from ansible_bender.storage.base import StorageBackend, Transaction, summarize_build, \
+    filter_summaries, file_lock
+
+DEFAULT_DATA = {
+    "next_build_id": 1,
+    "summaries": {},
+}
+
+logger = logging.getLogger(__name__)
+
+
+class JsonTransaction(Transaction):
+    def __init__(self, storage, write=False, snapshot=False):
+        """
+        :param storage: instance of JsonStorage
+        :param write: bool, the changes are going to be saved
+        :param snapshot: bool, don't lock for reading
+        """
+        self.storage = storage
+        self.write = write
+        self.snapshot = snapshot
+        self.locks = contextlib.ExitStack()
+        self._data = None
+        self._store = None
+        self._global_locked = False
+        self._data_changed = False
+        self._store_changed = False
+        self._locked_builds = set()
+        # builds changed within this transaction, None if a build was deleted
+        self.changed_builds = {}
+
+    # the data may be cached in memory: builds are copied on the way in and out
+    # so that changes to Build instances don't leak into the cache
+
+    def _lock_global(self):
+        if self._global_locked or (self.snapshot and not self.write):
+            return
+        self.locks.enter_context(self.storage.lock_global(shared=not self.write))
+        self._global_locked = True
+
+    def _lock_build(self, build_id):
+        if build_id in self._locked_builds:
+            return
+        self.locks.enter_context(self.storage.lock_build(build_id))
+        self._locked_builds.add(build_id)
+
+    @property
+    def data(self):
+        """ content of db.json """
+        if self._data is None:
+            self._lock_global()
+            self._data = self.storage.load(self.storage.db_path(), DEFAULT_DATA)
+        return self._data
+
+    @property
+    def store(self):
+        """ content of store.json """
+        if self._store is None:
+            self._lock_global()
+            self._store = self.storage.load(self.storage.store_path(), {})
+        return self._store
+
+    def _change_data(self):
+        self._data_changed = True
+        return self.data
+
+    def _change_store(self):
+        self._store_changed = True
+        return self.store
+
+    def _read_build(self, build_id):
+        if build_id in self.changed_builds:
+            return self.changed_builds[build_id]
+        if self.write:
+            # read-modify-write, no one else can change the build until we are done
+            self._lock_build(build_id)
+        return self.storage.load(self.storage.build_path(build_id), None)
+
+    def get_build(self, build_id):
+        return copy.deepcopy(self._read_build(build_id))
+
+    def lock_build(self, build_id):
+        if build_id not in self._locked_builds and self._global_locked:
+            logger.warning("build %s is locked after the shared data, this may deadlock", build_id)
+        self._lock_build(build_id)
+
+    def put_build(self, build_id, build_data):
+        self._lock_build(build_id)
+        previous = self._read_build(build_id)
+        self.changed_builds[build_id] = copy.deepcopy(build_data)
+        summary = summarize_build(build_data)
+        # the shared data are touched only when the summary changes, not on every layer
+        if previous is None or summarize_build(previous) != summary:
+            self._change_data()["summaries"][build_id] = summary
+
+    def delete_build(self, build_id):
+        self._lock_build(build_id)
+        if self._read_build(build_id) is None:
+            return False
+        self.changed_builds[build_id] = None
+        self._change_data()["summaries"].pop(build_id, None)
+        return True
+
+    def iter_builds(self):
+        response = []
+        for build_id in sorted(self.storage.list_build_ids(), key=int):
+            build_data = self.get_build(build_id)
+            if build_data is not None:
+                response.append(build_data)
+        return response
+
+    def list_summaries(self, state=None, target_image=None, since=None, limit=None):
+        return [dict(s) for s in filter_summaries(
+            self.data["summaries"].values(), state=state, target_image=target_image,
+            since=since, limit=limit)]
+
+    def allocate_build_id(self):
+        data = self._change_data()
+        next_build_id = data["next_build_id"]
+        data["next_build_id"] += 1
+        if self.get_build(str(next_build_id)) is None:
+            return str(next_build_id)
+        else:
+            raise Exception(f'Database seems to be corrupted. Build {next_build_id} already exists.')
+
+    def latest_build_id(self):
+        return str(self.data["next_build_id"] - 1)
+
+    def get_layer(self, base_image_id, content):
+        try:
+            return self.store[base_image_id][content]["image_id"]
+        except KeyError:
+            return None
+
+    def put_layer(self, base_image_id, content, layer_id, size=None, last_hit=None, duration=None):
+        store = self._change_store()
+        store.setdefault(base_image_id, {})
+        store[base_image_id][content] = {"image_id": layer_id, "last_hit": last_hit, "size": size,
+                                         "duration": duration}
+
+    def touch_layer(self, base_image_id, content, last_hit):
+        try:
+            entry = self.store[base_image_id][content]
+        except KeyError:
+            return
+        self._change_store()
+        entry["last_hit"] = last_hit
+
+    def iter_layers(self):
+        for base_image_id, entries in self.store.items():
+            for content, entry in entries.items():
+                if content == "python_interpreter":
+                    continue
+                yield {
+                    "base_image_id": base_image_id,
+                    "content": content,
+                    "image_id": entry["image_id"],
+                    "last_hit": entry.get("last_hit"),
+                    "size": entry.get("size"),
+                    "duration": entry.get("duration"),
+                }
+
+    def delete_layer(self, base_image_id, content):
+        entries = self.store.get(base_image_id, {})
+        if content == "python_interpreter" or content not in entries:
+            return False
+        store = self._change_store()
+        del entries[content]
+        if not entries:
+            del store[base_image_id]
+        return True
+
+    def get_python_interpreter(self, base_image_id):
+        return self.store.get(base_image_id, {}).get("python_interpreter")
+
+    def put_python_interpreter(self, base_image_id, python_interpreter):
+        store = self._change_store()
+        store.setdefault(base_image_id, {})
+        store[base_image_id]["python_interpreter"] = python_interpreter
+
+    def get_probe(self, key):
+        return self.data.get("probes", {}).get(key)
+
+    def put_probe(self, key, passed_at):
+        self._change_data().setdefault("probes", {})[key] = passed_at
+
+    def save(self):
+        """ persist the changes: builds go first, so the shared data never point to a missing build """
+        for build_id, build_data in self.changed_builds.items():
+            if build_data is None:
+                self.storage.remove_build(build_id)
+            else:
+                self.storage.save(self.storage.build_path(build_id), build_data)
+        if self._store_changed:
+            self.storage.save(self.storage.store_path(), self.store)
+        if self._data_changed:
+            self.storage.save(self.storage.db_path(), self.data)
+
+    def discard(self):
+        """ the data might have been changed in memory, but they were not saved """
+        if self._data_changed:
+            self.storage.invalidate(self.storage.db_path())
+        if self._store_changed:
+            self.storage.invalidate(self.storage.store_path())
+
+
+class JsonStorage(StorageBackend):
+    """ Simple implementation of persistent data store for ab; json files and file locks """
+    name = "json"
+
+    def __init__(self, runtime_dir_path):
+        super().__init__(runtime_dir_path)
+        # parsed content of the files: path -> (stat key, data)
+        self._cache = {}
+        self.cache_stats = {"hits": 0, "misses": 0}
+        self._migrated = False
+
+    def db_path(self):
+        return os.path.join(self.runtime_dir_path, "db.json")
+
+    def store_path(self):
+        return os.path.join(self.runtime_dir_path, "store.json")
+
+    def builds_dir_path(self):
+        return os.path.join(self.runtime_dir_path, "builds")
+
+    def build_path(self, build_id):
+        return os.path.join(self.builds_dir_path(), f"{build_id}.json")
+
+    def list_build_ids(self):
+        try:
+            file_names = os.listdir(self.builds_dir_path())
+        except FileNotFoundError:
+            return []
+        return [x[:-len(".json")] for x in file_names if x.endswith(".json") and not x.startswith(".")]
+
+    def lock_global(self, shared=False):
+        return file_lock(os.path.join(self.runtime_dir_path, "ab.lock"), shared=shared,
+                         stats=self.lock_stats)
+
+    def lock_build(self, build_id):
+        os.makedirs(self.builds_dir_path(), mode=0o0700, exist_ok=True)
+        return file_lock(os.path.join(self.builds_dir_path(), f"{build_id}.lock"),
+                         stats=self.lock_stats)
+
+    def remove_build(self, build_id):
+        """ remove the file with the build, build's lock has to be acquired already! """
+        for path in (self.build_path(build_id), os.path.join(self.builds_dir_path(), f"{build_id}.lock")):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self.invalidate(self.build_path(build_id))
+
+    @staticmethod
+    def _stat_key(path):
+        """ identify the current version of a file, None if it doesn't exist """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def invalidate(self, path):
+        self._cache.pop(path, None)
+
+    def load(self, path, default):
+        """
+        load a json file, the parsed data are kept in memory and the file is read again
+        only when it changed
+
+        :param path: str
+        :param default: data to provide when the file doesn't exist, they are copied
+        """
+        key = self._stat_key(path)
+        cached = self._cache.get(path)
+        if key is not None and cached is not None and cached[0] == key:
+            self.cache_stats["hits"] += 1
+            return cached[1]
+        self.cache_stats["misses"] += 1
+        try:
+            with open(path, "r") as fd:
+                data = json.load(fd)
+        except FileNotFoundError:
+            self.invalidate(path)
+            return copy.deepcopy(default)
+        self._cache[path] = (key, data)
+        return data
+
+    def save(self, path, data):
+        """
+        save data to a json file, the file has to be locked already!
+
+        The data are written to a temporary file which then replaces the original: readers
+        always see a complete file, so they don't need to take the lock, and a crash
+        can't leave a half-written file behind.
+        """
+        dir_path = os.path.dirname(path)
+        os.makedirs(dir_path, mode=0o0700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as fd:
+                json.dump(data, fd, indent=2)
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        # persist the rename itself
+        dir_fd = os.open(dir_path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self._cache[path] = (self._stat_key(path), data)
+
+    def _maybe_migrate(self):
+        """ split a database created by an older version of ab into per-build files """
+        if self._migrated:
+            return
+        if "builds" in self.load(self.db_path(), DEFAULT_DATA):
+            with self.lock_global():
+                # someone could have done it in the meantime
+                old_data = self.load(self.db_path(), DEFAULT_DATA)
+                if "builds" in old_data:
+                    logger.info("moving builds from %s to %s", self.db_path(), self.builds_dir_path())
+                    for build_id, build_data in old_data["builds"].items():
+                        self.save(self.build_path(build_id), build_data)
+                    self.save(self.store_path(), old_data.get("store", {}))
+                    self.save(self.db_path(), {
+                        "next_build_id": old_data["next_build_id"],
+                        "summaries": {k: summarize_build(v) for k, v in old_data["builds"].items()},
+                    })
+        self._migrated = True
+
+    def export_data(self):
+        """
+        provide all the data in the format of the single-file database
+
+        :return: dict, {"next_build_id", "probes", "builds", "store"}
+        """
+        with self.transaction() as t:
+            return {
+                "next_build_id": t.data["next_build_id"],
+                "probes": dict(t.data.get("probes", {})),
+                "builds": {b["build_id"]: b for b in t.iter_builds()},
+                "store": copy.deepcopy(t.store),
+            }
+
+    def migrated_paths(self):
+        """ files which are no longer used once the data are migrated to a different backend """
+        return [self.db_path(), self.store_path(), self.builds_dir_path()]
+
+    @contextmanager
+    def transaction(self, write=False, snapshot=False):
+        self._maybe_migrate()
+        t = JsonTransaction(self, write=write, snapshot=snapshot)
+        with t.locks:
+            try:
+                yield t
+                if write:
+                    t.save()
+            except BaseException:
+                # a failed save leaves the changed data in memory as well
+                t.discard()
+                raise
@@ -0,0 +1,335 @@
+"""
+Storage backend which keeps the data in an SQLite database
+
+Builds, their layers and the cache store live in separate tables so that a single
+operation reads and writes only the rows it needs instead of the whole database.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from ansible_bender.storage.base import StorageBackend, Transaction, SUMMARY_KEYS
+from ansible_bender.storage.json_storage import JsonStorage
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS builds (
+    build_id TEXT PRIMARY KEY,
+    target_image TEXT,
+    state TEXT,
+    build_start_time TEXT,
+    build_finished_time TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS builds_target_image ON builds (target_image);
+CREATE INDEX IF NOT EXISTS builds_state ON builds (state);
+CREATE TABLE IF NOT EXISTS layers (
+    build_id TEXT NOT NULL REFERENCES builds (build_id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    layer_id TEXT,
+    base_image_id TEXT,
+    content TEXT,
+    cached INTEGER,
+    PRIMARY KEY (build_id, position)
+);
+CREATE TABLE IF NOT EXISTS store (
+    base_image_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    image_id TEXT,
+    last_hit TEXT,
+    size INTEGER,
+    duration REAL,
+    PRIMARY KEY (base_image_id, content)
+);
+CREATE TABLE IF NOT EXISTS base_images (
+    base_image_id TEXT PRIMARY KEY,
+    python_interpreter TEXT
+);
+CREATE TABLE IF NOT EXISTS probes (
+    key TEXT PRIMARY KEY,
+    passed_at TEXT
+);
+"""
+# columns added to existing tables after the initial release of the schema
+UPGRADES = {
+    "store": (("last_hit", "TEXT"), ("size", "INTEGER"), ("duration", "REAL")),
+}
+# these are stored in the layers table
+LAYER_KEYS = ("layers", "layer_index")
+# seconds to wait for the write lock held by another process
+BUSY_TIMEOUT = 300
+
+
+class SqliteTransaction(Transaction):
+    def __init__(self, connection):
+        """
+        :param connection: sqlite3.Connection with a transaction in progress
+        """
+        self.conn = connection
+
+    def _get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key, )).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _load_layers(self, build_id):
+        rows = self.conn.execute(
+            "SELECT content, layer_id, base_image_id, cached FROM layers "
+            "WHERE build_id = ? ORDER BY position", (build_id, ))
+        return [
+            {"content": c, "layer_id": l, "base_image_id": b, "cached": None if ca is None else bool(ca)}
+            for c, l, b, ca in rows
+        ]
+
+    def _build_from_row(self, build_id, data):
+        build_data = json.loads(data)
+        layers = self._load_layers(build_id)
+        build_data["layers"] = layers
+        build_data["layer_index"] = {x["layer_id"]: x for x in layers}
+        return build_data
+
+    def get_build(self, build_id):
+        row = self.conn.execute("SELECT data FROM builds WHERE build_id = ?", (build_id, )).fetchone()
+        if row is None:
+            return None
+        return self._build_from_row(build_id, row[0])
+
+    def put_build(self, build_id, build_data):
+        layers = build_data.get("layers", [])
+        data = {k: v for k, v in build_data.items() if k not in LAYER_KEYS}
+        # REPLACE would delete the row and its layers with it, see ON DELETE CASCADE
+        self.conn.execute(
+            "INSERT INTO builds "
+            "(build_id, target_image, state, build_start_time, build_finished_time, data) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (build_id) DO UPDATE SET target_image = excluded.target_image, "
+            "state = excluded.state, build_start_time = excluded.build_start_time, "
+            "build_finished_time = excluded.build_finished_time, data = excluded.data",
+            (build_id, data.get("target_image"), data.get("state"), data.get("build_start_time"),
+             data.get("build_finished_time"), json.dumps(data))
+        )
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO layers "
+            "(build_id, position, layer_id, base_image_id, content, cached) VALUES (?, ?, ?, ?, ?, ?)",
+            [(build_id, idx, x["layer_id"], x["base_image_id"], x["content"], x["cached"])
+             for idx, x in enumerate(layers)]
+        )
+        self.conn.execute("DELETE FROM layers WHERE build_id = ? AND position >= ?",
+                          (build_id, len(layers)))
+
+    def delete_build(self, build_id):
+        self.conn.execute("DELETE FROM layers WHERE build_id = ?", (build_id, ))
+        cur = self.conn.execute("DELETE FROM builds WHERE build_id = ?", (build_id, ))
+        return cur.rowcount > 0
+
+    def iter_builds(self):
+        rows = self.conn.execute(
+            "SELECT build_id, data FROM builds ORDER BY CAST(build_id AS INTEGER)").fetchall()
+        return [self._build_from_row(build_id, data) for build_id, data in rows]
+
+    def list_summaries(self, state=None, target_image=None, since=None, limit=None):
+        # the summary fields are columns of the builds table, the data blob is not touched
+        conditions, params = [], []
+        if state is not None:
+            conditions.append("state = ?")
+            params.append(state)
+        if target_image is not None:
+            conditions.append("target_image GLOB ?")
+            params.append(target_image)
+        if since is not None:
+            conditions.append("build_start_time >= ?")
+            params.append(since)
+        query = "SELECT %s FROM builds" % ", ".join(SUMMARY_KEYS)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY CAST(build_id AS INTEGER) DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        rows = self.conn.execute(query, params).fetchall()
+        return [dict(zip(SUMMARY_KEYS, row)) for row in reversed(rows)]
+
+    def allocate_build_id(self):
+        next_build_id = int(self._get_meta("next_build_id", 1))
+        self._set_meta("next_build_id", str(next_build_id + 1))
+        if self.get_build(str(next_build_id)) is None:
+            return str(next_build_id)
+        else:
+            raise Exception(f'Database seems to be corrupted. Build {next_build_id} already exists.')
+
+    def latest_build_id(self):
+        return str(int(self._get_meta("next_build_id", 1)) - 1)
+
+    def get_layer(self, base_image_id, content):
+        row = self.conn.execute(
+            "SELECT image_id FROM store WHERE base_image_id = ? AND content = ?",
+            (base_image_id, content)).fetchone()
+        return row[0] if row else None
+
+    def put_layer(self, base_image_id, content, layer_id, size=None, last_hit=None, duration=None):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO store (base_image_id, content, image_id, last_hit, size, duration) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (base_image_id, content, layer_id, last_hit, size, duration))
+
+    def touch_layer(self, base_image_id, content, last_hit):
+        self.conn.execute(
+            "UPDATE store SET last_hit = ? WHERE base_image_id = ? AND content = ?",
+            (last_hit, base_image_id, content))
+
+    def iter_layers(self):
+        keys = ("base_image_id", "content", "image_id", "last_hit", "size", "duration")
+        rows = self.conn.execute("SELECT %s FROM store" % ", ".join(keys)).fetchall()
+        return [dict(zip(keys, row)) for row in rows]
+
+    def delete_layer(self, base_image_id, content):
+        cur = self.conn.execute("DELETE FROM store WHERE base_image_id = ? AND content = ?",
+                                (base_image_id, content))
+        return cur.rowcount > 0
+
+    def get_python_interpreter(self, base_image_id):
+        row = self.conn.execute(
+            "SELECT python_interpreter FROM base_images WHERE base_image_id = ?",
+            (base_image_id, )).fetchone()
+        return row[0] if row else None
+
+    def put_python_interpreter(self, base_image_id, python_interpreter):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO base_images (base_image_id, python_interpreter) VALUES (?, ?)",
+            (base_image_id, python_interpreter))
+
+    def get_probe(self, key):
+        row = self.conn.execute("SELECT passed_at FROM probes WHERE key = ?", (key, )).fetchone()
+        return row[0] if row else None
+
+    def put_probe(self, key, passed_at):
+        self.conn.execute("INSERT OR REPLACE INTO probes (key, passed_at) VALUES (?, ?)",
+                          (key, passed_at))
+
+    def import_json_data(self, data):
+        """
+        import the whole content of the json database
+
+        :param data: dict, see ansible_bender.storage.json_storage for the schema
+        """
+        self._set_meta("next_build_id", str(data["next_build_id"]))
+        for key, passed_at in data.get("probes", {}).items():
+            self.put_probe(key, passed_at)
+        for build_id, build_data in data["builds"].items():
+            self.put_build(build_id, build_data)
+        for base_image_id, entries in data["store"].items():
+            for content, entry in entries.items():
+                if content == "python_interpreter":
+                    self.put_python_interpreter(base_image_id, entry)
+                else:
+                    self.put_layer(base_image_id, content, entry["image_id"],
+                                   size=entry.get("size"), last_hit=entry.get("last_hit"),
+                                   duration=entry.get("duration"))
+
+
+class SqliteStorage(StorageBackend):
+    """ SQLite database in WAL mode: readers don't block writers """
+    name = "sqlite"
+
+    def __init__(self, runtime_dir_path):
+        super().__init__(runtime_dir_path)
+        self._conn = None
+        # the connection can be shared among threads, but transactions can't
+        self._thread_lock = threading.Lock()
+
+    def db_path(self):
+        return os.path.join(self.runtime_dir_path, "db.sqlite")
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path(), timeout=BUSY_TIMEOUT, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.executescript(SCHEMA)
+            self._upgrade_schema(conn)
+            self._conn = conn
+            self._maybe_migrate()
+        return self._conn
+
+    @staticmethod
+    def _upgrade_schema(conn):
+        """ add columns which are missing in databases created by older versions of ab """
+        for table, columns in UPGRADES.items():
+            present = {row[1] for row in conn.execute("PRAGMA table_info(%s)" % table)}
+            for name, column_type in columns:
+                if name not in present:
+                    conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, name, column_type))
+
+    def _maybe_migrate(self):
+        """ one-time import of data from the json database """
+        json_storage = JsonStorage(self.runtime_dir_path)
+        with self.transaction(write=True) as t:
+            if t._get_meta("json_migrated"):
+                return
+            t._set_meta("json_migrated", "1")
+            if not os.path.exists(json_storage.db_path()):
+                return
+            logger.info("migrating data from %s to %s", json_storage.db_path(), self.db_path())
+            t.import_json_data(json_storage.export_data())
+        # keep the files around, but make it clear they are no longer used
+        for path in json_storage.migrated_paths():
+            if os.path.exists(path):
+                os.rename(path, path + ".migrated")
+
+    def _begin_immediate(self, conn):
+        """
+        IMMEDIATE: take the write lock right away so two writers don't deadlock; the
+        contention is recorded the same way file_lock does it
+        """
+        conn.execute("PRAGMA busy_timeout = 0")
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as ex:
+            if "locked" not in str(ex) and "busy" not in str(ex):
+                raise
+            # another process is writing, let's wait and measure how long
+            start = time.monotonic()
+            conn.execute("PRAGMA busy_timeout = %d" % (BUSY_TIMEOUT * 1000))
+            conn.execute("BEGIN IMMEDIATE")
+            waited = time.monotonic() - start
+            self.lock_stats["contended"] += 1
+            self.lock_stats["wait_time"] += waited
+            logger.debug("waited %.3f s for the write lock of %s", waited, self.db_path())
+        finally:
+            conn.execute("PRAGMA busy_timeout = %d" % (BUSY_TIMEOUT * 1000))
+        self.lock_stats["acquired"] += 1
+
+    @contextmanager
+    def transaction(self, write=False, snapshot=False):
+        # readers never wait for writers in WAL mode, every read is a snapshot
+        conn = self._connect()
+        with self._thread_lock:
+            if write:
+                self._begin_immediate(conn)
+            else:
+                conn.execute("BEGIN")
+            try:
+                yield SqliteTransaction(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
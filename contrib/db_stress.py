@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+"""
+Stress test of ab's database: run N simulated builds concurrently and report
+how long they took and how much time they spent waiting for locks.
+
+Every simulated build performs the same database operations as a real one
+(allocating the build, looking up and recording a layer for every task, storing
+the layers in the cache), just without buildah and ansible. The json backend
+counts its shared and exclusive file locks, the sqlite backend the write locks
+of its write transactions: its readers don't take any.
+
+    $ python3 contrib/db_stress.py --builds 32 --tasks 20 --history 5000
+"""
+import argparse
+import multiprocessing
+import tempfile
+import time
+
+from ansible_bender.builders.base import BuildState
+from ansible_bender.conf import Build, ImageMetadata
+from ansible_bender.db import Database
+
+
+def new_build(index):
+    build = Build()
+    build.playbook_path = "playbook.yaml"
+    build.base_image = "registry.example.com/base"
+    build.target_image = f"registry.example.com/stress-{index}"
+    build.metadata = ImageMetadata()
+    build.builder_name = "buildah"
+    return build
+
+
+def simulate_build(args):
+    db_path, backend, index, tasks = args
+    db = Database(db_path=db_path, backend=backend)
+    build = db.record_build(new_build(index))
+    build.record_layer(None, "base", None, cached=True)
+    db.record_build(build, build_state=BuildState.IN_PROGRESS)
+    for task in range(tasks):
+        content = f"build {index} task {task}"
+        # what the callback plugin does for every task
+        with db.transaction(write=True):
+            build = db.get_build(build.build_id)
+            base_image_id = build.get_top_layer_id()
+            if db.get_cached_layer(content, base_image_id) is None:
+                layer_id = f"layer-{index}-{task}"
+                build.record_layer(content, layer_id, base_image_id, cached=False)
+                db.record_build(build)
+                db.save_layer(layer_id, base_image_id, content)
+    db.record_build(None, build_id=build.build_id, build_state=BuildState.DONE, set_finish_time=True)
+    return db.lock_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--builds", type=int, default=multiprocessing.cpu_count(),
+                        help="how many builds run concurrently")
+    parser.add_argument("--tasks", type=int, default=20, help="how many tasks every build has")
+    parser.add_argument("--history", type=int, default=0,
+                        help="how many finished builds are in the database before the test")
+    parser.add_argument("--backend", default=None, help="database backend: json or sqlite")
+    parser.add_argument("--database-dir", default=None,
+                        help="where to put the database, a temporary directory by default")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = args.database_dir or tmp_dir
+        db = Database(db_path=db_path, backend=args.backend)
+        with db.transaction(write=True):
+            for index in range(args.history):
+                db.record_build(new_build(index), build_state=BuildState.DONE)
+        backend = db.backend.name
+
+        start = time.monotonic()
+        with multiprocessing.Pool(args.builds) as pool:
+            results = pool.map(simulate_build,
+                               [(db_path, backend, index, args.tasks) for index in range(args.builds)])
+        duration = time.monotonic() - start
+
+    acquired = sum(r["acquired"] for r in results)
+    contended = sum(r["contended"] for r in results)
+    wait_time = sum(r["wait_time"] for r in results)
+    print(f"backend:          {backend}")
+    print(f"builds x tasks:   {args.builds} x {args.tasks} ({args.history} builds in history)")
+    print(f"total time:       {duration:.2f} s")
+    print(f"locks acquired:   {acquired}")
+    print(f"locks contended:  {contended}")
+    print(f"lock wait time:   {wait_time:.2f} s in total, {wait_time / args.builds:.2f} s per build")
+
+
+if __name__ == '__main__':
+    main()
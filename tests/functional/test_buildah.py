@@ -13,7 +13,8 @@ import pytest
 from ansible_bender.builders.buildah_builder import buildah, inspect_resource, \
     podman_run_cmd
 from ..conftest import ab
-from ..spellbook import basic_playbook_path, base_image, bad_playbook_path, random_word, basic_playbook_path_w_bv
+from ..spellbook import basic_playbook_path, base_image, bad_playbook_path, random_word, basic_playbook_path_w_bv, \
+    loop_playbook_path
 
 logger = logging.getLogger("ansible_bender")
 
@@ -183,6 +184,17 @@ def test_two_runs(tmpdir, target_image):
     assert p2.returncode == 0
 
 
+def test_loop_is_committed_once(tmpdir, target_image):
+    cmd = ["build", loop_playbook_path, base_image, target_image]
+    ab(cmd, str(tmpdir))
+    ab_inspect_data = json.loads(ab(["inspect", "--json"], str(tmpdir), return_output=True))
+    # every layer which was not loaded from cache is a buildah commit: one for the loop
+    # of 50 items and one for the last task
+    commits = [x for x in ab_inspect_data["layers"] if not x["cached"]]
+    assert len(ab_inspect_data["layers"]) == 3
+    assert len(commits) == 2
+
+
 def test_buildah_err_output(tmpdir, capfd):
     cmd = ["build", basic_playbook_path, base_image, "vrerv\\23&^&4//5B/F/BSFD/B"]
     ab(cmd, str(tmpdir), ignore_result=True)
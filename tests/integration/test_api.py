@@ -24,8 +24,8 @@ def test_build_db_metadata(application, build):
     assert build.playbook_path is not None
     assert build.build_finished_time is not None
     assert build.build_start_time is not None
-    assert build.log_lines is not None
-    logs = "\n".join([l for l in build.log_lines if l])
+    assert build.log_file is not None
+    logs = "\n".join([l for l in application.get_logs(build.build_id) if l])
     assert "PLAY [registry" in logs
     assert "TASK [Gathering Facts]" in logs
     assert "failed=0" in logs
@@ -126,7 +126,7 @@ def test_backwards_compat(tmpdir):
     """
     db_dir_path = str(tmpdir)
     db = Database(db_path=db_dir_path)
-    db_path = db._db_path()
+    db_path = db.backend.db_path()
     db_content = {
         "next_build_id": 2,
         "builds": {
@@ -2,6 +2,8 @@ import os
 import random
 import string
 
+from ansible_bender.conf import Build, ImageMetadata
+
 
 tests_dir = os.path.dirname(os.path.abspath(__file__))
 project_dir = os.path.dirname(tests_dir)
@@ -25,6 +27,7 @@ playbook_with_unknown_keys = os.path.join(data_dir, "playbook_with_unknown_keys.
 playbook_wrong_type = os.path.join(data_dir, "pb_wrong_type.yaml")
 import_playbook_basic = os.path.join(data_dir, "import_playbook_basic.yaml")
 import_playbook_recursive = os.path.join(data_dir, "import_playbook_recursive.yaml")
+loop_playbook_path = os.path.join(data_dir, "loop_playbook.yaml")
 
 base_image = "quay.io/biocontainers/python:3"
 
@@ -43,3 +46,13 @@ def random_word(length):
     # https://stackoverflow.com/a/2030081/909579
     letters = string.ascii_lowercase
     return ''.join(random.choice(letters) for _ in range(length))
+
+
+def make_build(target_image="registry.example.com/db-test"):
+    build = Build()
+    build.playbook_path = "playbook.yaml"
+    build.base_image = "fedora:latest"
+    build.target_image = target_image
+    build.metadata = ImageMetadata()
+    build.builder_name = "buildah"
+    return build
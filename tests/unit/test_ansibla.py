@@ -5,7 +5,7 @@ from pathlib import Path
 import pytest
 from flexmock import flexmock
 
-from ansible_bender.core import PbVarsParser
+from ansible_bender.core import PbVarsParser, get_task_contents, get_task_plan
 from ansible_bender.exceptions import ABValidationError
 
 
@@ -49,3 +49,29 @@ def test_validation(di, error_message):
     with pytest.raises(ABValidationError) as ex:
         p.process_pb_vars(di)
     assert error_message in str(ex)
+
+
+@pytest.mark.parametrize("granularity, boundaries", (
+    ("task", [True, True, True, True]),
+    ("role", [False, True, False, True]),
+    ("checkpoint", [False, False, True, True]),
+))
+def test_task_plan(tmpdir, granularity, boundaries):
+    role_tasks = tmpdir.mkdir("roles").mkdir("web").mkdir("tasks").join("main.yml")
+    role_tasks.write("- command: echo role 1\n- command: echo role 2\n")
+    playbook_path = tmpdir.join("playbook.yaml")
+    playbook_path.write("""
+- hosts: all
+  roles:
+  - web
+  tasks:
+  - command: echo 1
+    tags: [checkpoint]
+  - command: echo 2
+    tags: [no-cache]
+""")
+    # roles come first
+    tasks = get_task_contents(str(playbook_path))
+    plan = get_task_plan(tasks, granularity)
+    assert [p["boundary"] for p in plan] == boundaries
+    assert [p["cacheable"] for p in plan] == [True, True, True, False]
@@ -1,9 +1,18 @@
+import threading
+
 import pytest
 
-from ansible_bender.core import AnsibleRunner
+from ansible_bender import api as app_module
+from ansible_bender.api import Application, get_group_digest
+from ansible_bender.builders.base import BuildState
+from ansible_bender.conf import CachePolicy, LayeringPolicy
+from ansible_bender.exceptions import ABValidationError
+from ansible_bender.pipeline import CommitPipeline
+from ansible_bender.core import AnsibleRunner, get_task_contents
 from flexmock import flexmock
 
 from ansible_bender.builders.buildah_builder import BuildahBuilder
+from tests.spellbook import make_build
 
 
 @pytest.mark.parametrize("is_base_present,times_called", (
@@ -14,6 +23,7 @@ def test_build_pulls_base_img_if_not_present(application, build, is_base_present
     build.base_image = "very-good/and-warm:mead"
 
     B = flexmock(BuildahBuilder)
+    B.should_receive("get_environment_id").and_return(None)
     B.should_receive("sanity_check").and_return(None)
     B.should_receive("is_base_image_present").and_return(is_base_present).once()
     B.should_receive("pull").times(times_called)
@@ -32,3 +42,546 @@ def test_build_pulls_base_img_if_not_present(application, build, is_base_present
     build = application.db.get_build(build.build_id)
     assert not build.pulled == is_base_present
 
+
+def test_working_container_is_created_lazily(tmpdir):
+    app = Application(db_path=str(tmpdir), init_logging=False)
+    build = make_build()
+    build.record_layer(None, "base", None, cached=True)
+    build.working_container_layer_id = "base"
+    build = app.db.record_build(build)
+    app.db.save_layer("layer-1", "base", "task-1")
+    app.db.save_layer("layer-2", "layer-1", "task-2")
+
+    builder = flexmock(is_image_present=lambda layer_id: True)
+    builder.should_receive("swap_working_container").once()
+    flexmock(app).should_receive("get_builder").and_return(builder)
+
+    # a run of cache hits doesn't touch the container
+    assert app.task_started(build, "task-1", []) == (True, "loaded from cache: 'layer-1'")
+    assert app.task_started(build, "task-2", []) == (True, "loaded from cache: 'layer-2'")
+    assert build.working_container_layer_id == "base"
+
+    # the first miss gets a container created from the last hit
+    assert app.task_started(build, "task-3", []) == (False, None)
+    assert build.working_container_layer_id == "layer-2"
+    assert app.db.get_build(build.build_id).working_container_layer_id == "layer-2"
+    app.materialize_working_container(build)
+
+
+def test_plan(tmpdir):
+    playbook_path = str(tmpdir.join("playbook.yaml"))
+    with open(playbook_path, "w") as fd:
+        fd.write("""
+- hosts: all
+  tasks:
+  - name: first
+    command: echo 1
+  - name: second
+    command: echo 2
+  - name: third
+    command: echo 3
+""")
+    app = Application(db_path=str(tmpdir), init_logging=False)
+    build = make_build()
+    build.playbook_path = playbook_path
+
+    builder = flexmock(is_base_image_present=lambda: True, get_image_id=lambda name: "base",
+                       is_image_present=lambda layer_id: layer_id != "layer-2")
+    builder.should_receive("create").never()
+    flexmock(app).should_receive("get_builder").and_return(builder)
+
+    contents = [content for _, _, content in get_task_contents(playbook_path)]
+    app.db.save_layer("layer-1", "base", contents[0], duration=10.0)
+    # the image of the layer is gone
+    app.db.save_layer("layer-2", "layer-1", contents[1], duration=20.0)
+    # timing of the task executed on top of some other image
+    app.db.save_layer("layer-x", "other", contents[2], duration=30.0)
+
+    plan = app.plan(build)
+    assert [(t["name"], t["cached"], t["layer_id"], t["duration"]) for t in plan] == [
+        ("first", True, "layer-1", 10.0),
+        ("second", False, None, 20.0),
+        ("third", False, None, 30.0),
+    ]
+
+
+@pytest.mark.parametrize("granularity", (None, "block"))
+def test_plan_predicts_the_rebuild(tmpdir, granularity):
+    playbook_path = str(tmpdir.join("playbook.yaml"))
+    playbook = """
+- hosts: all
+  tasks:
+  - block:
+    - command: echo 1
+    - command: echo 2
+  - block:
+    - command: echo 3
+    - command: echo %s
+"""
+    app = Application(db_path=str(tmpdir), init_logging=False)
+    layers = iter("layer-%d" % i for i in range(100))
+    builder = flexmock(is_base_image_present=lambda: True, get_image_id=lambda name: "base",
+                       is_image_present=lambda layer_id: True,
+                       get_layer_size=lambda layer_id, base: 1,
+                       swap_working_container=lambda: None)
+    builder.should_receive("commit").replace_with(lambda *args, **kwargs: next(layers))
+    flexmock(app).should_receive("get_builder").and_return(builder)
+
+    def new_build():
+        build = make_build()
+        build.playbook_path = playbook_path
+        if granularity:
+            build.layering_policy = LayeringPolicy(granularity=granularity)
+        return build
+
+    def run():
+        build = new_build()
+        build.record_layer(None, "base", None, cached=True)
+        build.working_container_layer_id = "base"
+        if granularity:
+            build.task_plan = app._get_task_plan(build)
+        build = app.db.record_build(build)
+        decisions = []
+        for _, identity, content in get_task_contents(playbook_path):
+            skip, _ = app.task_started(build, content, [], identity=identity)
+            app.task_finished(build, content, [], "command", skipped=skip, changed=True,
+                              duration=1.0, identity=identity)
+            decisions.append(skip)
+        return decisions
+
+    tmpdir.join("playbook.yaml").write(playbook % "4")
+    assert [t["cached"] for t in app.plan(new_build())] == [False] * 4
+    run()
+    assert [t["cached"] for t in app.plan(new_build())] == [True] * 4
+    assert run() == [True] * 4
+
+    # the last task changed
+    tmpdir.join("playbook.yaml").write(playbook % "5")
+    plan = [t["cached"] for t in app.plan(new_build())]
+    assert plan == run()
+    # a layer covers the whole block
+    assert plan == ([True, True, True, False] if granularity is None else [True, True, False, False])
+
+    if granularity:
+        # a build which commits every task doesn't look up layers of whole blocks
+        granularity = None
+        plan = [t["cached"] for t in app.plan(new_build())]
+        assert plan == run() == [False] * 4
+
+
+def test_layering_policy(tmpdir):
+    playbook_path = str(tmpdir.join("playbook.yaml"))
+    with open(playbook_path, "w") as fd:
+        fd.write("""
+- hosts: all
+  tasks:
+  - block:
+    - command: echo 1
+    - command: echo 2
+  - block:
+    - command: echo 3
+    - command: echo 4
+""")
+    app = Application(db_path=str(tmpdir), init_logging=False)
+    layers = iter("layer-%d" % i for i in range(100))
+    builder = flexmock(is_image_present=lambda layer_id: True,
+                       get_layer_size=lambda layer_id, base: 1,
+                       swap_working_container=lambda: None)
+    builder.should_receive("commit").replace_with(lambda *args, **kwargs: next(layers))
+    flexmock(app).should_receive("get_builder").and_return(builder)
+
+    def run(build):
+        build.playbook_path = playbook_path
+        build.layering_policy = LayeringPolicy(granularity="block")
+        build.record_layer(None, "base", None, cached=True)
+        build.working_container_layer_id = "base"
+        build.task_plan = app._get_task_plan(build)
+        build = app.db.record_build(build)
+        decisions = []
+        for content in [p["content"] for p in build.task_plan]:
+            skip, _ = app.task_started(build, content, [])
+            app.task_finished(build, content, [], "command", skipped=skip, changed=True, duration=1.0)
+            decisions.append(skip)
+        return build, decisions
+
+    build, decisions = run(make_build())
+    assert decisions == [False] * 4
+    # a layer for every block
+    assert [x.layer_id for x in build.layers] == ["base", "layer-0", "layer-1"]
+
+    build, decisions = run(make_build())
+    assert decisions == [True] * 4
+    assert [x.layer_id for x in build.layers] == ["base", "layer-0", "layer-1"]
+    assert all(x.cached for x in build.layers)
+    entries = {e["image_id"]: e for e in app.db.load_cache_entries()}
+    assert entries["layer-0"]["duration"] == 2.0
+
+
+def test_plan_is_resynced_after_tasks_which_did_not_run(tmpdir):
+    playbook_path = str(tmpdir.join("playbook.yaml"))
+    with open(playbook_path, "w") as fd:
+        fd.write("""
+- hosts: all
+  tasks:
+  - block:
+    - command: echo 1
+    rescue:
+    - command: echo rescue
+  - block:
+    - command: echo 2
+    - command: echo 3
+""")
+    app = Application(db_path=str(tmpdir), init_logging=False)
+    layers = iter("layer-%d" % i for i in range(100))
+    builder = flexmock(is_image_present=lambda layer_id: True,
+                       get_layer_size=lambda layer_id, base: 1)
+    builder.should_receive("commit").replace_with(lambda *args, **kwargs: next(layers))
+    flexmock(app).should_receive("get_builder").and_return(builder)
+
+    build = make_build()
+    build.playbook_path = playbook_path
+    build.layering_policy = LayeringPolicy(granularity="block")
+    build.record_layer(None, "base", None, cached=True)
+    build.working_container_layer_id = "base"
+    build.task_plan = app._get_task_plan(build)
+    build = app.db.record_build(build)
+    contents = [p["content"] for p in build.task_plan]
+    assert len(contents) == 4
+
+    # the block succeeds: the rescue task doesn't run
+    for content in contents[:1] + contents[2:]:
+        assert app.task_started(build, content, []) == (False, None)
+        app.task_finished(build, content, [], "command", changed=True, duration=1.0)
+    assert build.plan_position == 4
+    # the first block still gets its own layer
+    assert [x.layer_id for x in build.layers] == ["base", "layer-0", "layer-1"]
+
+
+def test_tasks_using_facts_are_matched_by_identity(tmpdir):
+    playbook_path = str(tmpdir.join("playbook.yaml"))
+    with open(playbook_path, "w") as fd:
+        fd.write("""
+- hosts: all
+  tasks:
+  - block:
+    - command: echo 1
+      register: result
+    - command: echo {{ result.rc }} {{ ansible_facts.os_family }}
+  - block:
+    - command: echo 3
+""")
+    app = Application(db_path=str(tmpdir), init_logging=False)
+    layers = iter("layer-%d" % i for i in range(100))
+    builder = flexmock(is_image_present=lambda layer_id: True,
+                       get_layer_size=lambda layer_id, base: 1)
+    builder.should_receive("commit").replace_with(lambda *args, **kwargs: next(layers))
+    flexmock(app).should_receive("get_builder").and_return(builder)
+
+    build = make_build()
+    build.playbook_path = playbook_path
+    build.layering_policy = LayeringPolicy(granularity="block")
+    build.record_layer(None, "base", None, cached=True)
+    build.working_container_layer_id = "base"
+    build.task_plan = app._get_task_plan(build)
+    build = app.db.record_build(build)
+    # the facts and the registered result are not known before the task runs
+    assert [p["content"] is None for p in build.task_plan] == [False, True, False]
+
+    runtime_contents = [build.task_plan[0]["content"], "echo-debian-0", build.task_plan[2]["content"]]
+    for planned, content in zip(build.task_plan, runtime_contents):
+        assert app.task_started(build, content, [], identity=planned["identity"]) == (False, None)
+        app.task_finished(build, content, [], "command", changed=True, duration=1.0,
+                          identity=planned["identity"])
+    # a layer for every block
+    assert [x.layer_id for x in build.layers] == ["base", "layer-0", "layer-1"]
+    # the layer is keyed by the contents the tasks had when they ran
+    assert app.get_layer(get_group_digest(runtime_contents[:2]), "base") == "layer-0"
+
+
+def test_layering_policy_thresholds():
+    policy = LayeringPolicy(granularity="role", min_tasks=3, min_seconds=60)
+    assert not policy.is_default()
+    assert not policy.should_commit(2, 10.0)
+    assert policy.should_commit(3, 10.0)
+    assert policy.should_commit(1, 60.0)
+    assert LayeringPolicy.from_json(policy.to_dict()).to_dict() == policy.to_dict()
+    assert LayeringPolicy().should_commit(1, 0.0)
+    with pytest.raises(ABValidationError):
+        LayeringPolicy(granularity="play")
+
+
+def test_unchanged_task_reuses_parent_layer(tmpdir):
+    app = Application(db_path=str(tmpdir), init_logging=False)
+    build = make_build()
+    build.record_layer(None, "base", None, cached=True)
+    build = app.db.record_build(build)
+    builder = flexmock(is_image_present=lambda layer_id: True, get_layer_size=lambda layer_id, base: 1)
+    builder.should_receive("commit").and_return("layer-1").once()
+    flexmock(app).should_receive("get_builder").and_return(builder)
+
+    assert app.task_finished(build, "idempotent", [], "package") == "nothing changed, reusing layer 'base'"
+    app.task_finished(build, "changing", [], "command", changed=True)
+    assert [(x.content, x.layer_id) for x in build.layers] == [
+        (None, "base"), ("idempotent", "base"), ("changing", "layer-1"),
+    ]
+    entries = {e["content"]: e for e in app.db.load_cache_entries()}
+    assert entries["idempotent"]["image_id"] == entries["idempotent"]["base_image_id"] == "base"
+    assert entries["idempotent"]["size"] == 0
+    # the next build loads both from cache
+    assert app.get_layer("idempotent", "base") == "base"
+    assert app.get_layer("changing", "base") == "layer-1"
+
+    # evicting the entry of the unchanged task must not remove its parent image
+    flexmock(BuildahBuilder).should_receive("remove_image").with_args("layer-1").and_return(True).once()
+    flexmock(app_module).should_receive("get_builder").and_return(BuildahBuilder)
+    removed = app.prune_cache(CachePolicy(max_entries_per_base=0))
+    assert {e["content"] for e in removed} == {"idempotent", "changing"}
+
+
+def test_fs_changes_override_reported_status(tmpdir):
+    app = Application(db_path=str(tmpdir), init_logging=False)
+    build = make_build()
+    build.detect_fs_changes = True
+    build.record_layer(None, "base", None, cached=True)
+    build = app.db.record_build(build)
+    builder = flexmock(is_image_present=lambda layer_id: True, get_layer_size=lambda layer_id, base: 1)
+    builder.should_receive("get_fs_changes").and_return((False, 0)).and_return((True, 10))
+    builder.should_receive("commit").and_return("layer-1").once()
+    flexmock(app).should_receive("get_builder").and_return(builder)
+
+    # reported as changed but nothing was written: reuse the parent
+    app.task_finished(build, "restart", [], "service", changed=True)
+    # reported as unchanged but a file was written: commit
+    app.task_finished(build, "sloppy", [], "shell", changed=False)
+    assert [(x.content, x.layer_id) for x in build.layers] == [
+        (None, "base"), ("restart", "base"), ("sloppy", "layer-1"),
+    ]
+
+
+@pytest.mark.parametrize("fail_final_commit", (False, True))
+def test_build_fails_when_a_commit_fails(tmpdir, fail_final_commit):
+    app = Application(db_path=str(tmpdir), init_logging=False)
+    build = make_build()
+    build.playbook_path = str(tmpdir.join("playbook.yaml"))
+    tmpdir.join("playbook.yaml").write("[]")
+    build.pipelined_commits = True
+    committed = []
+
+    def commit(image_name, print_output=True):
+        committed.append(image_name)
+        return image_name + "-id"
+
+    def commit_metadata(layer_id, image_name):
+        raise RuntimeError("no space left on device")
+
+    builder = flexmock(create=lambda: None, clean=lambda: None, commit=commit, commit_timings=[],
+                       commit_metadata=commit_metadata)
+    flexmock(app).should_receive("get_builder").and_return(builder)
+    flexmock(app).should_receive("_preflight").and_return("base")
+    pruned = []
+    flexmock(app).should_receive("prune_builds").replace_with(lambda **kwargs: pruned.append("builds"))
+    flexmock(app).should_receive("prune_cache").replace_with(lambda: pruned.append("cache"))
+
+    def run_playbook(*args, **kwargs):
+        if not fail_final_commit:
+            def failed_commit(parent_layer_id):
+                raise RuntimeError("the snapshot is gone")
+            app._get_commit_pipeline(build).submit(failed_commit, "base", lambda *x: None)
+        return "PLAY RECAP"
+
+    flexmock(AnsibleRunner).should_receive("build").replace_with(run_playbook).once()
+
+    with pytest.raises(RuntimeError, match="space left|snapshot is gone"):
+        app.build(build)
+    build = app.db.get_build(build.build_id)
+    assert build.state == BuildState.FAILED
+    assert build.build_finished_time
+    assert len(committed) == 1 and committed[0].endswith("-failed")
+    assert build.final_layer_id == committed[0] + "-id"
+    assert list(app.get_logs(build.build_id)) == ["PLAY RECAP"]
+    # the failure is being investigated and the next attempt needs the layers
+    assert pruned == []
+
+
+def test_logs_of_a_successful_build(tmpdir):
+    app = Application(db_path=str(tmpdir), init_logging=False)
+    build = make_build()
+    build.playbook_path = str(tmpdir.join("playbook.yaml"))
+    tmpdir.join("playbook.yaml").write("[]")
+    builder = flexmock(create=lambda: None, clean=lambda: None, commit_timings=[],
+                       commit_metadata=lambda layer_id, image_name: "final")
+    flexmock(app).should_receive("get_builder").and_return(builder)
+    flexmock(app).should_receive("_preflight").and_return("base")
+    pruned = []
+    flexmock(app).should_receive("prune_builds").replace_with(lambda **kwargs: pruned.append("builds"))
+    flexmock(app).should_receive("prune_cache").replace_with(lambda: pruned.append("cache"))
+    flexmock(AnsibleRunner).should_receive("build").and_return("PLAY [all]\nPLAY RECAP").once()
+
+    app.build(build)
+    build = app.db.get_build(build.build_id)
+    assert build.state == BuildState.DONE
+    assert build.final_layer_id == "final"
+    assert list(app.get_logs(build.build_id)) == ["PLAY [all]", "PLAY RECAP"]
+    assert pruned == ["builds", "cache"]
+
+
+def test_pipelined_commits(tmpdir):
+    app = Application(db_path=str(tmpdir), init_logging=False)
+    build = make_build()
+    build.pipelined_commits = True
+    build.record_layer(None, "base", None, cached=True)
+    build = app.db.record_build(build)
+    # Application.build sets it up
+    app._commit_pipelines[build.build_id] = CommitPipeline()
+    released = threading.Event()
+    snapshots = iter(["snap-1", "snap-2", "snap-3"])
+
+    def commit_snapshot(snapshot, image_name):
+        assert released.wait(5)
+        if snapshot == "snap-3":
+            raise RuntimeError("no space left on device")
+        return snapshot.replace("snap", "layer")
+
+    builder = flexmock(snapshot=lambda: next(snapshots), commit_snapshot=commit_snapshot,
+                       is_image_present=lambda layer_id: True,
+                       get_layer_size=lambda layer_id, base: len(base))
+    flexmock(app).should_receive("get_builder").and_return(builder)
+
+    # ansible doesn't wait for the commits
+    app.task_finished(build, "first", [], "command", changed=True)
+    app.task_finished(build, "second", [], "command", changed=True)
+    # nor for the commits when a task didn't change anything
+    assert app.task_finished(build, "unchanged", [], "command") == \
+        "nothing changed, reusing the parent layer"
+    assert [x.layer_id for x in build.layers] == ["base"]
+    # the cache can't be consulted on top of a layer which is being committed
+    assert app.task_started(build, "third", []) == (False, None)
+
+    released.set()
+    app.collect_commits(build, wait=True)
+    assert [(x.content, x.layer_id, x.base_image_id) for x in build.layers] == [
+        (None, "base", None), ("first", "layer-1", "base"), ("second", "layer-2", "layer-1"),
+        ("unchanged", "layer-2", "layer-2"),
+    ]
+    assert build.working_container_layer_id == "layer-2"
+    entries = {e["content"]: e for e in app.db.load_cache_entries()}
+    assert entries["second"]["size"] == len("layer-1")
+    assert app.db.get_build(build.build_id).layers[-1].layer_id == "layer-2"
+
+    app.task_finished(build, "third", [], "command", changed=True)
+    with pytest.raises(RuntimeError, match="no space left"):
+        app.collect_commits(build, wait=True)
+
+    # without IPC, the callback plugin creates an application for every task: nothing
+    # would collect the commits, so they are synchronous
+    fallback = Application(db_path=str(tmpdir), init_logging=False)
+    builder.should_receive("snapshot").never()
+    builder.should_receive("commit").and_return("layer-4").once()
+    flexmock(fallback).should_receive("get_builder").and_return(builder)
+    fallback.task_finished(build, "fourth", [], "command", changed=True)
+    assert build.layers[-1].layer_id == "layer-4"
+
+
+def test_preflight_probes_are_cached(tmpdir):
+    app = Application(db_path=str(tmpdir), init_logging=False)
+
+    def preflight(environment_id, checks, lookups=0):
+        build = app.db.record_build(make_build())
+        builder = flexmock(get_environment_id=lambda: environment_id, is_base_image_present=lambda: True,
+                           get_image_id=lambda name: "base")
+        builder.should_receive("sanity_check").times(checks)
+        builder.should_receive("check_container_creation").times(checks)
+        builder.should_receive("find_python_interpreter").and_return("/usr/bin/python3").times(lookups)
+        assert app._preflight(build, builder) == "base"
+        assert build.python_interpreter == "/usr/bin/python3"
+
+    preflight("buildah 1.30.0, podman 4.5.0", 1, lookups=1)
+    # the same tools and base image: no container is started
+    preflight("buildah 1.30.0, podman 4.5.0", 0)
+    preflight("buildah 1.31.0, podman 4.5.0", 1)
+    # the builder doesn't support caching of the probes
+    preflight(None, 1)
+
+
+def test_final_image_is_created_from_the_top_layer(tmpdir):
+    app = Application(db_path=str(tmpdir), init_logging=False)
+    build = make_build()
+    build.record_layer(None, "base", None, cached=True)
+    build.working_container_layer_id = "base"
+    build = app.db.record_build(build)
+    fs_changes = []
+    builder = flexmock(commit=lambda image_name, print_output=True: "layer-1",
+                       get_layer_size=lambda layer_id, base: None,
+                       get_fs_changes=lambda: fs_changes[-1] if fs_changes else None)
+    flexmock(app).should_receive("get_builder").and_return(builder)
+
+    def final_image(expected_method):
+        other = "commit" if expected_method == "commit_metadata" else "commit_metadata"
+        builder.should_receive(other).never()
+        builder.should_receive(expected_method).and_return("final").once()
+        assert app._commit_final_image(build, builder) == "final"
+
+    # the last task which ran was committed
+    app.task_finished(build, "first", [], "command", changed=True)
+    assert not build.working_container_dirty
+    final_image("commit_metadata")
+
+    # a task which reported no change reused layer-1, its changes are not in any layer
+    app.task_finished(build, "second", [], "command", changed=False)
+    assert build.get_top_layer_id() == "layer-1"
+    assert app.db.get_build(build.build_id).working_container_dirty
+    # the filesystem is not scanned
+    final_image("commit")
+    # the scan proves that nothing changed
+    fs_changes.append((False, 0))
+    final_image("commit_metadata")
+
+    # changes done by a task whose failure was ignored are not in any layer
+    app.task_finished(build, "third", [], "command", failed=True)
+    fs_changes.append((True, 5))
+    final_image("commit")
+
+
+def test_builder_is_reused_for_the_build(tmpdir):
+    app = Application(db_path=str(tmpdir), init_logging=False)
+    build = app.db.record_build(make_build())
+    flexmock(app_module).should_receive("get_builder") \
+        .and_return(lambda b, debug=False: flexmock(build=b)).once()
+    builder = app.get_builder(build)
+    reloaded = app.db.get_build(build.build_id)
+    assert app.get_builder(reloaded) is builder
+    assert builder.build is reloaded
+
+
+def test_build_is_locked_before_the_cache_store(tmpdir):
+    app = Application(db_path=str(tmpdir), init_logging=False, db_backend="json")
+    build = make_build()
+    build.record_layer(None, "base", None, cached=True)
+    build = app.db.record_build(build)
+    app.db.save_layer("layer-1", "base", "content")
+
+    def is_image_present(layer_id):
+        # buildah is not invoked while the database is locked
+        assert getattr(app.db._local, "transaction", None) is None
+        order.append("buildah")
+        return True
+
+    flexmock(app).should_receive("get_builder").and_return(flexmock(is_image_present=is_image_present))
+
+    backend = app.db.backend
+    order = []
+    lock_global, lock_build = backend.lock_global, backend.lock_build
+    flexmock(backend, lock_global=lambda shared=False: order.append(
+                 "shared" if shared else "global") or lock_global(shared),
+             lock_build=lambda build_id: order.append(build_id) or lock_build(build_id))
+    assert app.maybe_load_from_cache("content", build) == "layer-1"
+    # the lookup, the check of the image and then a short write transaction; the build
+    # is locked first, the other way around, the process would deadlock with one which
+    # changes the build and then the shared data
+    assert order == ["shared", "buildah", build.build_id, "global"]
+
+    # the entry was evicted while buildah was running
+    order.clear()
+    flexmock(app.db).should_receive("get_cached_layer").and_return("layer-1").and_return(None)
+    assert app.maybe_load_from_cache("content", build) is None
+    assert [x.layer_id for x in app.db.get_build(build.build_id).layers] == ["base", "layer-1"]
@@ -1,8 +1,12 @@
 import json
+import os
+import subprocess
+
+import pytest
 
 from ansible_bender.builders import buildah_builder
 from ansible_bender.builders.buildah_builder import BuildahBuilder, get_buildah_image_id
-from ansible_bender.conf import Build
+from ansible_bender.conf import Build, ImageMetadata
 from flexmock import flexmock
 
 from tests.spellbook import base_image, buildah_inspect_data_path
@@ -18,6 +22,16 @@ def test_buildah_id():
     mock_inspect()
     assert get_buildah_image_id("this-is-mocked") == "6aed6d59a707a7040ad25063eafd3a2165961a2c9f4d1d06ed0a73bdf2a89322"
 
+
+def test_python_interpreter_is_probed_in_a_single_container():
+    build = Build()
+    build.base_image = base_image
+    flexmock(buildah_builder, buildah_command_exists=lambda: None, podman_command_exists=lambda: None)
+    b = BuildahBuilder(build)
+    flexmock(buildah_builder).should_receive("podman_run_cmd").and_return("/usr/local/bin/python3\n").once()
+    assert b.find_python_interpreter() == "/usr/local/bin/python3"
+
+
 def test_extra():
     build = Build()
     build.base_image = base_image
@@ -26,3 +40,186 @@ def test_extra():
     b = BuildahBuilder(build, debug=True)
     assert b.podman_run_args == ["--network=host", "-e=FOO=BAR"]
     assert b.buildah_run_args == ["--hostname=foo"]
+
+
+def test_overlay_upper_dir(tmpdir):
+    mountinfo = tmpdir.join("mountinfo")
+    mountinfo.write(
+        "22 1 0:21 / / rw,relatime shared:1 - ext4 /dev/vda1 rw\n"
+        "310 22 0:57 / /var/lib/containers/storage/overlay/abc/merged rw,nodev,relatime - overlay overlay "
+        "rw,lowerdir=/var/lib/containers/storage/overlay/l/X,"
+        "upperdir=/var/lib/containers/storage/overlay/abc/diff,"
+        "workdir=/var/lib/containers/storage/overlay/abc/work\n"
+    )
+    assert buildah_builder.get_overlay_upper_dir(
+        "/var/lib/containers/storage/overlay/abc/merged", str(mountinfo)
+    ) == "/var/lib/containers/storage/overlay/abc/diff"
+    assert buildah_builder.get_overlay_upper_dir("/", str(mountinfo)) is None
+
+
+def test_upper_dir_changes(tmpdir):
+    upper = tmpdir.mkdir("diff")
+    upper.mkdir("etc").join("motd").write("hello")
+    before = buildah_builder.scan_upper_dir(str(upper))
+    assert before.keys() == {"etc", os.path.join("etc", "motd")}
+
+    # the first temporary file of ansible copies /tmp up: a new directory, no data
+    upper.mkdir("tmp").join(".ansible-tmp").write("x")
+    upper.join("tmp").join(".ansible-tmp").remove()
+    after = buildah_builder.scan_upper_dir(str(upper))
+    assert buildah_builder.diff_upper_dir_states(before, after) == (True, 0)
+
+    # later temporary files touch only the mtime of the directory
+    before = after
+    upper.join("tmp").join(".ansible-tmp").write("x")
+    upper.join("tmp").join(".ansible-tmp").remove()
+    after = buildah_builder.scan_upper_dir(str(upper))
+    assert buildah_builder.diff_upper_dir_states(before, after) == (False, 0)
+
+    # only regular files count to the size: len("127.0.0.1")
+    upper.join("etc").join("hosts").write("127.0.0.1")
+    after = buildah_builder.scan_upper_dir(str(upper))
+    assert buildah_builder.diff_upper_dir_states(before, after) == (True, 9)
+
+    upper.join("etc").join("motd").remove()
+    assert buildah_builder.diff_upper_dir_states(
+        after, buildah_builder.scan_upper_dir(str(upper))) == (True, 0)
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="changing the owner of a file requires root")
+def test_upper_dir_ownership_changes(tmpdir):
+    upper = tmpdir.mkdir("diff")
+    motd = upper.mkdir("etc").join("motd")
+    motd.write("hello")
+    before = buildah_builder.scan_upper_dir(str(upper))
+    # only the owner changes, not the content nor the mtime; the whole file is in the layer
+    os.chown(str(motd), 1000, 1000)
+    after = buildah_builder.scan_upper_dir(str(upper))
+    assert buildah_builder.diff_upper_dir_states(before, after) == (True, 5)
+
+    before = after
+    os.chown(str(upper.join("etc")), 1000, 1000)
+    after = buildah_builder.scan_upper_dir(str(upper))
+    assert buildah_builder.diff_upper_dir_states(before, after) == (True, 0)
+
+
+def test_commit_fast_path():
+    build = Build()
+    build.base_image = base_image
+    build.metadata = ImageMetadata()
+    build.metadata.cmd = ["ls"]
+    flexmock(buildah_builder, buildah_command_exists=lambda: None, podman_command_exists=lambda: None)
+    b = BuildahBuilder(build)
+    b.ansible_host = "cont"
+    # the version is asked only once per process
+    buildah_builder.get_buildah_version.cache_clear()
+    flexmock(buildah_builder).should_receive("run_cmd").and_return("Version:  1.11.3\n").once()
+    # the configuration doesn't change between the commits
+    flexmock(buildah_builder).should_receive("configure_buildah_container").once()
+    commits = []
+
+    def commit(cmd, args, **kwargs):
+        iidfile = args.index("--iidfile") + 1
+        with open(args[iidfile], "w") as fd:
+            fd.write(args[-1] + "-id")
+        commits.append(args[:iidfile] + args[iidfile + 1:])
+
+    flexmock(buildah_builder, buildah=commit)
+    flexmock(b, _scan_fs=lambda: None)
+
+    assert b.commit("layer-1") == "layer-1-id"
+    assert b.commit("layer-2") == "layer-2-id"
+    assert b.commit("final", final_image=True) == "final-id"
+    assert b.get_buildah_version() == (1, 11, 3)
+    assert b.get_buildah_version() == (1, 11, 3)
+    buildah_builder.get_buildah_version.cache_clear()
+
+    assert commits == [
+        buildah_builder.INTERMEDIATE_COMMIT_ARGS + ["--iidfile", "cont", "layer-1"],
+        buildah_builder.INTERMEDIATE_COMMIT_ARGS + ["--iidfile", "cont", "layer-2"],
+        ["--iidfile", "cont", "final"],
+    ]
+    assert [x["image"] for x in b.commit_timings] == ["layer-1", "layer-2", "final"]
+    assert [x["final"] for x in b.commit_timings] == [False, False, True]
+
+
+def test_image_index():
+    images = [
+        {"id": "a" * 64, "names": ["docker.io/library/fedora:latest"]},
+        {"id": "b" * 64, "names": ["localhost/layer:latest", "quay.io/me/layer:1"]},
+        {"id": "c" * 64, "names": None},
+    ]
+    flexmock(buildah_builder).should_receive("run_cmd").and_return(json.dumps(images)).once()
+    flexmock(buildah_builder).should_receive("does_image_exist").never()
+    build = Build()
+    build.base_image = base_image
+    flexmock(buildah_builder, buildah_command_exists=lambda: None, podman_command_exists=lambda: None)
+    b = BuildahBuilder(build)
+
+    assert b.get_image_id("fedora") == "a" * 64
+    assert b.get_image_id("docker.io/library/fedora") == "a" * 64
+    assert b.get_image_id("layer") == "b" * 64
+    assert b.get_image_id("me/layer:1") == "b" * 64
+    assert b.is_image_present("c" * 64)
+    assert b.is_image_present("sha256:" + "c" * 12)
+
+    buildah_builder.image_index.add("sha256:" + "d" * 64)
+    assert b.is_image_present("d" * 64)
+    flexmock(buildah_builder).should_receive("remove_buildah_image").once()
+    assert b.remove_image("d" * 64)
+    flexmock(buildah_builder).should_receive("does_image_exist") \
+        .and_raise(subprocess.CalledProcessError(1, "buildah inspect")).once()
+    assert not b.is_image_present("d" * 64)
+
+
+def test_fs_is_scanned_once_per_task():
+    build = Build()
+    build.base_image = base_image
+    flexmock(buildah_builder, buildah_command_exists=lambda: None, podman_command_exists=lambda: None)
+    b = BuildahBuilder(build)
+    b._fs_state = {}
+    flexmock(b, _commit_container=lambda *args, **kwargs: "layer-id")
+    flexmock(b).should_receive("_scan_fs").and_return({"etc": (0o40755, 0, 0, 0)}).once()
+
+    assert b.get_fs_changes() == (True, 0)
+    assert b.commit("layer") == "layer-id"
+    # the scan of the task is the baseline of the next one
+    assert b._fs_state == {"etc": (0o40755, 0, 0, 0)}
+
+
+def test_image_index_follows_recommitted_names():
+    images = [
+        {"id": "a" * 64, "names": ["localhost/my-image:latest"]},
+        {"id": "b" * 64, "names": ["docker.io/library/fedora:latest"]},
+    ]
+    flexmock(buildah_builder).should_receive("run_cmd").and_return(json.dumps(images)).once()
+    build = Build()
+    build.base_image = base_image
+    build.metadata = ImageMetadata()
+    flexmock(buildah_builder, buildah_command_exists=lambda: None, podman_command_exists=lambda: None)
+    b = BuildahBuilder(build)
+    b.ansible_host = "cont"
+    assert b.get_image_id("my-image") == "a" * 64
+
+    def commit(cmd, args, **kwargs):
+        with open(args[args.index("--iidfile") + 1], "w") as fd:
+            fd.write("sha256:" + "c" * 64)
+
+    flexmock(buildah_builder, buildah=commit, configure_buildah_container=lambda *a, **kw: None)
+    flexmock(b, _scan_fs=lambda: None)
+    assert b.commit("my-image", final_image=True) == "c" * 64
+    # the name was moved to the new image
+    assert b.get_image_id("my-image") == "c" * 64
+    assert b.get_image_id("fedora") == "b" * 64
+    assert b.is_image_present("a" * 64)
+
+    # a concurrent prune removed the layer which the index still knows about
+    b.build.layers = []
+    flexmock(b.build, get_top_layer_id=lambda: "a" * 64)
+    flexmock(buildah_builder).should_receive("create_buildah_container") \
+        .and_raise(subprocess.CalledProcessError(1, "buildah from")).once()
+    flexmock(buildah_builder).should_receive("run_cmd").and_return(json.dumps(images[1:])).once()
+    flexmock(buildah_builder).should_receive("does_image_exist") \
+        .and_raise(subprocess.CalledProcessError(1, "buildah inspect")).once()
+    with pytest.raises(RuntimeError, match="removed"):
+        b.create()
@@ -1,6 +1,9 @@
+import argparse
+import datetime
+
 import pytest
 
-from ansible_bender.cli import split_once_or_fail_with
+from ansible_bender.cli import parse_since, split_once_or_fail_with
 
 
 def test_split_once():
@@ -8,3 +11,15 @@ def test_split_once():
     with pytest.raises(RuntimeError, match=secret):
         split_once_or_fail_with("a-a-a", "=", secret)
     assert ("a", "a") == split_once_or_fail_with("a=a", "=", secret)
+
+
+@pytest.mark.parametrize("value,expected", (
+    ("2019-01-31", datetime.datetime(2019, 1, 31)),
+    ("2019-01-31T12:00", datetime.datetime(2019, 1, 31, 12)),
+    ("2019-01-31 12:00:05", datetime.datetime(2019, 1, 31, 12, 0, 5)),
+    ("2019-01-31T12:00:05.5", datetime.datetime(2019, 1, 31, 12, 0, 5, 500000)),
+))
+def test_parse_since(value, expected):
+    assert parse_since(value) == expected
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_since("yesterday")
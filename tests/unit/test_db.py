@@ -0,0 +1,434 @@
+"""
+Tests for the database and its storage backends
+"""
+import datetime
+import json
+import os
+import threading
+
+import pytest
+
+from ansible_bender.builders.base import BuildState
+from ansible_bender.conf import BuildSummary, CachePolicy, RetentionPolicy
+from ansible_bender.db import Database
+from tests.spellbook import make_build
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def db(tmpdir, request):
+    return Database(db_path=str(tmpdir), backend=request.param)
+
+
+def test_record_and_get_build(db):
+    build = db.record_build(make_build())
+    assert build.build_id == "1"
+    build.record_layer(None, "base", None, cached=True)
+    build.record_layer("content", "layer-1", "base", cached=False)
+    db.record_build(build, build_state=BuildState.IN_PROGRESS)
+
+    loaded = db.get_build("1")
+    assert loaded.state == BuildState.IN_PROGRESS
+    assert [x.layer_id for x in loaded.layers] == ["base", "layer-1"]
+    assert loaded.layer_index["layer-1"].base_image_id == "base"
+    assert db.get_latest_build().build_id == "1"
+
+    db.record_build(make_build())
+    assert db.get_latest_build().build_id == "2"
+    assert [b.build_id for b in db.load_builds()] == ["1", "2"]
+
+    db.delete_build("1")
+    with pytest.raises(RuntimeError):
+        db.get_build("1")
+    with pytest.raises(RuntimeError):
+        db.delete_build("1")
+
+
+def test_cache_store(db):
+    assert db.get_cached_layer("content", "base") is None
+    db.save_layer("layer-1", "base", "content")
+    assert db.get_cached_layer("content", "base") == "layer-1"
+    assert db.get_cached_layer("content", "other-base") is None
+
+    assert db.load_python_interpreter("base") is None
+    db.record_python_interpreter("base", "/usr/bin/python3")
+    assert db.load_python_interpreter("base") == "/usr/bin/python3"
+    # the interpreter entry must not clash with cached layers
+    assert db.get_cached_layer("content", "base") == "layer-1"
+
+
+def test_probes(db):
+    assert not db.is_probe_fresh("buildah 1.30.0", 60)
+    db.record_probe("buildah 1.30.0")
+    assert db.is_probe_fresh("buildah 1.30.0", 60)
+    assert not db.is_probe_fresh("buildah 1.31.0", 60)
+    assert not db.is_probe_fresh("buildah 1.30.0", -1)
+
+
+def test_sqlite_migration(tmpdir):
+    json_db = Database(db_path=str(tmpdir), backend="json")
+    build = make_build()
+    build.record_layer(None, "base", None, cached=True)
+    json_db.record_build(build)
+    json_db.save_layer("layer-1", "base", "content")
+    json_db.record_python_interpreter("base", "/usr/bin/python3")
+
+    sqlite_db = Database(db_path=str(tmpdir), backend="sqlite")
+    assert sqlite_db.get_build("1").layers[0].layer_id == "base"
+    assert sqlite_db.get_cached_layer("content", "base") == "layer-1"
+    assert sqlite_db.load_python_interpreter("base") == "/usr/bin/python3"
+    assert sqlite_db.record_build(make_build()).build_id == "2"
+
+    json_path = os.path.join(sqlite_db.runtime_dir_path, "db.json")
+    assert not os.path.exists(json_path)
+    with open(json_path + ".migrated") as fd:
+        assert json.load(fd)["next_build_id"] == 2
+
+    # once migrated, sqlite is picked automatically
+    assert Database(db_path=str(tmpdir)).backend.name == "sqlite"
+    # and the json backend doesn't pretend the data are gone
+    with pytest.raises(RuntimeError, match="were migrated to the sqlite backend"):
+        Database(db_path=str(tmpdir), backend="json")
+
+    # an update of a build keeps its rows in the layers table
+    conn = sqlite_db.backend._connect()
+    conn.execute("CREATE TEMP TRIGGER no_layer_deletes BEFORE DELETE ON layers "
+                 "BEGIN SELECT RAISE(ABORT, 'layers deleted'); END")
+    build = sqlite_db.get_build("1")
+    build.target_image = "renamed"
+    sqlite_db.record_build(build)
+    assert sqlite_db.get_build("1").target_image == "renamed"
+
+
+def test_unknown_backend(tmpdir):
+    with pytest.raises(RuntimeError, match="No such database backend"):
+        Database(db_path=str(tmpdir), backend="nope")
+
+
+def test_lock_contention(tmpdir):
+    db = Database(db_path=str(tmpdir), backend="json")
+    db.record_build(make_build())
+    other = Database(db_path=str(tmpdir), backend="json")
+    locked = threading.Event()
+    release = threading.Event()
+    acquired = db.lock_stats["acquired"]
+
+    def write():
+        with other.transaction(write=True):
+            other.record_build(make_build("other"))
+            locked.set()
+            release.wait()
+
+    t = threading.Thread(target=write)
+    t.start()
+    locked.wait()
+    threading.Timer(0.2, release.set).start()
+    # readers of the shared data wait for the writer
+    assert len(db.load_build_summaries()) == 2
+    t.join()
+    assert db.lock_stats["acquired"] == acquired + 1
+    assert db.lock_stats["contended"] == 1
+    assert db.lock_stats["wait_time"] > 0.1
+
+
+def test_sqlite_lock_contention(tmpdir):
+    db = Database(db_path=str(tmpdir), backend="sqlite")
+    db.record_build(make_build())
+    other = Database(db_path=str(tmpdir), backend="sqlite")
+    locked = threading.Event()
+    release = threading.Event()
+    acquired = db.lock_stats["acquired"]
+
+    def write():
+        with other.transaction(write=True):
+            other.record_build(make_build("other"))
+            locked.set()
+            release.wait()
+
+    t = threading.Thread(target=write)
+    t.start()
+    locked.wait()
+    threading.Timer(0.2, release.set).start()
+    # readers don't wait in WAL mode, writers do
+    assert len(db.load_build_summaries()) == 1
+    assert db.lock_stats["acquired"] == acquired
+    db.record_build(make_build("third"))
+    t.join()
+    assert db.lock_stats["acquired"] == acquired + 1
+    assert db.lock_stats["contended"] == 1
+    assert db.lock_stats["wait_time"] > 0.1
+    assert len(db.load_build_summaries()) == 3
+
+
+def test_readers_dont_block(tmpdir):
+    db = Database(db_path=str(tmpdir), backend="json")
+    db.record_build(make_build())
+    other = Database(db_path=str(tmpdir), backend="json")
+    with other.transaction():
+        other.load_build_summaries()
+        assert len(db.load_build_summaries()) == 1
+    assert db.lock_stats["contended"] == 0
+
+
+def test_dead_process_does_not_hold_lock(tmpdir):
+    db = Database(db_path=str(tmpdir), backend="json")
+    pid = os.fork()
+    if pid == 0:
+        # the child takes the lock and dies without releasing it
+        Database(db_path=str(tmpdir), backend="json").transaction(write=True).__enter__()
+        os._exit(0)
+    os.waitpid(pid, 0)
+    db.record_build(make_build())
+    assert db.lock_stats["contended"] == 0
+
+
+def test_logs(db):
+    build = db.record_build(make_build())
+    build.log_file = db.save_logs(build.build_id, ("line %d" % x for x in range(1000)))
+    db.record_build(build)
+
+    build = db.get_build(build.build_id)
+    assert "log_lines" not in build.to_dict()
+    logs = db.iter_logs(build)
+    assert next(logs) == "line 0"
+    assert list(db.iter_logs(build, tail=2)) == ["line 998", "line 999"]
+
+    db.delete_build(build.build_id)
+    assert not os.path.exists(os.path.join(db.runtime_dir_path, build.log_file))
+
+
+def test_legacy_inline_logs(db):
+    build = db.record_build(make_build())
+    build.log_lines = ["legacy", "logs"]
+    assert list(db.iter_logs(build)) == ["legacy", "logs"]
+    # logs are moved out of the record once it's written
+    db.record_build(build)
+    build = db.get_build(build.build_id)
+    assert build.log_file
+    assert list(db.iter_logs(build, tail=1)) == ["logs"]
+
+
+def test_json_read_cache(tmpdir):
+    db = Database(db_path=str(tmpdir), backend="json")
+    db.record_build(make_build())
+    stats = db.backend.cache_stats
+    misses = stats["misses"]
+    db.get_build("1")
+    db.get_build("1")
+    assert stats["misses"] == misses
+    assert stats["hits"] >= 2
+
+    # a change done by a different process has to be picked up: db.json and the new build
+    Database(db_path=str(tmpdir), backend="json").record_build(make_build("other"))
+    assert db.get_latest_build().target_image == "other"
+    assert stats["misses"] == misses + 2
+
+    # in-memory changes of a loaded build don't leak into the cache
+    build = db.get_build("1")
+    build.metadata.labels["leak"] = "yes"
+    assert db.get_build("1").metadata.labels == {}
+
+
+def test_snapshot_reads_dont_wait_for_writers(tmpdir):
+    db = Database(db_path=str(tmpdir), backend="json")
+    db.record_build(make_build())
+    writer = Database(db_path=str(tmpdir), backend="json")
+    with writer.transaction(write=True):
+        writer.record_build(writer.get_build("1"))
+        assert db.get_build("1", snapshot=True).build_id == "1"
+        assert len(db.load_builds(snapshot=True)) == 1
+    assert db.lock_stats["acquired"] == 2  # only the write above: global and build's lock
+    # no temporary files are left behind
+    assert sorted(os.listdir(db.runtime_dir_path)) == ["ab.lock", "builds", "db.json"]
+    assert sorted(os.listdir(os.path.join(db.runtime_dir_path, "builds"))) == ["1.json", "1.lock"]
+
+
+def test_transaction(db):
+    build = db.record_build(make_build())
+    with db.transaction(write=True):
+        build = db.get_build(build.build_id)
+        build.record_layer("content", "layer-1", "base", cached=False)
+        db.record_build(build)
+        db.save_layer("layer-1", "base", "content")
+        # the changes are visible within the transaction
+        assert db.get_cached_layer("content", "base") == "layer-1"
+    assert db.get_build(build.build_id).layers[-1].layer_id == "layer-1"
+    assert db.get_cached_layer("content", "base") == "layer-1"
+
+    with pytest.raises(RuntimeError, match="read-only"):
+        with db.transaction():
+            db.save_layer("layer-2", "base", "content")
+
+    # nothing is persisted when the transaction fails
+    with pytest.raises(ValueError):
+        with db.transaction(write=True):
+            db.save_layer("layer-3", "base", "content-3")
+            raise ValueError()
+    assert db.get_cached_layer("content-3", "base") is None
+
+
+def test_failed_save_is_discarded(tmpdir):
+    db = Database(db_path=str(tmpdir), backend="json")
+    db.save_layer("layer-1", "base", "content")
+    backend = db.backend
+    save = backend.save
+
+    def failing_save(path, data):
+        if path == backend.store_path():
+            raise OSError("No space left on device")
+        save(path, data)
+
+    backend.save = failing_save
+    with pytest.raises(OSError):
+        with db.transaction(write=True):
+            db.save_layer("layer-2", "base", "content-2")
+    del backend.save
+    # the change is neither on the disk nor in the memory of the process
+    assert db.get_cached_layer("content-2", "base") is None
+    assert db.get_cached_layer("content", "base") == "layer-1"
+
+
+def test_transaction_locks_once(tmpdir):
+    db = Database(db_path=str(tmpdir), backend="json")
+    with db.transaction(write=True):
+        db.record_build(make_build())
+        db.get_build("1")
+        db.save_layer("layer-1", "base", "content")
+    # the shared data and the build
+    assert db.lock_stats["acquired"] == 2
+
+
+def test_builds_dont_contend(tmpdir):
+    db = Database(db_path=str(tmpdir), backend="json")
+    build = db.record_build(make_build())
+    other = Database(db_path=str(tmpdir), backend="json")
+    other_build = other.record_build(make_build())
+    with other.transaction(write=True):
+        # the build is locked, not the whole database
+        other_build.record_layer("content", "layer-1", "base", cached=False)
+        other.record_build(other_build)
+        build.record_layer("content", "layer-2", "base", cached=False)
+        db.record_build(build)
+    assert db.lock_stats["contended"] == 0
+    assert db.get_build(build.build_id).layers[-1].layer_id == "layer-2"
+    assert db.get_build(other_build.build_id).layers[-1].layer_id == "layer-1"
+
+
+def test_json_split_legacy_database(tmpdir):
+    runtime_dir = os.path.join(str(tmpdir), "ab")
+    os.makedirs(runtime_dir)
+    build = make_build()
+    build.build_id = "1"
+    with open(os.path.join(runtime_dir, "db.json"), "w") as fd:
+        json.dump({
+            "next_build_id": 2,
+            "builds": {"1": build.to_dict()},
+            "store": {"base": {"content": {"image_id": "layer-1"}}},
+        }, fd)
+
+    db = Database(db_path=str(tmpdir), backend="json")
+    assert db.get_build("1").target_image == build.target_image
+    assert [s.build_id for s in db.load_build_summaries()] == ["1"]
+    assert db.get_cached_layer("content", "base") == "layer-1"
+    assert db.record_build(make_build()).build_id == "2"
+    with open(os.path.join(runtime_dir, "db.json")) as fd:
+        assert "builds" not in json.load(fd)
+
+
+def test_build_summaries(db):
+    for idx, image in enumerate(["app", "web", "app", "app"]):
+        build = make_build(image)
+        build.build_start_time = datetime.datetime(2019, 1, idx + 1)
+        db.record_build(build, build_state=BuildState.DONE if idx % 2 else BuildState.FAILED)
+    db.delete_build("3")
+
+    summaries = db.load_build_summaries()
+    assert [s.build_id for s in summaries] == ["1", "2", "4"]
+    assert summaries[0].build_start_time == datetime.datetime(2019, 1, 1)
+    assert summaries[0].duration is None
+
+    assert [s.build_id for s in db.load_build_summaries(limit=2)] == ["2", "4"]
+    assert [s.build_id for s in db.load_build_summaries(state=BuildState.DONE)] == ["2", "4"]
+    assert [s.build_id for s in db.load_build_summaries(target_image="a*")] == ["1", "4"]
+    assert [s.build_id for s in db.load_build_summaries(
+        since=datetime.datetime(2019, 1, 2), target_image="app", limit=5)] == ["4"]
+
+
+def test_cache_entries_accounting(db):
+    db.save_layer("layer-1", "base", "content-1", size=100, duration=1.5)
+    db.save_layer("layer-2", "base", "content-2")
+    entries = {e["content"]: e for e in db.load_cache_entries()}
+    assert entries["content-1"]["size"] == 100
+    assert entries["content-1"]["duration"] == 1.5
+    assert entries["content-2"]["size"] is None
+    assert entries["content-2"]["duration"] is None
+    first_hit = entries["content-1"]["last_hit"]
+    assert isinstance(first_hit, datetime.datetime)
+
+    # planning a build doesn't count as a hit
+    assert db.get_cached_layer("content-1", "base", touch=False) == "layer-1"
+    entries = {e["content"]: e for e in db.load_cache_entries()}
+    assert entries["content-1"]["last_hit"] == first_hit
+
+    assert db.get_cached_layer("content-1", "base") == "layer-1"
+    entries = {e["content"]: e for e in db.load_cache_entries()}
+    assert entries["content-1"]["last_hit"] > first_hit
+
+    db.record_python_interpreter("base", "/usr/bin/python3")
+    db.delete_cache_entries([entries["content-1"]])
+    assert db.get_cached_layer("content-1", "base") is None
+    assert [e["content"] for e in db.load_cache_entries()] == ["content-2"]
+    assert db.load_python_interpreter("base") == "/usr/bin/python3"
+
+
+def test_cache_policy():
+    now = datetime.datetime(2019, 1, 31)
+
+    def entry(content, base, days_ago, size):
+        return {"base_image_id": base, "content": content, "image_id": content,
+                "last_hit": now - datetime.timedelta(days=days_ago), "size": size}
+    entries = [
+        entry("old", "a", 40, 10),
+        entry("a1", "a", 3, 10),
+        entry("a2", "a", 2, 10),
+        entry("a3", "a", 1, 10),
+        entry("b1", "b", 5, 100),
+    ]
+
+    def evicted(**kwargs):
+        policy = CachePolicy(**dict({"max_entries_per_base": None, "max_age": None}, **kwargs))
+        return [e["content"] for e in policy.select_evicted(entries, now=now)]
+
+    assert evicted() == []
+    assert evicted(max_age=datetime.timedelta(days=30)) == ["old"]
+    assert evicted(max_entries_per_base=2) == ["a1", "old"]
+    # least recently used go first
+    assert evicted(max_size=25) == ["a1", "b1", "old"]
+    assert CachePolicy().select_evicted(entries, now=now)[0]["content"] == "old"
+
+
+def test_retention_policy():
+    now = datetime.datetime(2019, 1, 31)
+
+    def summary(build_id, image, state, days_ago):
+        return BuildSummary(build_id, image, state,
+                            build_finished_time=now - datetime.timedelta(days=days_ago))
+    summaries = [
+        summary("1", "app-20190101-120000000000-failed", BuildState.FAILED, 30),
+        summary("2", "app", BuildState.DONE, 20),
+        summary("3", "app-20190125-120000000000-failed", BuildState.FAILED, 6),
+        summary("4", "app", BuildState.DONE, 5),
+        summary("5", "web", BuildState.DONE, 4),
+        summary("6", "app", BuildState.IN_PROGRESS, 0),
+    ]
+
+    def expired(**kwargs):
+        policy = RetentionPolicy(**kwargs)
+        return [s.build_id for s in policy.select_expired(summaries, now=now)]
+
+    assert expired(keep_builds=None, failed_max_age=None) == []
+    assert expired(keep_builds=None, failed_max_age=datetime.timedelta(days=7)) == ["1"]
+    # failed builds count towards their target image, builds in progress are left alone
+    assert expired(keep_builds=2, failed_max_age=None) == ["1", "2"]
+    assert expired(keep_builds=1, failed_max_age=datetime.timedelta(days=1)) == ["1", "2", "3"]
+    assert RetentionPolicy.get_failed_image_target(summaries[0].target_image) == "app"
+    assert RetentionPolicy.get_failed_image_target("app") is None
@@ -0,0 +1,74 @@
+"""
+Tests for fingerprints of files used by tasks
+"""
+import os
+
+from ansible_bender.fingerprint import Fingerprinter, IGNORE_FILE_NAME
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fd:
+        fd.write(content)
+    # pretend the file is old enough to be cached
+    os.utime(path, (1000000000, 1000000000))
+
+
+def test_fingerprint_content(tmpdir):
+    d = str(tmpdir.join("files"))
+    write(os.path.join(d, "a"), "a")
+    write(os.path.join(d, "sub", "b"), "b")
+    f = Fingerprinter()
+    fp = f.fingerprint(d)
+    assert f.fingerprint(os.path.join(d, "nope")) is None
+
+    # touching files doesn't change the fingerprint
+    os.utime(os.path.join(d, "a"), (2000000000, 2000000000))
+    assert f.fingerprint(d) == fp
+
+    write(os.path.join(d, "a"), "changed")
+    assert f.fingerprint(d) != fp
+    write(os.path.join(d, "a"), "a")
+    assert f.fingerprint(d) == fp
+
+    os.chmod(os.path.join(d, "sub", "b"), 0o755)
+    assert f.fingerprint(d) != fp
+    os.chmod(os.path.join(d, "sub", "b"), 0o644)
+
+    os.rename(os.path.join(d, "sub", "b"), os.path.join(d, "sub", "c"))
+    assert f.fingerprint(d) != fp
+
+
+def test_abignore(tmpdir):
+    d = str(tmpdir.join("files"))
+    write(os.path.join(d, "sub", "a"), "a")
+    f = Fingerprinter()
+    write(os.path.join(d, IGNORE_FILE_NAME), "# comment\n.git/\n*.pyc\n")
+    fp = f.fingerprint(d)
+
+    write(os.path.join(d, ".git", "HEAD"), "ref")
+    write(os.path.join(d, "sub", "x.pyc"), "bytecode")
+    assert f.fingerprint(d) == fp
+    write(os.path.join(d, "sub", "x.py"), "code")
+    assert f.fingerprint(d) != fp
+
+
+def test_stat_cache(tmpdir):
+    d = str(tmpdir.join("files"))
+    for i in range(20):
+        write(os.path.join(d, str(i)), str(i))
+    cache_path = str(tmpdir.join("fingerprints.json"))
+
+    f = Fingerprinter(cache_path)
+    fp = f.fingerprint(d)
+    assert f.stats == {"hits": 0, "misses": 20}
+    f.save()
+
+    f = Fingerprinter(cache_path)
+    assert f.fingerprint(d) == fp
+    assert f.stats == {"hits": 20, "misses": 0}
+
+    # the cache is invalidated by a different size or mtime
+    write(os.path.join(d, "0"), "zero")
+    assert f.fingerprint(d) != fp
+    assert f.stats == {"hits": 39, "misses": 1}
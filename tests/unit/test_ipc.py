@@ -0,0 +1,40 @@
+"""
+Tests for the communication between the callback plugin and ab
+"""
+import os
+
+import pytest
+
+from ansible_bender.api import Application
+from ansible_bender.builders.base import BuildState
+from ansible_bender.constants import NO_CACHE_TAG
+from ansible_bender.exceptions import ABError
+from ansible_bender.ipc import BuildService, BuildServiceClient
+from tests.spellbook import make_build
+
+
+@pytest.fixture()
+def app(tmpdir):
+    return Application(db_path=str(tmpdir), init_logging=False)
+
+
+def test_task_started(app):
+    build = app.db.record_build(make_build())
+    with BuildService(app, build) as service:
+        client = BuildServiceClient(service.address)
+        response = client.call("task_started", content="123", tags=[NO_CACHE_TAG])
+        assert response == {"skip": False, "message": f"detected tag '{NO_CACHE_TAG}': won't load from cache from now"}
+        # the service works with the build in memory and persists it
+        assert not build.cache_tasks
+        assert not app.db.get_build(build.build_id).cache_tasks
+
+        client.call("abort_build")
+        assert client.call("task_started", content="123", tags=[]) == {"skip": True, "message": None}
+        assert app.db.get_build(build.build_id).state == BuildState.FAILED
+
+        with pytest.raises(ABError, match="Unknown method"):
+            client.call("nope")
+        # the connection is still usable after an error
+        assert client.call("task_finished", content="123", tags=[], action="command") == {"message": None}
+        client.close()
+    assert not os.path.exists(service.address)
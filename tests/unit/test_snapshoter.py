@@ -0,0 +1,184 @@
+"""
+Tests for the callback plugin
+"""
+import os
+
+import yaml
+from ansible.executor.task_result import TaskResult
+from ansible.inventory.host import Host
+from ansible.parsing.dataloader import DataLoader
+from ansible.playbook.task import Task
+from ansible.template import Templar
+from flexmock import flexmock
+
+try:
+    from ansible.template import trust_as_template
+except ImportError:
+    # ansible < 2.19 treats every string as a template
+    def trust_as_template(value):
+        return value
+
+from ansible_bender.api import Application
+from ansible_bender.callback_plugins.snapshoter import (
+    CallbackModule, get_referenced_variables, get_task_sources, get_task_templates,
+    get_unresolved_variables, resolve_variables,
+)
+from ansible_bender.ipc import BuildService, BuildServiceClient
+from tests.spellbook import loop_playbook_path, make_build
+
+
+def write(path, content=""):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fd:
+        fd.write(content)
+
+
+def load_task(ds, search_path):
+    task = Task.load(ds, loader=DataLoader())
+    flexmock(task, get_search_path=lambda: search_path)
+    return task
+
+
+def test_task_sources(tmpdir):
+    playbook_dir = str(tmpdir)
+    role_path = os.path.join(playbook_dir, "roles", "web")
+    write(os.path.join(playbook_dir, "files", "a.txt"))
+    write(os.path.join(playbook_dir, "templates", "a.j2"))
+    write(os.path.join(playbook_dir, "other.yml"))
+    write(os.path.join(role_path, "templates", "nginx.conf.j2"))
+    write(os.path.join(role_path, "defaults", "main.yml"))
+    write(os.path.join(role_path, "tasks", "main.yml"))
+
+    task = load_task({"copy": {"src": "a.txt", "dest": "/a"}}, [playbook_dir])
+    assert get_task_sources(task) == [os.path.join(playbook_dir, "files", "a.txt")]
+
+    task = load_task({"template": {"src": "a.j2", "dest": "/a"}}, [playbook_dir])
+    assert get_task_sources(task) == [os.path.join(playbook_dir, "templates", "a.j2")]
+
+    task = load_task({"include_tasks": "other.yml"}, [playbook_dir])
+    assert get_task_sources(task) == [os.path.join(playbook_dir, "other.yml")]
+
+    task = load_task({"include_role": {"name": "web"}}, [playbook_dir])
+    assert get_task_sources(task) == [role_path]
+
+    # a task of a role: templates are found within the role, defaults affect the task
+    task = load_task({"template": {"src": "nginx.conf.j2", "dest": "/a"}}, [role_path, playbook_dir])
+    task._role = flexmock(_role_path=role_path)
+    assert get_task_sources(task) == [
+        os.path.join(role_path, "defaults"),
+        os.path.join(role_path, "templates", "nginx.conf.j2"),
+    ]
+
+    task = load_task({"copy": {"src": "missing", "dest": "/a"}}, [playbook_dir])
+    assert get_task_sources(task) == []
+
+
+def test_referenced_variables():
+    ds = {
+        "name": "install {{ package }}",
+        "dnf": {"name": "{{ package }}-{{ app_version | default('1') }}", "state": "present"},
+        "when": ["enabled", "item.x is defined"],
+        "loop": "{{ items }}",
+        "delegate_to": "{{ inventory_hostname }}",
+        "args": {"creates": "{% for x in paths %}{{ x }}{% endfor %}"},
+    }
+    assert get_referenced_variables(ds) == {"package", "app_version", "enabled", "item.x", "items", "paths"}
+    assert get_referenced_variables({"command": "ls {{ broken"}) == set()
+    ds = {
+        "debug": {"msg": "{{ ansible_facts['os_family'] }} {{ ansible_date_time.epoch }}"},
+        "when": ["result.rc == 0", "result.stdout_lines[0] == x", "x.split(',') | length > 1"],
+    }
+    assert get_referenced_variables(ds) == {
+        "ansible_facts.os_family", "result.rc", "result.stdout_lines.0", "x",
+    }
+
+
+def test_task_templates(tmpdir):
+    playbook_dir = str(tmpdir)
+    templates_dir = os.path.join(playbook_dir, "templates")
+    write(os.path.join(templates_dir, "a.j2"),
+          "# {{ ansible_managed }}\nport={{ port }}\n{% include 'b.j2' %}\n")
+    write(os.path.join(templates_dir, "b.j2"), "{% for x in users %}{{ x }}@{{ host.name }}{% endfor %}")
+    write(os.path.join(templates_dir, "c.j2"), "{{ motd }}")
+    a, b, c = (os.path.join(templates_dir, x) for x in ("a.j2", "b.j2", "c.j2"))
+
+    ds = {"template": {"src": "a.j2", "dest": "{{ dest }}"}}
+    task = load_task(ds, [playbook_dir])
+    assert get_task_templates(task) == [a, b]
+    # variables defined by the template action are left out
+    assert get_referenced_variables(ds, [a, b]) == {"dest", "port", "users", "host.name"}
+
+    ds = {"copy": {"content": "{{ lookup('template', 'c.j2') }}", "dest": "/c"}}
+    assert get_task_templates(load_task(ds, [playbook_dir])) == [c]
+    assert get_referenced_variables(ds, [c]) == {"motd"}
+
+    # the name of the template is known only once the task runs
+    task = load_task({"debug": {"msg": "{{ lookup('template', item) }}"}, "loop": ["c.j2"]}, [playbook_dir])
+    assert get_task_templates(task) is None
+    task = load_task({"template": {"src": trust_as_template("{{ name }}.j2"), "dest": "/a"}}, [playbook_dir])
+    assert get_task_templates(task) is None
+    templar = Templar(loader=DataLoader(), variables={"name": "c"})
+    assert get_task_templates(task, templar) == [c]
+
+
+def test_resolve_variables():
+    variables = {"app_version": "1.2", "packages": ["a", "b"], "unrelated": "x"}
+    assert resolve_variables(["app_version", "packages", "undefined"], variables) == {
+        "app_version": "1.2", "packages": ["a", "b"],
+    }
+    variables = {
+        "ansible_facts": {"os_family": "RedHat", "date_time": {"epoch": "1"}},
+        "result": {"changed": True, "rc": 0, "stdout": "x", "start": "10:00", "end": "10:01"},
+        # variables loaded by ansible are trusted to be templates
+        "defined_by_template": trust_as_template("{{ result }}"),
+    }
+    assert resolve_variables(["ansible_facts.os_family", "result.rc", "result.missing"], variables) == {
+        "ansible_facts.os_family": "RedHat", "result.rc": 0,
+        "result.missing": {"changed": True, "rc": 0, "stdout": "x"},
+    }
+    assert resolve_variables(["defined_by_template.stdout"], variables) == {"defined_by_template.stdout": "x"}
+
+
+def test_unresolved_variables():
+    # variables known when the playbook is planned: no facts, nothing is registered
+    variables = {"ansible_facts": {}, "config": {"port": 80}, "version": "{{ other }}"}
+    assert get_unresolved_variables(
+        ["ansible_facts.os_family", "ansible_distribution", "result.rc", "config.port",
+         "config.host", "version.split"], variables) == {
+        "ansible_facts.os_family", "ansible_distribution", "result.rc", "config.host",
+    }
+
+
+def send_callback(callback, method_name, *args):
+    """ dispatch an event the same way TaskQueueManager.send_callback does """
+    getattr(callback, method_name)(*args)
+    callback.v2_on_any(*args)
+
+
+def test_loop_is_committed_once(tmpdir):
+    app = Application(db_path=str(tmpdir), init_logging=False)
+    build = make_build()
+    build.record_layer(None, "base", None, cached=True)
+    build = app.db.record_build(build)
+    builder = flexmock(is_image_present=lambda layer_id: True, get_layer_size=lambda layer_id, base: 1)
+    builder.should_receive("commit").and_return("layer-1").and_return("layer-2").times(2)
+    flexmock(app).should_receive("get_builder").and_return(builder)
+
+    with open(loop_playbook_path) as fd:
+        play = yaml.safe_load(fd)[0]
+    host = Host("container")
+    callback = CallbackModule()
+    with BuildService(app, build) as service:
+        callback._client = BuildServiceClient(service.address)
+        for ds in play["tasks"]:
+            task = Task.load(ds, loader=DataLoader())
+            send_callback(callback, "v2_playbook_on_task_start", task, False)
+            items = list(range(50)) if "loop" in ds else []
+            item_results = [{"item": x, "changed": True, "_ansible_item_result": True} for x in items]
+            for item_result in item_results:
+                send_callback(callback, "v2_runner_item_on_ok", TaskResult(host, task, item_result, {}))
+            result = {"changed": True, "results": item_results} if items else {"changed": True}
+            send_callback(callback, "v2_runner_on_ok", TaskResult(host, task, result, {}))
+        callback._client.close()
+    # a single layer for the loop and one for the following task
+    assert [x.layer_id for x in build.layers] == ["base", "layer-1", "layer-2"]